@@ -0,0 +1,148 @@
+import itertools
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Callable
+
+if TYPE_CHECKING:
+    from lora_conversion import ConvertedLoRA
+
+# Default VRAM budget for the adapters resident in one transformer
+DEFAULT_ADAPTER_POOL_BYTES = 2 * (2**30)
+
+# Adapter names are unique across pools, since pipelines with their own
+# pools, like dev and schnell, can share a text encoder
+_adapter_ids = itertools.count()
+
+
+@dataclass
+class _Adapter:
+    name: str
+    size: int
+
+
+class AdapterPool:
+    """
+    LoRA adapters kept loaded in one pipeline's transformer, so switching
+    between adapters that are already resident is just a `set_adapters`
+    call instead of unloading everything and loading it again.
+
+    Every version of a URL's weights gets its own adapter name. Once the adapters' weights exceed
+    `max_bytes`, the least recently used ones that the current request
+    doesn't need are removed with `delete_adapters`. Pipelines that wrap the
+    same transformer, like img2img and inpainting, share its pool.
+
+    `load_state_dict` returns either a state dict for `load_lora_weights`
+    or a `ConvertedLoRA`, which is injected without converting it again.
+    `inspect`, if given, returns the bytes a URL's adapter will take up
+    without loading it, or raises for a file that can't be loaded. All of
+    a request's new adapters are inspected before anything is deleted or
+    loaded, so a bad file leaves the pipeline as it was.
+
+    `resolve`, if given, maps a URL to the weights it currently points at,
+    e.g. the name of its weights cache entry. Adapters are resident per
+    resolved key, so a URL that moved to new weights loads them instead of
+    reusing the adapter of the old ones.
+    """
+
+    def __init__(
+        self,
+        pipe,
+        load_state_dict: Callable[[str], "dict | ConvertedLoRA"],
+        max_bytes: int = DEFAULT_ADAPTER_POOL_BYTES,
+        device: str = "cuda",
+        inspect: Callable[[str], int] | None = None,
+        resolve: Callable[[str], str] | None = None,
+    ):
+        self.pipe = pipe
+        self.device = device
+        self.load_state_dict = load_state_dict
+        self.inspect = inspect
+        self.resolve = resolve
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.total_bytes = 0
+
+        self._lock = threading.Lock()
+        # Resident adapters by resolved key, from least to most recently used
+        self._adapters: OrderedDict[str, _Adapter] = OrderedDict()
+
+    def activate(self, loras: list[tuple[str, float]]) -> list[str]:
+        """Make exactly the given (url, scale) adapters active.
+
+        Adapters that aren't resident yet are loaded. Returns the names of
+        the active adapters.
+        """
+        # LoRAs are linear in their scale, so the same one twice can be merged
+        scales: dict[str, float] = {}
+        urls: dict[str, str] = {}
+        for url, scale in loras:
+            key = self.resolve(url) if self.resolve is not None else url
+            urls[key] = url
+            scales[key] = scales.get(key, 0.0) + scale
+
+        with self._lock:
+            if self.inspect is not None:
+                incoming = [
+                    self.inspect(urls[key])
+                    for key in scales
+                    if key not in self._adapters
+                ]
+                # Room for all of them at once, rather than one at a time
+                self._evict(sum(incoming), keep=set(scales))
+            names = [self._ensure(key, urls[key], keep=set(scales)) for key in scales]
+            self.pipe.enable_lora()
+            self.pipe.set_adapters(names, adapter_weights=list(scales.values()))
+            return names
+
+    def deactivate(self) -> None:
+        """Run without LoRAs, keeping the resident adapters for later requests."""
+        with self._lock:
+            self.pipe.disable_lora()
+
+    def resident(self) -> list[str]:
+        """Resolved keys of the resident adapters, from least to most recently used."""
+        with self._lock:
+            return list(self._adapters)
+
+    def cache_info(self) -> str:
+        return f"CacheInfo(hits={self.hits}, misses={self.misses}, currsize={len(self._adapters)}, bytes={self.total_bytes})"
+
+    def _ensure(self, key: str, url: str, keep: set[str]) -> str:
+        adapter = self._adapters.get(key)
+        if adapter is not None:
+            self.hits += 1
+            self._adapters.move_to_end(key)
+            return adapter.name
+
+        self.misses += 1
+        lora = self.load_state_dict(url)
+        if isinstance(lora, dict):
+            size = sum(v.numel() * v.element_size() for v in lora.values())
+        else:
+            size = lora.nbytes
+        self._evict(size, keep)
+
+        # Names are never reused, so a deleted adapter can't be confused
+        # with a newer one
+        name = f"lora_{next(_adapter_ids)}"
+        if isinstance(lora, dict):
+            self.pipe.load_lora_weights(lora, adapter_name=name)
+        else:
+            lora.load_into(self.pipe, name)
+        # The new LoRA layers are created where the state dict lives
+        self.pipe.to(self.device)
+        self._adapters[key] = _Adapter(name, size)
+        self.total_bytes += size
+        return name
+
+    def _evict(self, incoming: int, keep: set[str]) -> None:
+        for key in list(self._adapters):
+            if self.total_bytes + incoming <= self.max_bytes:
+                return
+            if key in keep:
+                continue
+            adapter = self._adapters.pop(key)
+            self.pipe.delete_adapters(adapter.name)
+            self.total_bytes -= adapter.size
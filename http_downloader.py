@@ -0,0 +1,322 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+DEFAULT_CHUNK_SIZE = 16 * (2**20)
+DEFAULT_CONCURRENCY = 8
+# Attempts per chunk. Each retry continues from the last byte received.
+CHUNK_ATTEMPTS = 5
+DEFAULT_READ_SIZE = 2**20
+# Suffix of the sidecar file recording the progress of a partial download
+PROGRESS_SUFFIX = ".progress"
+
+
+@dataclass
+class RemoteFile:
+    url: str
+    size: int | None
+    etag: str | None
+    accepts_ranges: bool
+
+
+class ParallelDownloader:
+    """
+    In-process replacement for `pget <url> <path>`. Files are fetched with
+    parallel HTTP range requests over a pooled session and written in place,
+    so an interrupted download can be resumed from the chunks that already
+    landed. The SHA-256 of the file is computed while it downloads, by
+    hashing the contiguous prefix of finished chunks as it grows.
+    """
+
+    def __init__(
+        self,
+        concurrency: int = DEFAULT_CONCURRENCY,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        timeout: float = 30,
+        progress_interval: float = 5,
+        read_size: int = DEFAULT_READ_SIZE,
+    ):
+        self.concurrency = concurrency
+        self.chunk_size = chunk_size
+        # Granularity of writes, and of resuming an interrupted chunk
+        self.read_size = read_size
+        self.timeout = timeout
+        self.progress_interval = progress_interval
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=concurrency,
+            pool_maxsize=concurrency,
+            max_retries=Retry(
+                total=3, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504)
+            ),
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.executor = ThreadPoolExecutor(concurrency, thread_name_prefix="download")
+
+    def download(
+        self,
+        url: str,
+        path: Path,
+        sha256: str | None = None,
+        on_progress: Callable[[int, int | None], None] | None = None,
+    ) -> str:
+        """Download `url` to `path` and return the SHA-256 hex digest of the file.
+
+        If `sha256` is given and doesn't match, the file is removed and a
+        RuntimeError is raised. A partial download of the same remote file
+        left at `path` by an earlier attempt is resumed.
+        """
+        path = Path(path)
+        remote = self.probe(url)
+        start_time = time.time()
+
+        if remote.size is not None and remote.accepts_ranges and remote.size > 0:
+            digest = self._download_ranges(remote, path, on_progress)
+        else:
+            digest = self._download_stream(remote, path, on_progress)
+
+        if sha256 is not None and digest != sha256:
+            path.unlink(missing_ok=True)
+            raise RuntimeError(
+                f"SHA-256 mismatch for {url}: expected {sha256}, got {digest}"
+            )
+
+        size = path.stat().st_size
+        elapsed = time.time() - start_time
+        print(
+            f"Downloaded {size / 2**20:.1f} MiB in {elapsed:.2f}s "
+            f"({size / 2**20 / max(elapsed, 1e-6):.1f} MiB/s)"
+        )
+        return digest
+
+    def probe(self, url: str) -> RemoteFile:
+        response = self.session.head(url, allow_redirects=True, timeout=self.timeout)
+        response.raise_for_status()
+        content_length = response.headers.get("Content-Length", "")
+        return RemoteFile(
+            url=response.url,
+            size=int(content_length) if content_length.isdigit() else None,
+            etag=response.headers.get("ETag"),
+            accepts_ranges=response.headers.get("Accept-Ranges") == "bytes",
+        )
+
+    def _download_stream(
+        self,
+        remote: RemoteFile,
+        path: Path,
+        on_progress: Callable[[int, int | None], None] | None,
+    ) -> str:
+        """Fallback for servers that don't support range requests."""
+        progress = _Progress(remote.size, self.progress_interval, on_progress)
+        sha256 = hashlib.sha256()
+        with self.session.get(remote.url, stream=True, timeout=self.timeout) as r:
+            r.raise_for_status()
+            with path.open("wb") as f:
+                for data in r.iter_content(self.read_size):
+                    f.write(data)
+                    sha256.update(data)
+                    progress.add(len(data))
+        return sha256.hexdigest()
+
+    def _download_ranges(
+        self,
+        remote: RemoteFile,
+        path: Path,
+        on_progress: Callable[[int, int | None], None] | None,
+    ) -> str:
+        assert remote.size is not None
+        num_chunks = -(-remote.size // self.chunk_size)
+        state = _ResumeState(path, remote)
+        done = state.load() if path.exists() else set()
+
+        with path.open("r+b" if path.exists() else "wb") as f:
+            f.truncate(remote.size)
+
+        hasher = _PrefixHasher(path, self.chunk_size, num_chunks, self.read_size)
+        progress = _Progress(remote.size, self.progress_interval, on_progress)
+        for index in sorted(done):
+            hasher.chunk_done(index)
+            progress.add(self._chunk_range(index, remote.size)[1])
+
+        def fetch(index: int) -> None:
+            self._fetch_chunk(remote, path, index, progress)
+            state.chunk_done(index)
+            hasher.chunk_done(index)
+
+        pending = [i for i in range(num_chunks) if i not in done]
+        futures = [self.executor.submit(fetch, i) for i in pending]
+        try:
+            for future in futures:
+                future.result()
+        except BaseException:
+            # Don't leave chunks writing into a file the caller may remove
+            for future in futures:
+                future.cancel()
+            wait(futures)
+            raise
+
+        state.remove()
+        return hasher.hexdigest()
+
+    def _chunk_range(self, index: int, size: int) -> tuple[int, int]:
+        start = index * self.chunk_size
+        return start, min(self.chunk_size, size - start)
+
+    def _fetch_chunk(
+        self, remote: RemoteFile, path: Path, index: int, progress: "_Progress"
+    ) -> None:
+        assert remote.size is not None
+        start, length = self._chunk_range(index, remote.size)
+        received = 0
+        fd = os.open(path, os.O_WRONLY)
+        try:
+            for attempt in range(CHUNK_ATTEMPTS):
+                end = start + length - 1
+                headers = {"Range": f"bytes={start + received}-{end}"}
+                if remote.etag:
+                    # Fail rather than mix bytes of two versions of the file
+                    headers["If-Range"] = remote.etag
+                try:
+                    with self.session.get(
+                        remote.url, headers=headers, stream=True, timeout=self.timeout
+                    ) as r:
+                        r.raise_for_status()
+                        if r.status_code != 206:
+                            raise RuntimeError(
+                                f"Expected a partial response for {remote.url}, got {r.status_code}"
+                            )
+                        for data in r.iter_content(self.read_size):
+                            os.pwrite(fd, data, start + received)
+                            received += len(data)
+                            progress.add(len(data))
+                    if received == length:
+                        return
+                except requests.RequestException as e:
+                    print(f"Chunk {index} failed (attempt {attempt + 1}): {e}")
+            raise RuntimeError(
+                f"Failed to download bytes {start}-{start + length - 1} of {remote.url}"
+            )
+        finally:
+            os.close(fd)
+
+
+def progress_path(path: Path) -> Path:
+    """The file recording which chunks of a partial download at `path` landed."""
+    return path.with_name(path.name + PROGRESS_SUFFIX)
+
+
+class _ResumeState:
+    """Sidecar file recording which chunks of a partial download are complete."""
+
+    def __init__(self, path: Path, remote: RemoteFile):
+        self.path = progress_path(path)
+        self.remote = remote
+        self.done: set[int] = set()
+        self.lock = threading.Lock()
+
+    def load(self) -> set[int]:
+        try:
+            state = json.loads(self.path.read_text())
+        except (FileNotFoundError, json.JSONDecodeError):
+            return set()
+        # Only resume if it is still the same remote file
+        if state.get("size") != self.remote.size or state.get("etag") != (
+            self.remote.etag
+        ):
+            return set()
+        self.done = set(state.get("chunks", []))
+        return set(self.done)
+
+    def chunk_done(self, index: int) -> None:
+        with self.lock:
+            self.done.add(index)
+            state = {
+                "size": self.remote.size,
+                "etag": self.remote.etag,
+                "chunks": sorted(self.done),
+            }
+            tmp_path = self.path.with_name(self.path.name + ".tmp")
+            tmp_path.write_text(json.dumps(state))
+            tmp_path.replace(self.path)
+
+    def remove(self) -> None:
+        self.path.unlink(missing_ok=True)
+
+
+class _PrefixHasher:
+    """SHA-256 of a file whose chunks are written out of order.
+
+    Whenever the run of finished chunks from the start of the file grows,
+    the new bytes are read back (usually from the page cache) and hashed.
+    """
+
+    def __init__(self, path: Path, chunk_size: int, num_chunks: int, read_size: int):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.num_chunks = num_chunks
+        self.read_size = read_size
+        self.sha256 = hashlib.sha256()
+        self.next_chunk = 0
+        self.finished: set[int] = set()
+        self.lock = threading.Lock()
+
+    def chunk_done(self, index: int) -> None:
+        with self.lock:
+            self.finished.add(index)
+            if self.next_chunk not in self.finished:
+                return
+            with self.path.open("rb") as f:
+                f.seek(self.next_chunk * self.chunk_size)
+                while self.next_chunk in self.finished:
+                    self.finished.remove(self.next_chunk)
+                    remaining = self.chunk_size
+                    while remaining > 0 and (
+                        data := f.read(min(self.read_size, remaining))
+                    ):
+                        self.sha256.update(data)
+                        remaining -= len(data)
+                    self.next_chunk += 1
+
+    def hexdigest(self) -> str:
+        assert self.next_chunk == self.num_chunks, "Not all chunks were hashed"
+        return self.sha256.hexdigest()
+
+
+class _Progress:
+    def __init__(
+        self,
+        total: int | None,
+        interval: float,
+        callback: Callable[[int, int | None], None] | None,
+    ):
+        self.total = total
+        self.interval = interval
+        self.callback = callback
+        self.done = 0
+        self.start_time = self.last_report = time.time()
+        self.lock = threading.Lock()
+
+    def add(self, n: int) -> None:
+        with self.lock:
+            self.done += n
+            if self.callback is not None:
+                self.callback(self.done, self.total)
+            now = time.time()
+            if now - self.last_report < self.interval:
+                return
+            self.last_report = now
+            total = f"/{self.total / 2**20:.0f}" if self.total else ""
+            rate = self.done / 2**20 / max(now - self.start_time, 1e-6)
+            print(f"Downloaded {self.done / 2**20:.0f}{total} MiB ({rate:.1f} MiB/s)")
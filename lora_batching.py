@@ -0,0 +1,254 @@
+import threading
+from collections.abc import Collection
+from typing import Callable
+
+import torch
+
+from lora_slots import DEFAULT_MAX_RANK, scaled_lora_weights, targetable_modules
+
+# Adapter index of batch samples that run without a LoRA
+NO_ADAPTER = -1
+
+
+def lora_row_groups(
+    adapter_indices: list[int], device: torch.device | str = "cpu"
+) -> list[tuple[int, torch.Tensor]]:
+    """The batch samples using each adapter, as (adapter index, rows) pairs.
+
+    Computed once per batch on the host, so forward passes never have to
+    read the indices back from the device. Samples without an adapter are
+    left out.
+    """
+    rows: dict[int, list[int]] = {}
+    for row, index in enumerate(adapter_indices):
+        if index != NO_ADAPTER:
+            rows.setdefault(index, []).append(row)
+    return [(index, torch.tensor(r, device=device)) for index, r in rows.items()]
+
+
+def check_batchable(
+    state_dict: dict, target_modules: Collection[str], max_rank: int
+) -> None:
+    """Raise ValueError if `BatchedLoRAs` can't hold the PEFT LoRA `state_dict`.
+
+    Only looks at keys and shapes, so requests can be checked before they
+    are batched with others.
+    """
+    unsupported = [
+        k for k in state_dict if not k.endswith((".lora_A.weight", ".lora_B.weight"))
+    ]
+    if unsupported:
+        raise ValueError(f"Only plain LoRA weights are supported, got {unsupported[0]}")
+    modules = {k.rsplit(".lora_", 1)[0] for k in state_dict}
+    unknown = modules - set(target_modules)
+    if unknown:
+        raise ValueError(
+            f"LoRA targets layers that can't be batched: {', '.join(sorted(unknown))}"
+        )
+    rank = max(
+        (v.shape[0] for k, v in state_dict.items() if k.endswith(".lora_A.weight")),
+        default=0,
+    )
+    if rank > max_rank:
+        raise ValueError(f"LoRA rank {rank} is above the batched rank of {max_rank}")
+
+
+def segmented_lora_delta(
+    x: torch.Tensor,
+    groups: list[tuple[int, torch.Tensor]],
+    scales: torch.Tensor,
+    lora_a: torch.Tensor,
+    lora_b: torch.Tensor,
+) -> torch.Tensor:
+    """The LoRA update of each batch sample, every sample with its own adapter.
+
+    `x` is (batch, ..., in_features), `groups` comes from `lora_row_groups`,
+    `scales` holds one entry per sample, and `lora_a` and `lora_b` stack the
+    adapters as (adapters, rank, in_features) and (adapters, out_features,
+    rank). Each group runs as two dense matmuls, so the cost grows with the
+    number of distinct adapters in the batch rather than with its size,
+    like a segmented gather matmul.
+    """
+    delta = x.new_zeros(*x.shape[:-1], lora_b.shape[1])
+    for index, rows in groups:
+        hidden = x[rows] @ lora_a[index].T.to(x.dtype)
+        update = hidden @ lora_b[index].T.to(x.dtype)
+        scale = scales[rows].to(x.dtype).view(-1, *[1] * (x.dim() - 1))
+        delta[rows] = update * scale
+    return delta
+
+
+def reference_lora_delta(
+    x: torch.Tensor,
+    adapter_indices: torch.Tensor,
+    scales: torch.Tensor,
+    lora_a: torch.Tensor,
+    lora_b: torch.Tensor,
+) -> torch.Tensor:
+    """Sample by sample version of `segmented_lora_delta`, to check it against."""
+    delta = x.new_zeros(*x.shape[:-1], lora_b.shape[1])
+    for i, index in enumerate(adapter_indices.tolist()):
+        if index != NO_ADAPTER:
+            weight = lora_b[index] @ lora_a[index]
+            delta[i] = scales[i] * (x[i] @ weight.T.to(x.dtype))
+    return delta
+
+
+class BatchedLoRALinear(torch.nn.Module):
+    """
+    A linear layer with a stack of fixed-rank LoRA adapters, where every
+    sample of a batch can use a different one. Which adapter and scale each
+    sample uses is set with `set_batch` before the forward pass.
+    """
+
+    def __init__(self, base_layer: torch.nn.Linear, num_adapters: int, max_rank: int):
+        super().__init__()
+        self.base_layer = base_layer
+        weight = base_layer.weight
+        self.lora_a = torch.nn.Parameter(
+            weight.new_zeros(num_adapters, max_rank, base_layer.in_features),
+            requires_grad=False,
+        )
+        self.lora_b = torch.nn.Parameter(
+            weight.new_zeros(num_adapters, base_layer.out_features, max_rank),
+            requires_grad=False,
+        )
+        self.groups: list[tuple[int, torch.Tensor]] | None = None
+        self.scales: torch.Tensor | None = None
+
+    def set_batch(
+        self, groups: list[tuple[int, torch.Tensor]], scales: torch.Tensor
+    ) -> None:
+        self.groups = groups
+        self.scales = scales
+
+    def clear_batch(self) -> None:
+        self.groups = None
+        self.scales = None
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        out = self.base_layer(x)
+        if self.groups is None or self.scales is None:
+            return out
+        return out + segmented_lora_delta(
+            x, self.groups, self.scales, self.lora_a, self.lora_b
+        )
+
+
+class BatchedLoRAs:
+    """
+    Runs a batch whose samples use different LoRAs in one forward pass, as
+    an alternative to AdapterPool and LoRASlots. Targeted linear layers are
+    replaced by `BatchedLoRALinear` layers holding `num_adapters` adapters
+    of rank `max_rank`, which are filled like LoRASlots fills its slots:
+    zero-padded, with alpha / rank folded into B, least recently used
+    first.
+
+    `load_state_dict` returns a URL's transformer LoRA weights in PEFT
+    format along with their network alphas. `resolve` keys adapters on the
+    weights a URL points at, like it does for LoRASlots.
+    """
+
+    def __init__(
+        self,
+        transformer: torch.nn.Module,
+        load_state_dict: Callable[[str], tuple[dict, dict | None]],
+        num_adapters: int = 8,
+        max_rank: int = DEFAULT_MAX_RANK,
+        target_modules: list[str] | None = None,
+        resolve: Callable[[str], str] | None = None,
+    ):
+        self.transformer = transformer
+        self.load_state_dict = load_state_dict
+        self.resolve = resolve
+        self.max_rank = max_rank
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        # Resolved key of the LoRA held by each adapter index, or None
+        self._keys: list[str | None] = [None] * num_adapters
+        # Adapter indices from least to most recently used
+        self._lru = list(range(num_adapters))
+
+        if target_modules is None:
+            target_modules = targetable_modules(transformer)
+        self._layers: dict[str, BatchedLoRALinear] = {}
+        for name in target_modules:
+            parent_name, _, child_name = name.rpartition(".")
+            parent = transformer.get_submodule(parent_name)
+            layer = BatchedLoRALinear(
+                getattr(parent, child_name), num_adapters, max_rank
+            )
+            setattr(parent, child_name, layer)
+            self._layers[name] = layer
+
+    def set_batch(self, loras: list[tuple[str, float] | None]) -> list[int]:
+        """Use the (url, scale) LoRA of each sample, or none, for the next forward passes.
+
+        LoRAs that aren't loaded yet are copied into the least recently used
+        adapters. Returns each sample's adapter index.
+        """
+        # Resolved key of each URL, in order of first use, so LoRAs are
+        # loaded in a predictable order
+        keys = {
+            url: self.resolve(url) if self.resolve is not None else url
+            for url in dict.fromkeys(lora[0] for lora in loras if lora is not None)
+        }
+        if len(set(keys.values())) > len(self._keys):
+            raise ValueError(
+                f"Can't batch {len(keys)} LoRAs with {len(self._keys)} adapters"
+            )
+
+        with self._lock:
+            keep = set(keys.values())
+            index_of = {url: self._ensure(key, url, keep) for url, key in keys.items()}
+            adapter_indices = [
+                NO_ADAPTER if lora is None else index_of[lora[0]] for lora in loras
+            ]
+            device = next(iter(self._layers.values())).lora_a.device
+            # Shared by every layer, and only built once per batch
+            groups = lora_row_groups(adapter_indices, device)
+            scales = torch.tensor(
+                [0.0 if lora is None else lora[1] for lora in loras], device=device
+            )
+            for layer in self._layers.values():
+                layer.set_batch(groups, scales)
+            return adapter_indices
+
+    def clear_batch(self) -> None:
+        with self._lock:
+            for layer in self._layers.values():
+                layer.clear_batch()
+
+    def cache_info(self) -> str:
+        return f"CacheInfo(hits={self.hits}, misses={self.misses}, adapters={self._keys}, max_rank={self.max_rank})"
+
+    def _ensure(self, key: str, url: str, keep: set[str]) -> int:
+        if key in self._keys:
+            index = self._keys.index(key)
+            self.hits += 1
+        else:
+            self.misses += 1
+            state_dict, network_alphas = self.load_state_dict(url)
+            check_batchable(state_dict, self._layers, self.max_rank)
+            index = next(i for i in self._lru if self._keys[i] not in keep)
+            self._keys[index] = None
+            self._copy_in(index, scaled_lora_weights(state_dict, network_alphas))
+            self._keys[index] = key
+        self._lru.remove(index)
+        self._lru.append(index)
+        return index
+
+    @torch.no_grad()
+    def _copy_in(
+        self, index: int, weights: dict[str, tuple[torch.Tensor, torch.Tensor]]
+    ) -> None:
+        for name, layer in self._layers.items():
+            layer.lora_a[index].zero_()
+            layer.lora_b[index].zero_()
+            if name in weights:
+                lora_a, lora_b = weights[name]
+                rank = lora_a.shape[0]
+                layer.lora_a[index, :rank].copy_(lora_a)
+                layer.lora_b[index, :, :rank].copy_(lora_b)
@@ -0,0 +1,180 @@
+import json
+import os
+import threading
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable
+
+import torch
+from safetensors.torch import load_file, save_file
+
+from lora_memory_cache import LoRAMemoryCache
+from weights import sidecar_path
+
+# Bump to invalidate sidecars written by an older conversion
+CONVERSION_VERSION = 1
+CONVERTED_WEIGHTS_SUFFIX = "peft.safetensors"
+CONVERTED_CONFIG_SUFFIX = "peft.json"
+# Marks the transformer's weights in the converted safetensors file
+TRANSFORMER_PREFIX = "transformer."
+
+
+@dataclass
+class ConvertedLoRA:
+    """
+    A LoRA ready to inject: the transformer's weights in PEFT format with
+    their network alphas and `LoraConfig` kwargs, and any text encoder
+    weights as returned by `lora_state_dict`, keys prefixed "text_encoder.".
+    """
+
+    state_dict: dict[str, torch.Tensor]
+    network_alphas: dict | None
+    config_kwargs: dict
+    text_encoder_state_dict: dict[str, torch.Tensor] = field(default_factory=dict)
+    text_encoder_alphas: dict | None = None
+
+    @property
+    def nbytes(self) -> int:
+        tensors = [*self.state_dict.values(), *self.text_encoder_state_dict.values()]
+        return sum(v.numel() * v.element_size() for v in tensors)
+
+    def load_into(self, pipe, adapter_name: str) -> None:
+        """Add the LoRA to `pipe`, like `pipe.load_lora_weights` without converting."""
+        from lora_loading_patch import load_peft_lora_into_transformer
+
+        if self.state_dict:
+            load_peft_lora_into_transformer(
+                type(pipe),
+                self.state_dict,
+                self.config_kwargs,
+                pipe.transformer,
+                adapter_name,
+                pipe,
+            )
+        if self.text_encoder_state_dict:
+            pipe.load_lora_into_text_encoder(
+                self.text_encoder_state_dict,
+                network_alphas=self.text_encoder_alphas,
+                text_encoder=pipe.text_encoder,
+                prefix="text_encoder",
+                lora_scale=pipe.lora_scale,
+                adapter_name=adapter_name,
+                _pipeline=pipe,
+            )
+
+
+class ConvertedLoRACache:
+    """
+    Converted LoRAs stored as sidecars of their cached files: the PEFT state
+    dict as safetensors and the network alphas and `LoraConfig` kwargs as
+    JSON. Only the first load of a file pays for key conversion and config
+    inference, which is slowest for kohya-style files like most CivitAI
+    LoRAs. The sidecars are removed along with their cached file.
+
+    `convert` turns a raw LoRA state dict into a `ConvertedLoRA`. Converted
+    weights are read through `memory_cache`, and put into it as soon as
+    they are converted.
+    """
+
+    def __init__(
+        self,
+        memory_cache: LoRAMemoryCache,
+        convert: Callable[[dict], ConvertedLoRA],
+    ):
+        self.memory_cache = memory_cache
+        self.convert = convert
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def load(self, path: Path, persist: bool = True) -> ConvertedLoRA:
+        """The converted LoRA for the safetensors file at `path`.
+
+        With `persist` False the conversion isn't saved, for files that
+        aren't in the weights cache.
+        """
+        weights_path = sidecar_path(path, CONVERTED_WEIGHTS_SUFFIX)
+        config_path = sidecar_path(path, CONVERTED_CONFIG_SUFFIX)
+        config = _read_config(config_path)
+        if config is not None and weights_path.exists():
+            with self._lock:
+                self.hits += 1
+            tensors = self.memory_cache.load(weights_path)
+            return ConvertedLoRA(
+                state_dict={
+                    k[len(TRANSFORMER_PREFIX) :]: v
+                    for k, v in tensors.items()
+                    if k.startswith(TRANSFORMER_PREFIX)
+                },
+                network_alphas=config["network_alphas"],
+                config_kwargs=config["config_kwargs"],
+                text_encoder_state_dict={
+                    k: v
+                    for k, v in tensors.items()
+                    if not k.startswith(TRANSFORMER_PREFIX)
+                },
+                text_encoder_alphas=config["text_encoder_alphas"],
+            )
+
+        with self._lock:
+            self.misses += 1
+        lora = self.convert(load_file(path))
+        if persist:
+            tensors = self._save(lora, weights_path, config_path)
+            self.memory_cache.put(weights_path, tensors)
+        return lora
+
+    def warm(self, path: Path) -> bool:
+        """Convert `path` ahead of time and load the conversion into memory.
+
+        Like `LoRAMemoryCache.warm`, the conversion is only loaded if it
+        fits without evicting anything. Returns whether it is in memory.
+        """
+        weights_path = sidecar_path(path, CONVERTED_WEIGHTS_SUFFIX)
+        config_path = sidecar_path(path, CONVERTED_CONFIG_SUFFIX)
+        if _read_config(config_path) is None or not weights_path.exists():
+            self._save(self.convert(load_file(path)), weights_path, config_path)
+        return self.memory_cache.warm(weights_path)
+
+    def _save(
+        self, lora: ConvertedLoRA, weights_path: Path, config_path: Path
+    ) -> dict[str, torch.Tensor]:
+        """Write the sidecars of `lora` and return the tensors written."""
+        tensors = {
+            **{f"{TRANSFORMER_PREFIX}{k}": v for k, v in lora.state_dict.items()},
+            **lora.text_encoder_state_dict,
+        }
+        # Conversion can leave views into one tensor, which safetensors
+        # refuses to save
+        tensors = {k: v.contiguous().clone() for k, v in tensors.items()}
+        _atomic_write(weights_path, lambda p: save_file(tensors, p))
+        # Written last, as its presence marks the sidecar as complete
+        config = {
+            "version": CONVERSION_VERSION,
+            "network_alphas": lora.network_alphas,
+            "config_kwargs": lora.config_kwargs,
+            "text_encoder_alphas": lora.text_encoder_alphas,
+        }
+        # Alphas can be 0-d tensors
+        text = json.dumps(config, default=float)
+        _atomic_write(config_path, lambda p: p.write_text(text))
+        return tensors
+
+    def cache_info(self) -> str:
+        return f"CacheInfo(hits={self.hits}, misses={self.misses})"
+
+
+def _read_config(path: Path) -> dict | None:
+    try:
+        config = json.loads(path.read_text())
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    if config.get("version") != CONVERSION_VERSION:
+        return None
+    return config
+
+
+def _atomic_write(path: Path, write: Callable[[Path], object]) -> None:
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    write(tmp_path)
+    tmp_path.replace(path)
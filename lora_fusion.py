@@ -0,0 +1,138 @@
+import time
+from collections.abc import Hashable
+from typing import Callable
+
+import torch
+
+
+class LoRAFuser:
+    """
+    Fuses the active LoRA adapters into a transformer's base weights once
+    the same LoRAs and scales have been used by `threshold` consecutive
+    requests, so each denoising step stops paying for the low-rank matmuls.
+
+    Before a layer is fused, its base weight is copied to the CPU, and
+    unfusing copies it back, so the base weights come back bit for bit
+    rather than after a lossy subtraction in bf16. The backup buffers are
+    reused between fusions. How long fusing and unfusing take is recorded
+    to help tune `threshold`.
+
+    `resolve`, if given, maps a URL to the weights it currently points at,
+    so `key` changes when a URL moves to new weights and the old ones are
+    no longer treated as fused.
+    """
+
+    def __init__(
+        self,
+        transformer: torch.nn.Module,
+        threshold: int,
+        resolve: Callable[[str], str] | None = None,
+    ):
+        self.transformer = transformer
+        self.threshold = threshold
+        self.resolve = resolve
+        # What is fused into the weights right now, or None
+        self.fused_key: Hashable | None = None
+        self.fuse_times: list[float] = []
+        self.unfuse_times: list[float] = []
+
+        self._last_key: Hashable | None = None
+        self._streak = 0
+        # CPU copies of the base weights of fused layers, by module name
+        self._backups: dict[str, torch.Tensor] = {}
+        self._fused_layers: list[str] = []
+        # Layers whose adapters were disabled by fusing
+        self._disabled_layers: list[str] = []
+
+    def key(self, loras: list[tuple[str, float]], scale: float | None) -> Hashable:
+        """The `observe` key of the (url, scale) `loras` at joint attention `scale`."""
+        resolved = tuple(
+            (self.resolve(url) if self.resolve is not None else url, lora_scale)
+            for url, lora_scale in loras
+        )
+        return resolved, scale
+
+    def observe(self, key: Hashable | None, scale: float = 1.0) -> bool:
+        """Note that a request is about to run with the LoRAs described by `key`.
+
+        `key` identifies the active adapters and their weights, or is None
+        for a request without LoRAs. `scale` is applied on top of the
+        adapter weights, like `joint_attention_kwargs["scale"]`. Fuses the
+        active adapters once `key` has been seen `threshold` times in a row.
+        Returns whether they are fused.
+        """
+        self._streak = self._streak + 1 if key == self._last_key else 1
+        self._last_key = key
+        if (
+            key is not None
+            and self.fused_key is None
+            and self._streak >= self.threshold
+        ):
+            self.fuse(key, scale)
+        return self.fused_key is not None and self.fused_key == key
+
+    @torch.no_grad()
+    def fuse(self, key: Hashable, scale: float = 1.0) -> None:
+        from peft.tuners.tuners_utils import BaseTunerLayer
+
+        assert self.fused_key is None, "Unfuse before fusing again"
+        start = time.time()
+        for name, layer in self.transformer.named_modules():
+            if not isinstance(layer, BaseTunerLayer) or layer.disable_adapters:
+                continue
+            lora_a = getattr(layer, "lora_A", {})
+            adapters = [a for a in layer.active_adapters if a in lora_a]
+            if not adapters:
+                continue
+            delta = sum(layer.get_delta_weight(a) for a in adapters)
+            layer.enable_adapters(False)
+            self._disabled_layers.append(name)
+            # Zeroed adapters, e.g. unused layers in slot mode, need no backup
+            if not torch.any(delta):
+                continue
+
+            weight = layer.get_base_layer().weight
+            backup = self._backups.get(name)
+            if backup is None or backup.shape != weight.shape:
+                backup = self._backups[name] = torch.empty_like(
+                    weight, device="cpu", pin_memory=torch.cuda.is_available()
+                )
+            backup.copy_(weight, non_blocking=True)
+            weight.add_((delta * scale).to(weight.dtype))
+            self._fused_layers.append(name)
+
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        self.fused_key = key
+        self.fuse_times.append(time.time() - start)
+        print(
+            f"Fused LoRAs into {len(self._fused_layers)} layers "
+            f"in {self.fuse_times[-1]:.2f}s"
+        )
+
+    @torch.no_grad()
+    def unfuse(self) -> None:
+        """Restore the base weights and re-enable the adapters, if fused."""
+        if self.fused_key is None:
+            return
+        start = time.time()
+        modules = dict(self.transformer.named_modules())
+        for name in self._fused_layers:
+            weight = modules[name].get_base_layer().weight
+            weight.copy_(self._backups[name], non_blocking=True)
+        for name in self._disabled_layers:
+            modules[name].enable_adapters(True)
+
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        self._fused_layers = []
+        self._disabled_layers = []
+        self.fused_key = None
+        self.unfuse_times.append(time.time() - start)
+        print(f"Unfused LoRAs in {self.unfuse_times[-1]:.2f}s")
+
+    def stats(self) -> str:
+        def mean(times: list[float]) -> float:
+            return sum(times) / len(times) if times else 0.0
+
+        return f"FuseStats(threshold={self.threshold}, fused={self.fused_key is not None}, fuses={len(self.fuse_times)}, mean_fuse={mean(self.fuse_times):.3f}s, unfuses={len(self.unfuse_times)}, mean_unfuse={mean(self.unfuse_times):.3f}s)"
@@ -0,0 +1,165 @@
+import json
+import struct
+from dataclasses import dataclass, field
+from math import prod
+from pathlib import Path
+
+# Bytes per element of each safetensors dtype
+DTYPE_SIZES = {
+    "F64": 8,
+    "F32": 4,
+    "F16": 2,
+    "BF16": 2,
+    "F8_E4M3": 1,
+    "F8_E5M2": 1,
+    "I64": 8,
+    "I32": 4,
+    "I16": 2,
+    "I8": 1,
+    "U8": 1,
+    "BOOL": 1,
+}
+FLOAT_DTYPES = {"F64", "F32", "F16", "BF16", "F8_E4M3", "F8_E5M2"}
+# Headers are a few hundred KiB for the largest LoRAs, anything far bigger is corrupt
+MAX_HEADER_BYTES = 64 * (2**20)
+
+# Suffixes of the down (A) and up (B) weights of each key format, checked
+# in order, so the more specific diffusers suffixes come before xlabs'
+KEY_FORMATS = {
+    "peft": (".lora_A.weight", ".lora_B.weight"),
+    "kohya": (".lora_down.weight", ".lora_up.weight"),
+    "diffusers": (".lora.down.weight", ".lora.up.weight"),
+    "xlabs": (".down.weight", ".up.weight"),
+}
+# Per-module entries that are neither A nor B but still belong to a LoRA
+EXTRA_SUFFIXES = (".alpha", ".dora_scale", ".lora_magnitude_vector")
+# Module names of text encoder layers, as opposed to transformer ones
+TEXT_ENCODER_PREFIXES = ("text_encoder", "lora_te")
+
+
+@dataclass
+class LoRAInfo:
+    """What a LoRA safetensors file holds, read from its header alone."""
+
+    key_format: str
+    # Rank of each module the LoRA targets
+    ranks: dict[str, int]
+    dtypes: set[str]
+    # Bytes of all tensors, which is what the adapter takes up once loaded
+    nbytes: int
+    metadata: dict[str, str] = field(default_factory=dict)
+
+    @property
+    def target_modules(self) -> list[str]:
+        return sorted(self.ranks)
+
+    @property
+    def text_encoder_modules(self) -> list[str]:
+        """Targeted text encoder modules, in diffusers or kohya naming."""
+        return [m for m in self.target_modules if m.startswith(TEXT_ENCODER_PREFIXES)]
+
+    @property
+    def max_rank(self) -> int:
+        return max(self.ranks.values())
+
+    def summary(self) -> str:
+        return f"LoRAInfo(format={self.key_format}, modules={len(self.ranks)}, max_rank={self.max_rank}, dtypes={','.join(sorted(self.dtypes))}, bytes={self.nbytes})"
+
+
+def inspect_lora(path: Path) -> LoRAInfo:
+    """Describe the LoRA in the safetensors file at `path` without loading it.
+
+    Raises ValueError if the file is not a well-formed safetensors file or
+    doesn't hold a LoRA that can be loaded: unknown or mixed key formats,
+    down weights without up weights or with mismatched ranks, non-float
+    weights, or tensors that run past the end of the file.
+    """
+    header, data_size = read_safetensors_header(path)
+    metadata = header.pop("__metadata__", None) or {}
+
+    formats = set()
+    dtypes = set()
+    nbytes = 0
+    # (module, "A" or "B") -> shape
+    factors: dict[tuple[str, str], list[int]] = {}
+    for key, tensor in header.items():
+        dtype, shape = _check_tensor(key, tensor, data_size)
+        dtypes.add(dtype)
+        nbytes += prod(shape) * DTYPE_SIZES[dtype]
+
+        if key.endswith(EXTRA_SUFFIXES) or ".lora_magnitude_vector." in key:
+            continue
+        for key_format, suffixes in KEY_FORMATS.items():
+            suffix = next((s for s in suffixes if key.endswith(s)), None)
+            if suffix is not None:
+                formats.add(key_format)
+                module = key[: -len(suffix)]
+                factors[module, "A" if suffix == suffixes[0] else "B"] = shape
+                break
+        else:
+            raise ValueError(f"{path.name} has a key that isn't part of a LoRA: {key}")
+
+    if not factors:
+        raise ValueError(f"{path.name} has no LoRA weights")
+    if len(formats) > 1:
+        raise ValueError(f"{path.name} mixes LoRA key formats: {sorted(formats)}")
+    non_float = dtypes - FLOAT_DTYPES
+    if non_float:
+        raise ValueError(f"{path.name} has non-float weights: {sorted(non_float)}")
+
+    ranks = {}
+    for module, part in factors:
+        if part != "A":
+            continue
+        down = factors[module, "A"]
+        up = factors.get((module, "B"))
+        if up is None:
+            raise ValueError(f"{path.name} has no up weight for {module}")
+        if len(up) < 2 or up[1] != down[0]:
+            raise ValueError(
+                f"{path.name} has mismatched ranks for {module}: {down} and {up}"
+            )
+        ranks[module] = down[0]
+    missing_down = [m for m, part in factors if part == "B" and m not in ranks]
+    if missing_down:
+        raise ValueError(f"{path.name} has no down weight for {missing_down[0]}")
+
+    return LoRAInfo(formats.pop(), ranks, dtypes, nbytes, metadata)
+
+
+def read_safetensors_header(path: Path) -> tuple[dict, int]:
+    """The parsed JSON header of a safetensors file and the size of its data.
+
+    Raises ValueError if the header can't be read.
+    """
+    file_size = path.stat().st_size
+    with path.open("rb") as f:
+        prefix = f.read(8)
+        if len(prefix) < 8:
+            raise ValueError(f"{path.name} is too small to be a safetensors file")
+        (header_size,) = struct.unpack("<Q", prefix)
+        if header_size > min(MAX_HEADER_BYTES, file_size - 8):
+            raise ValueError(f"{path.name} has an invalid header size: {header_size}")
+        try:
+            header = json.loads(f.read(header_size))
+        except (UnicodeDecodeError, json.JSONDecodeError) as e:
+            raise ValueError(f"{path.name} has an unreadable header: {e}") from e
+    if not isinstance(header, dict):
+        raise ValueError(f"{path.name} has an unreadable header")
+    return header, file_size - 8 - header_size
+
+
+def _check_tensor(key: str, tensor: dict, data_size: int) -> tuple[str, list[int]]:
+    try:
+        dtype = tensor["dtype"]
+        shape = [int(d) for d in tensor["shape"]]
+        begin, end = (int(o) for o in tensor["data_offsets"])
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError(f"Malformed header entry for {key}: {tensor}") from e
+    if dtype not in DTYPE_SIZES:
+        raise ValueError(f"Unknown dtype {dtype} for {key}")
+    if end - begin != prod(shape) * DTYPE_SIZES[dtype] or not 0 <= begin <= end:
+        raise ValueError(f"Size of {key} doesn't match its shape {shape}")
+    if end > data_size:
+        raise ValueError(f"{key} runs past the end of the file, which may be truncated")
+    return dtype, shape
@@ -32,87 +32,118 @@ def load_lora_into_transformer(
             Adapter name to be used for referencing the loaded adapter model. If not specified, it will use
             `default_{i}` where i is the total number of adapters being loaded.
     """
+    state_dict, network_alphas = transformer_peft_state_dict(
+        state_dict, network_alphas, cls.transformer_name
+    )
+
+    if len(state_dict.keys()) > 0:
+        lora_config_kwargs = transformer_lora_config_kwargs(state_dict, network_alphas)
+        load_peft_lora_into_transformer(
+            cls, state_dict, lora_config_kwargs, transformer, adapter_name, _pipeline
+        )
+
+
+def load_peft_lora_into_transformer(
+    cls, state_dict, lora_config_kwargs, transformer, adapter_name=None, _pipeline=None
+):
+    """
+    Inject a LoRA already in PEFT format into `transformer`, with the
+    `LoraConfig` kwargs from `transformer_lora_config_kwargs`. This is the
+    second half of `load_lora_into_transformer`, for LoRAs whose conversion
+    was cached.
+    """
     from peft import LoraConfig, inject_adapter_in_model, set_peft_model_state_dict
 
-    keys = list(state_dict.keys())
+    if adapter_name in getattr(transformer, "peft_config", {}):
+        raise ValueError(
+            f"Adapter name {adapter_name} already in use in the transformer - please select a new adapter name."
+        )
 
-    transformer_keys = [k for k in keys if k.startswith(cls.transformer_name)]
-    state_dict = {
-        k.replace(f"{cls.transformer_name}.", ""): v
-        for k, v in state_dict.items()
-        if k in transformer_keys
-    }
+    lora_config = LoraConfig(**lora_config_kwargs)
+
+    # adapter_name
+    if adapter_name is None:
+        adapter_name = get_adapter_name(transformer)
+
+    # In case the pipeline has been already offloaded to CPU - temporarily remove the hooks
+    # otherwise loading LoRA weights will lead to an error
+    is_model_cpu_offload, is_sequential_cpu_offload = (
+        cls._optionally_disable_offloading(_pipeline)
+    )
+
+    inject_adapter_in_model(
+        lora_config, transformer, adapter_name=adapter_name, low_cpu_mem_usage=True
+    )
+    incompatible_keys = set_peft_model_state_dict(
+        transformer, state_dict, adapter_name, low_cpu_mem_usage=True
+    )
+
+    if incompatible_keys is not None:
+        # check only for unexpected keys
+        unexpected_keys = getattr(incompatible_keys, "unexpected_keys", None)
+        if unexpected_keys:
+            logger.warning(
+                f"Loading adapter weights from state_dict led to unexpected keys not found in the model: "
+                f" {unexpected_keys}. "
+            )
+
+    # Offload back.
+    if is_model_cpu_offload:
+        _pipeline.enable_model_cpu_offload()
+    elif is_sequential_cpu_offload:
+        _pipeline.enable_sequential_cpu_offload()
+    # Unsafe code />
 
-    if len(state_dict.keys()) > 0:
-        # check with first key if is not in peft format
-        first_key = next(iter(state_dict.keys()))
-        if "lora_A" not in first_key:
-            state_dict = convert_unet_state_dict_to_peft(state_dict)
 
-        if adapter_name in getattr(transformer, "peft_config", {}):
+def transformer_lora_config_kwargs(state_dict, network_alphas):
+    """
+    The `LoraConfig` kwargs for a PEFT state dict from
+    `transformer_peft_state_dict`, inferred from its ranks and alphas.
+    """
+    rank = {}
+    for key, val in state_dict.items():
+        if "lora_B" in key:
+            rank[key] = val.shape[1]
+
+    lora_config_kwargs = get_peft_kwargs(
+        rank, network_alpha_dict=network_alphas, peft_state_dict=state_dict
+    )
+    if "use_dora" in lora_config_kwargs:
+        if lora_config_kwargs["use_dora"] and is_peft_version("<", "0.9.0"):
             raise ValueError(
-                f"Adapter name {adapter_name} already in use in the transformer - please select a new adapter name."
+                "You need `peft` 0.9.0 at least to use DoRA-enabled LoRAs. Please upgrade your installation of `peft`."
             )
+        else:
+            lora_config_kwargs.pop("use_dora")
+    return lora_config_kwargs
 
-        rank = {}
-        for key, val in state_dict.items():
-            if "lora_B" in key:
-                rank[key] = val.shape[1]
-
-        if network_alphas is not None and len(network_alphas) >= 1:
-            prefix = cls.transformer_name
-            alpha_keys = [
-                k
-                for k in network_alphas.keys()
-                if k.startswith(prefix) and k.split(".")[0] == prefix
-            ]
-            network_alphas = {
-                k.replace(f"{prefix}.", ""): v
-                for k, v in network_alphas.items()
-                if k in alpha_keys
-            }
-
-        lora_config_kwargs = get_peft_kwargs(
-            rank, network_alpha_dict=network_alphas, peft_state_dict=state_dict
-        )
-        if "use_dora" in lora_config_kwargs:
-            if lora_config_kwargs["use_dora"] and is_peft_version("<", "0.9.0"):
-                raise ValueError(
-                    "You need `peft` 0.9.0 at least to use DoRA-enabled LoRAs. Please upgrade your installation of `peft`."
-                )
-            else:
-                lora_config_kwargs.pop("use_dora")
-        lora_config = LoraConfig(**lora_config_kwargs)
-
-        # adapter_name
-        if adapter_name is None:
-            adapter_name = get_adapter_name(transformer)
-
-        # In case the pipeline has been already offloaded to CPU - temporarily remove the hooks
-        # otherwise loading LoRA weights will lead to an error
-        is_model_cpu_offload, is_sequential_cpu_offload = (
-            cls._optionally_disable_offloading(_pipeline)
-        )
 
-        inject_adapter_in_model(
-            lora_config, transformer, adapter_name=adapter_name, low_cpu_mem_usage=True
-        )
-        incompatible_keys = set_peft_model_state_dict(
-            transformer, state_dict, adapter_name, low_cpu_mem_usage=True
-        )
+def transformer_peft_state_dict(state_dict, network_alphas, prefix="transformer"):
+    """
+    Select the transformer's LoRA layers from a state dict returned by
+    `lora_state_dict`, with `prefix` removed from their keys and in PEFT
+    format. Returns the state dict and the matching network alphas.
+    """
+    state_dict = {
+        k.replace(f"{prefix}.", ""): v
+        for k, v in state_dict.items()
+        if k.startswith(prefix)
+    }
 
-        if incompatible_keys is not None:
-            # check only for unexpected keys
-            unexpected_keys = getattr(incompatible_keys, "unexpected_keys", None)
-            if unexpected_keys:
-                logger.warning(
-                    f"Loading adapter weights from state_dict led to unexpected keys not found in the model: "
-                    f" {unexpected_keys}. "
-                )
-
-        # Offload back.
-        if is_model_cpu_offload:
-            _pipeline.enable_model_cpu_offload()
-        elif is_sequential_cpu_offload:
-            _pipeline.enable_sequential_cpu_offload()
-        # Unsafe code />
+    # check with first key if is not in peft format
+    if state_dict and "lora_A" not in next(iter(state_dict.keys())):
+        state_dict = convert_unet_state_dict_to_peft(state_dict)
+
+    if network_alphas is not None and len(network_alphas) >= 1:
+        alpha_keys = [
+            k
+            for k in network_alphas.keys()
+            if k.startswith(prefix) and k.split(".")[0] == prefix
+        ]
+        network_alphas = {
+            k.replace(f"{prefix}.", ""): v
+            for k, v in network_alphas.items()
+            if k in alpha_keys
+        }
+
+    return state_dict, network_alphas
@@ -0,0 +1,96 @@
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import torch
+from safetensors.torch import load_file
+
+
+class LoRAMemoryCache:
+    """
+    In-memory tier above WeightsDownloadCache holding recently used LoRA
+    state dicts, so switching back to an adapter doesn't re-read and re-parse
+    its safetensors file. Entries are keyed by the name of the cached file
+    (the same URL hash the disk cache uses) and evicted least recently used
+    first once `max_bytes` is exceeded. When CUDA is available the tensors
+    are kept in pinned memory to speed up the copy to the GPU.
+    """
+
+    def __init__(self, max_bytes: int = 8 * (2**30)):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.total_bytes = 0
+
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, tuple[dict[str, torch.Tensor], int]] = (
+            OrderedDict()
+        )
+
+    def load(self, path: Path) -> dict[str, torch.Tensor]:
+        """Return the state dict stored in the safetensors file at `path`.
+
+        The returned dict is a fresh copy, so callers may add or remove keys,
+        but the tensors are shared and must not be modified in place.
+        """
+        key = path.name
+        with self._lock:
+            if key in self._entries:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return dict(self._entries[key][0])
+            self.misses += 1
+
+        state_dict, size = self._read(path)
+        with self._lock:
+            self._insert(key, state_dict, size)
+        return dict(state_dict)
+
+    def put(self, path: Path, state_dict: dict[str, torch.Tensor]) -> None:
+        """Cache `state_dict` as the contents of `path`, e.g. right after writing it."""
+        state_dict, size = self._pin(state_dict)
+        with self._lock:
+            self._insert(path.name, state_dict, size)
+
+    def warm(self, path: Path) -> bool:
+        """Load `path` ahead of time, but only if it fits without evicting anything.
+
+        Returns whether the state dict is now in memory.
+        """
+        key = path.name
+        with self._lock:
+            if key in self._entries:
+                return True
+            # The file size is a close upper bound of the tensor bytes
+            if self.total_bytes + path.stat().st_size > self.max_bytes:
+                return False
+
+        state_dict, size = self._read(path)
+        with self._lock:
+            if self.total_bytes + size > self.max_bytes:
+                return key in self._entries
+            self._insert(key, state_dict, size)
+        return True
+
+    def _read(self, path: Path) -> tuple[dict[str, torch.Tensor], int]:
+        return self._pin(load_file(path))
+
+    def _pin(
+        self, state_dict: dict[str, torch.Tensor]
+    ) -> tuple[dict[str, torch.Tensor], int]:
+        if torch.cuda.is_available():
+            state_dict = {k: v.pin_memory() for k, v in state_dict.items()}
+        size = sum(v.numel() * v.element_size() for v in state_dict.values())
+        return state_dict, size
+
+    def _insert(self, key: str, state_dict: dict[str, torch.Tensor], size: int) -> None:
+        if size > self.max_bytes or key in self._entries:
+            return
+        self._entries[key] = (state_dict, size)
+        self.total_bytes += size
+        while self.total_bytes > self.max_bytes:
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self.total_bytes -= evicted_size
+
+    def cache_info(self) -> str:
+        return f"CacheInfo(hits={self.hits}, misses={self.misses}, currsize={len(self._entries)}, bytes={self.total_bytes})"
@@ -0,0 +1,163 @@
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+from typing import Callable
+
+import torch
+from safetensors.torch import save_file
+
+from lora_slots import scaled_lora_weights
+
+MERGED_LORAS_DIR_NAME = ".merged-loras"
+# URL-like key under which a merged adapter is loaded, followed by its file name
+MERGED_URL_PREFIX = "merged:"
+MERGE_METHODS = ("concat", "svd")
+
+
+def merge_loras(
+    loras: list[tuple[dict, dict | None, float]],
+    method: str = "concat",
+    rank: int | None = None,
+) -> dict[str, torch.Tensor]:
+    """Combine LoRAs into a single adapter with the same effect.
+
+    `loras` holds a PEFT state dict, its network alphas and a scale for
+    each LoRA. The result is a PEFT state dict in float32 with all scaling
+    folded into B and the same rank on every module, so it can be loaded
+    without any alphas.
+
+    "concat" stacks the LoRAs' ranks, which is exact. "svd" re-factorizes
+    each module's combined update to `rank`, which is smaller but lossy.
+    """
+    if method not in MERGE_METHODS:
+        raise ValueError(f"Unknown LoRA merge method: {method}")
+    if method == "svd" and not rank:
+        raise ValueError("Merging with svd needs a target rank")
+
+    # Module -> the (A, B) pairs of every LoRA that targets it
+    factors: dict[str, list[tuple[torch.Tensor, torch.Tensor]]] = {}
+    for state_dict, network_alphas, scale in loras:
+        weights = scaled_lora_weights(state_dict, network_alphas)
+        for module, (lora_a, lora_b) in weights.items():
+            factors.setdefault(module, []).append(
+                (lora_a.float(), lora_b.float() * scale)
+            )
+
+    merged = {}
+    for module, pairs in factors.items():
+        lora_a = torch.cat([a for a, _ in pairs], dim=0)
+        lora_b = torch.cat([b for _, b in pairs], dim=1)
+        if method == "svd":
+            lora_a, lora_b = _refactorize(lora_a, lora_b, rank)  # pyright: ignore
+        merged[module] = (lora_a, lora_b)
+
+    # Zero-pad to a common rank, as loaders derive a single alpha from it
+    max_rank = max((a.shape[0] for a, _ in merged.values()), default=0)
+    state_dict = {}
+    for module, (lora_a, lora_b) in merged.items():
+        pad = max_rank - lora_a.shape[0]
+        state_dict[f"{module}.lora_A.weight"] = torch.nn.functional.pad(
+            lora_a, (0, 0, 0, pad)
+        ).contiguous()
+        state_dict[f"{module}.lora_B.weight"] = torch.nn.functional.pad(
+            lora_b, (0, pad)
+        ).contiguous()
+    return state_dict
+
+
+def _refactorize(
+    lora_a: torch.Tensor, lora_b: torch.Tensor, rank: int
+) -> tuple[torch.Tensor, torch.Tensor]:
+    """Best rank `rank` approximation of B @ A, without forming the full matrix.
+
+    With B = Qb Rb and A^T = Qa Ra, B @ A = Qb (Rb Ra^T) Qa^T, so only the
+    small core Rb Ra^T needs an SVD.
+    """
+    q_b, r_b = torch.linalg.qr(lora_b)
+    q_a, r_a = torch.linalg.qr(lora_a.T)
+    u, s, vh = torch.linalg.svd(r_b @ r_a.T)
+    rank = min(rank, s.shape[0])
+    sqrt_s = s[:rank].sqrt()
+    new_b = q_b @ (u[:, :rank] * sqrt_s)
+    new_a = (sqrt_s[:, None] * vh[:rank]) @ q_a.T
+    return new_a, new_b
+
+
+class MergedLoRACache:
+    """
+    Merged adapters for combinations of LoRAs and scales, stored as
+    safetensors files so a repeated combination is merged only once. The
+    least recently used files are removed once there are more than
+    `max_entries`.
+
+    Combinations are keyed on what `resolve` maps each URL to, e.g. the
+    name of its weights cache entry, so a URL that moved to new weights is
+    merged again rather than reusing the merge of the old ones.
+    """
+
+    def __init__(
+        self,
+        base_dir: Path,
+        method: str = "concat",
+        rank: int | None = None,
+        max_entries: int = 32,
+        resolve: Callable[[str], str] | None = None,
+    ):
+        if method not in MERGE_METHODS:
+            raise ValueError(f"Unknown LoRA merge method: {method}")
+        self.base_dir = base_dir
+        self.method = method
+        self.rank = rank
+        self.max_entries = max_entries
+        self.resolve = resolve
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        base_dir.mkdir(parents=True, exist_ok=True)
+
+    def ensure(
+        self,
+        loras: list[tuple[str, float]],
+        load_peft_state_dict: Callable[[str], tuple[dict, dict | None]],
+    ) -> Path:
+        """Return the merged adapter for the (url, scale) LoRAs, merging them if needed."""
+        resolved = [
+            (self.resolve(url) if self.resolve is not None else url, scale)
+            for url, scale in loras
+        ]
+        key = json.dumps([resolved, self.method, self.rank])
+        digest = hashlib.sha256(key.encode()).hexdigest()[:16]
+        path = self.base_dir / f"{digest}.safetensors"
+
+        with self._lock:
+            if path.exists():
+                self.hits += 1
+                path.touch()  # Mark as most recently used
+                return path
+            self.misses += 1
+
+            merged = merge_loras(
+                [(*load_peft_state_dict(url), scale) for url, scale in loras],
+                method=self.method,
+                rank=self.rank,
+            )
+            # Saved in the format `lora_state_dict` expects for the transformer
+            merged = {f"transformer.{k}": v for k, v in merged.items()}
+            tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+            save_file(merged, tmp_path)
+            tmp_path.replace(path)
+
+            entries = sorted(
+                self.base_dir.glob("*.safetensors"), key=lambda p: p.stat().st_mtime
+            )
+            for stale in entries[: max(0, len(entries) - self.max_entries)]:
+                stale.unlink(missing_ok=True)
+            return path
+
+    def path(self, name: str) -> Path:
+        return self.base_dir / name
+
+    def cache_info(self) -> str:
+        return f"CacheInfo(hits={self.hits}, misses={self.misses}, method={self.method}, rank={self.rank})"
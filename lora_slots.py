@@ -0,0 +1,268 @@
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable
+
+import torch
+
+# Slot buffers are sized for LoRAs up to this rank
+DEFAULT_MAX_RANK = 64
+
+
+class LoRASlots:
+    """
+    Fixed-rank LoRA layers injected into a transformer once, at setup, as an
+    alternative to AdapterPool. Each slot is a PEFT adapter of rank
+    `max_rank` on every targeted linear layer. Loading a LoRA copies its
+    weights into a slot in place: A and B are zero-padded to `max_rank`,
+    the alpha / rank scaling is folded into B, and layers the LoRA doesn't
+    touch are zeroed. The module structure never changes between requests,
+    so switching LoRAs costs a memcpy and shapes stay static for compiled
+    graphs.
+
+    `load_state_dict` returns a URL's transformer LoRA weights in PEFT
+    format along with their network alphas, see
+    `lora_loading_patch.transformer_peft_state_dict`.
+
+    `stage` loads a LoRA that is likely to be needed next onto the device
+    in the background, on a side CUDA stream when there is one, so that a
+    later `activate` only has to copy it into a slot on the device.
+
+    `resolve`, if given, maps a URL to the weights it currently points at,
+    like it does for AdapterPool, so a URL that moved to new weights is
+    copied in again instead of reusing the slot holding the old ones.
+    """
+
+    def __init__(
+        self,
+        transformer: torch.nn.Module,
+        load_state_dict: Callable[[str], tuple[dict, dict | None]],
+        num_slots: int = 2,
+        max_rank: int = DEFAULT_MAX_RANK,
+        target_modules: list[str] | None = None,
+        resolve: Callable[[str], str] | None = None,
+    ):
+        from peft import LoraConfig, inject_adapter_in_model
+
+        self.transformer = transformer
+        self.load_state_dict = load_state_dict
+        self.resolve = resolve
+        self.max_rank = max_rank
+        self.hits = 0
+        self.misses = 0
+        self.staged_hits = 0
+
+        self._lock = threading.Lock()
+        self._stager = ThreadPoolExecutor(max_workers=1, thread_name_prefix="stage")
+        # The staged LoRA by URL, at most one
+        self._staged: dict[str, Future] = {}
+        self.slot_names = [f"slot_{i}" for i in range(num_slots)]
+        # URL and resolved key of the LoRA held by each slot, or None
+        self._slot_urls: list[str | None] = [None] * num_slots
+        self._slot_keys: list[str | None] = [None] * num_slots
+        # Slot order from least to most recently used
+        self._slot_lru = list(range(num_slots))
+
+        if target_modules is None:
+            target_modules = targetable_modules(transformer)
+        config = LoraConfig(
+            r=max_rank, lora_alpha=max_rank, target_modules=target_modules
+        )
+        for name in self.slot_names:
+            inject_adapter_in_model(config, transformer, adapter_name=name)
+        # Module name -> LoRA layer, keyed like the PEFT state dicts
+        self._layers = {
+            name: module
+            for name, module in transformer.named_modules()
+            if hasattr(module, "lora_A") and self.slot_names[0] in module.lora_A
+        }
+        for slot in range(num_slots):
+            self._clear(slot)
+        self.deactivate()
+
+    def activate(self, loras: list[tuple[str, float]]) -> list[str]:
+        """Make exactly the given (url, scale) LoRAs active.
+
+        LoRAs that aren't in a slot yet are copied into the least recently
+        used one. Returns the names of the active slots.
+        """
+        scales: dict[str, float] = {}
+        urls: dict[str, str] = {}
+        for url, scale in loras:
+            key = self._key(url)
+            urls[key] = url
+            scales[key] = scales.get(key, 0.0) + scale
+        if len(scales) > len(self.slot_names):
+            raise ValueError(
+                f"Can't use {len(scales)} LoRAs at once with {len(self.slot_names)} slots"
+            )
+
+        with self._lock:
+            slots = [self._ensure(key, urls[key], keep=set(scales)) for key in scales]
+            names = [self.slot_names[slot] for slot in slots]
+            for layer in self._layers.values():
+                layer.set_adapter(names)
+                for name, scale in zip(names, scales.values()):
+                    layer.set_scale(name, scale)
+                layer.enable_adapters(True)
+            return names
+
+    def stage(self, url: str) -> None:
+        """Start loading `url` onto the device for a later `activate`.
+
+        Replaces the LoRA staged before, if any. Does nothing if `url` is
+        already in a slot or staged. The URL is resolved in the background
+        too, so this never waits for a download.
+        """
+        with self._lock:
+            if url in self._slot_urls or url in self._staged:
+                return
+            self._staged = {url: self._stager.submit(self._stage, url)}
+
+    def deactivate(self) -> None:
+        with self._lock:
+            for layer in self._layers.values():
+                layer.enable_adapters(False)
+
+    def cache_info(self) -> str:
+        return f"CacheInfo(hits={self.hits}, misses={self.misses}, staged_hits={self.staged_hits}, slots={self._slot_urls}, max_rank={self.max_rank})"
+
+    def _key(self, url: str) -> str:
+        return self.resolve(url) if self.resolve is not None else url
+
+    def _ensure(self, key: str, url: str, keep: set[str]) -> int:
+        if key in self._slot_keys:
+            slot = self._slot_keys.index(key)
+            self.hits += 1
+        else:
+            self.misses += 1
+            slot = next(s for s in self._slot_lru if self._slot_keys[s] not in keep)
+            # Cleared first, so a failed copy doesn't leave a mix of two LoRAs
+            self._slot_urls[slot] = self._slot_keys[slot] = None
+            self._clear(slot)
+            weights = self._take_staged(key, url)
+            if weights is None:
+                weights = scaled_lora_weights(*self.load_state_dict(url))
+            self._copy_in(slot, weights)
+            self._slot_urls[slot] = url
+            self._slot_keys[slot] = key
+        self._slot_lru.remove(slot)
+        self._slot_lru.append(slot)
+        return slot
+
+    @torch.no_grad()
+    def _clear(self, slot: int) -> None:
+        name = self.slot_names[slot]
+        for layer in self._layers.values():
+            layer.lora_A[name].weight.zero_()
+            layer.lora_B[name].weight.zero_()
+
+    @torch.no_grad()
+    def _stage(self, url: str) -> tuple[str, dict, torch.cuda.Event | None] | None:
+        key = self._key(url)
+        if key in self._slot_keys:
+            return None
+        state_dict, network_alphas = self.load_state_dict(url)
+        layer = next(iter(self._layers.values()))
+        device = layer.lora_A[self.slot_names[0]].weight.device
+        # On the CPU this runs synchronously, in the staging thread
+        stream = torch.cuda.Stream(device) if device.type == "cuda" else None
+        with torch.cuda.stream(stream):
+            # Copied from pinned memory as is, and scaled on the device
+            state_dict = {
+                k: v.to(device, non_blocking=True) for k, v in state_dict.items()
+            }
+            weights = scaled_lora_weights(state_dict, network_alphas)
+            event = stream.record_event() if stream is not None else None
+        return key, weights, event
+
+    def _take_staged(self, key: str, url: str) -> dict | None:
+        """The staged weights of `url` once they are on the device, or None.
+
+        Weights staged for another version of `url` than `key` are dropped.
+        """
+        future = self._staged.pop(url, None)
+        if future is None:
+            return None
+        try:
+            staged = future.result()
+        except Exception as e:
+            print(f"Failed to stage LoRA {url}, loading it again: {e}")
+            return None
+        if staged is None or staged[0] != key:
+            return None
+        _, weights, event = staged
+        if event is not None:
+            stream = torch.cuda.current_stream()
+            stream.wait_event(event)
+            # The staging stream's allocations are now used on this stream
+            for lora_a, lora_b in weights.values():
+                lora_a.record_stream(stream)
+                lora_b.record_stream(stream)
+        self.staged_hits += 1
+        return weights
+
+    @torch.no_grad()
+    def _copy_in(
+        self, slot: int, weights: dict[str, tuple[torch.Tensor, torch.Tensor]]
+    ) -> None:
+        name = self.slot_names[slot]
+        unknown = weights.keys() - self._layers.keys()
+        if unknown:
+            raise ValueError(
+                f"LoRA targets layers that have no slot: {', '.join(sorted(unknown))}"
+            )
+
+        for module, (lora_a, lora_b) in weights.items():
+            rank = lora_a.shape[0]
+            if rank > self.max_rank:
+                raise ValueError(
+                    f"LoRA rank {rank} is above the slot rank of {self.max_rank}"
+                )
+            # The slot's own scaling is max_rank / max_rank = 1, as the
+            # LoRA's scaling is already folded into B
+            layer = self._layers[module]
+            layer.lora_A[name].weight[:rank].copy_(lora_a)
+            layer.lora_B[name].weight[:, :rank].copy_(lora_b)
+
+
+def targetable_modules(transformer: torch.nn.Module) -> list[str]:
+    """Names of the linear layers in the transformer blocks, which LoRAs target."""
+    return [
+        name
+        for name, module in transformer.named_modules()
+        if isinstance(module, torch.nn.Linear)
+        and name.startswith(("transformer_blocks.", "single_transformer_blocks."))
+    ]
+
+
+def scaled_lora_weights(
+    state_dict: dict, network_alphas: dict | None
+) -> dict[str, tuple[torch.Tensor, torch.Tensor]]:
+    """Split a PEFT LoRA state dict into (A, B) per module, folding alpha / rank into B.
+
+    Raises ValueError for anything but plain A and B weight matrices, e.g.
+    DoRA magnitudes or LoRA biases.
+    """
+    unsupported = [
+        k for k in state_dict if not k.endswith((".lora_A.weight", ".lora_B.weight"))
+    ]
+    if unsupported:
+        raise ValueError(f"Only plain LoRA weights are supported, got {unsupported[0]}")
+
+    alphas = {_alpha_module_name(k): v for k, v in (network_alphas or {}).items()}
+    weights = {}
+    for key, lora_a in state_dict.items():
+        if not key.endswith(".lora_A.weight"):
+            continue
+        module = key[: -len(".lora_A.weight")]
+        lora_b = state_dict[f"{module}.lora_B.weight"]
+        rank = lora_a.shape[0]
+        weights[module] = (lora_a, lora_b * (alphas.get(module, rank) / rank))
+    return weights
+
+
+def _alpha_module_name(key: str) -> str:
+    """Module an entry of `network_alphas` applies to, e.g. `x` for `x.lora.down.weight`."""
+    if ".down." in key:
+        return ".".join(key.split(".down.")[0].split(".")[:-1])
+    return key[: -len(".alpha")] if key.endswith(".alpha") else key
@@ -1,8 +1,17 @@
+import asyncio
+import copy
 import os
+import random
+import shutil
 import subprocess
+import tempfile
+import threading
 import time
-from dataclasses import dataclass
-from typing import List, cast
+from collections import deque
+from collections.abc import Hashable
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, replace
+from typing import Callable, List, cast
 
 import numpy as np
 import torch
@@ -20,11 +29,36 @@ from diffusers.pipelines.stable_diffusion.safety_checker import (
 from transformers import (
     CLIPImageProcessor,
     AutoModelForImageClassification,
+    T5TokenizerFast,
     ViTImageProcessor,
 )
 
+from startup import StartupGraph
 from weights import WeightsDownloadCache
-from lora_loading_patch import load_lora_into_transformer
+from adapter_pool import DEFAULT_ADAPTER_POOL_BYTES, AdapterPool
+from lora_conversion import ConvertedLoRA, ConvertedLoRACache
+from lora_inspect import LoRAInfo, inspect_lora
+from lora_loading_patch import (
+    load_lora_into_transformer,
+    transformer_lora_config_kwargs,
+    transformer_peft_state_dict,
+)
+from lora_batching import BatchedLoRAs, check_batchable
+from lora_fusion import LoRAFuser
+from lora_merge import MERGED_LORAS_DIR_NAME, MERGED_URL_PREFIX, MergedLoRACache
+from lora_slots import DEFAULT_MAX_RANK, LoRASlots, targetable_modules
+from lora_memory_cache import LoRAMemoryCache
+from sequence_buckets import (
+    DEFAULT_SEQUENCE_BUCKETS,
+    SequenceBucketStats,
+    bucket_length,
+    image_psnr,
+    parse_buckets,
+)
+from prompt_cache import DEFAULT_PROMPT_CACHE_BYTES, PromptEmbeddingCache
+from scheduler import MicroBatchScheduler
+from output_encoding import DEFAULT_ENCODE_PRESET, ImageEncoder
+from prefetch import ACCESS_HISTORY_NAME, AccessHistory, Prefetcher, read_warm_list
 
 MODEL_URL_DEV = (
     "https://weights.replicate.delivery/default/black-forest-labs/FLUX.1-dev/files.tar"
@@ -42,6 +76,63 @@ FALCON_MODEL_URL = (
     "https://weights.replicate.delivery/default/falconai/nsfw-image-detection.tar"
 )
 
+# Output directories kept before the oldest is removed. Well above the
+# concurrency in cog.yaml, so a request's outputs outlive their upload.
+KEPT_OUTPUT_DIRS = 16
+
+# Components built during setup. The rest are built on first use, see setup().
+DEFAULT_EAGER_COMPONENTS = "safety_checker,feature_extractor,dev"
+LAZY_COMPONENTS = [
+    "falcon",
+    "falcon_processor",
+    "schnell",
+    "dev_img2img",
+    "schnell_img2img",
+    "dev_inpaint",
+    "schnell_inpaint",
+]
+
+
+@dataclass
+class Generation:
+    """One request's share of a batched pipeline call, see `run_generations`."""
+
+    pipe_name: str
+    model: str
+    prompt: str
+    num_outputs: int
+    seed: int
+    guidance_scale: float
+    num_inference_steps: int
+    max_sequence_length: int
+    # (url, scale) of the LoRAs to activate, after merging
+    loras: list[tuple[str, float]]
+    flux_kwargs: dict
+
+    @property
+    def joint_scale(self) -> float | None:
+        return self.flux_kwargs.get("joint_attention_kwargs", {}).get("scale")
+
+    def batch_key(self, share_loras: bool = False) -> Hashable:
+        """Generations with equal keys can share a pipeline call.
+
+        With `share_loras`, generations with different LoRAs can share one
+        too, for when each image gets its own LoRA.
+        """
+        if "image" in self.flux_kwargs:
+            # Each request has its own input image, so these run alone
+            return id(self)
+        return (
+            self.pipe_name,
+            None if share_loras else (tuple(self.loras), self.joint_scale),
+            self.flux_kwargs["width"],
+            self.flux_kwargs["height"],
+            self.num_inference_steps,
+            self.guidance_scale,
+            self.max_sequence_length,
+        )
+
+
 ASPECT_RATIOS = {
     "1:1": (1024, 1024),
     "16:9": (1344, 768),
@@ -61,12 +152,6 @@ logging.getLogger("diffusers").setLevel(logging.CRITICAL)
 logging.getLogger("transformers").setLevel(logging.CRITICAL)
 
 
-@dataclass
-class LoadedLoRAs:
-    main: str | None
-    extra: str | None
-
-
 class Predictor(BasePredictor):
     def setup(self) -> None:  # pyright: ignore
         """Load the model into memory to make running multiple predictions efficient"""
@@ -74,126 +159,245 @@ class Predictor(BasePredictor):
         # Don't pull weights
         os.environ["TRANSFORMERS_OFFLINE"] = "1"
 
-        self.weights_cache = WeightsDownloadCache()
-
-        print("Loading safety checker...")
-        if not SAFETY_CACHE_PATH.exists():
-            download_base_weights(SAFETY_URL, SAFETY_CACHE_PATH)
-        self.safety_checker = StableDiffusionSafetyChecker.from_pretrained(
-            SAFETY_CACHE_PATH, torch_dtype=torch.float16
-        ).to("cuda")  # pyright: ignore
-        self.feature_extractor = cast(
-            "CLIPImageProcessor", CLIPImageProcessor.from_pretrained(FEATURE_EXTRACTOR)
-        )
-
-        print("Loading Falcon safety checker...")
-        if not Path(FALCON_MODEL_CACHE).exists():
-            download_base_weights(FALCON_MODEL_URL, FALCON_MODEL_CACHE)
-        self.falcon_model = AutoModelForImageClassification.from_pretrained(
-            FALCON_MODEL_NAME,
-            cache_dir=FALCON_MODEL_CACHE,
-        )
-        self.falcon_processor = ViTImageProcessor.from_pretrained(FALCON_MODEL_NAME)
-
-        print("Loading Flux dev pipeline")
-        if not FLUX_DEV_PATH.exists():
-            download_base_weights(MODEL_URL_DEV, Path("."))
-        dev_pipe = FluxPipeline.from_pretrained(
-            "FLUX.1-dev",
-            torch_dtype=torch.bfloat16,
-        ).to("cuda")
-        dev_pipe.__class__.load_lora_into_transformer = classmethod(
-            load_lora_into_transformer
-        )
-
-        print("Loading Flux schnell pipeline")
-        if not FLUX_SCHNELL_PATH.exists():
-            download_base_weights(MODEL_URL_SCHNELL, FLUX_SCHNELL_PATH)
-        schnell_pipe = FluxPipeline.from_pretrained(
-            "FLUX.1-schnell",
-            vae=dev_pipe.vae,
-            text_encoder=dev_pipe.text_encoder,
-            text_encoder_2=dev_pipe.text_encoder_2,
-            tokenizer=dev_pipe.tokenizer,
-            tokenizer_2=dev_pipe.tokenizer_2,
-            torch_dtype=torch.bfloat16,
-        ).to("cuda")
-
-        self.pipes = {
-            "dev": dev_pipe,
-            "schnell": schnell_pipe,
-        }
-
-        # Load img2img pipelines
-        print("Loading Flux dev img2img pipeline")
-        dev_img2img_pipe = FluxImg2ImgPipeline(
-            transformer=dev_pipe.transformer,
-            scheduler=dev_pipe.scheduler,
-            vae=dev_pipe.vae,
-            text_encoder=dev_pipe.text_encoder,
-            text_encoder_2=dev_pipe.text_encoder_2,
-            tokenizer=dev_pipe.tokenizer,
-            tokenizer_2=dev_pipe.tokenizer_2,
-        ).to("cuda")
-        dev_img2img_pipe.__class__.load_lora_into_transformer = classmethod(
-            load_lora_into_transformer
-        )
-
-        print("Loading Flux schnell img2img pipeline")
-        schnell_img2img_pipe = FluxImg2ImgPipeline(
-            transformer=schnell_pipe.transformer,
-            scheduler=schnell_pipe.scheduler,
-            vae=schnell_pipe.vae,
-            text_encoder=schnell_pipe.text_encoder,
-            text_encoder_2=schnell_pipe.text_encoder_2,
-            tokenizer=schnell_pipe.tokenizer,
-            tokenizer_2=schnell_pipe.tokenizer_2,
-        ).to("cuda")
-
-        self.img2img_pipes = {
-            "dev": dev_img2img_pipe,
-            "schnell": schnell_img2img_pipe,
-        }
-
-        # Load inpainting pipelines
-        print("Loading Flux dev inpaint pipeline")
-        dev_inpaint_pipe = FluxInpaintPipeline(
-            transformer=dev_pipe.transformer,
-            scheduler=dev_pipe.scheduler,
-            vae=dev_pipe.vae,
-            text_encoder=dev_pipe.text_encoder,
-            text_encoder_2=dev_pipe.text_encoder_2,
-            tokenizer=dev_pipe.tokenizer,
-            tokenizer_2=dev_pipe.tokenizer_2,
-        ).to("cuda")
-        dev_inpaint_pipe.__class__.load_lora_into_transformer = classmethod(
-            load_lora_into_transformer
-        )
-
-        print("Loading Flux schnell inpaint pipeline")
-        schnell_inpaint_pipe = FluxInpaintPipeline(
-            transformer=schnell_pipe.transformer,
-            scheduler=schnell_pipe.scheduler,
-            vae=schnell_pipe.vae,
-            text_encoder=schnell_pipe.text_encoder,
-            text_encoder_2=schnell_pipe.text_encoder_2,
-            tokenizer=schnell_pipe.tokenizer,
-            tokenizer_2=schnell_pipe.tokenizer_2,
-        ).to("cuda")
-
-        self.inpaint_pipes = {
-            "dev": dev_inpaint_pipe,
-            "schnell": schnell_inpaint_pipe,
-        }
-
-        self.loaded_lora_urls = {
-            "dev": LoadedLoRAs(main=None, extra=None),
-            "schnell": LoadedLoRAs(main=None, extra=None),
-        }
+        # Set when several predictor processes share the weights cache, e.g. one per GPU
+        self.weights_cache = WeightsDownloadCache(
+            shared=os.environ.get("WEIGHTS_CACHE_SHARED") == "1"
+        )
+        self.lora_memory_cache = LoRAMemoryCache(
+            max_bytes=int(os.environ.get("LORA_MEMORY_CACHE_BYTES", 8 * (2**30)))
+        )
+        self.converted_loras = ConvertedLoRACache(self.lora_memory_cache, convert_lora)
+        self.prefetcher = Prefetcher(
+            self.weights_cache,
+            AccessHistory(self.weights_cache.base_dir / ACCESS_HISTORY_NAME),
+            # Loads read the conversions, not the raw files, so warm those
+            warm=self.converted_loras.warm,
+        )
+        # Optional file listing LoRA URLs to fetch as soon as the instance starts
+        warm_list_path = os.environ.get("LORA_WARM_LIST")
+        self.prefetcher.start(
+            read_warm_list(Path(warm_list_path)) if warm_list_path else None
+        )
+
+        for pipeline_class in [FluxPipeline, FluxImg2ImgPipeline, FluxInpaintPipeline]:
+            pipeline_class.load_lora_into_transformer = classmethod(
+                load_lora_into_transformer
+            )
+
+        graph = StartupGraph()
+        # Downloads have no dependencies, so they all start right away, and
+        # each component is loaded as soon as its own files have landed
+        graph.add(
+            "download_safety",
+            lambda: download_base_weights_once(SAFETY_URL, SAFETY_CACHE_PATH),
+        )
+        graph.add(
+            "download_falcon",
+            lambda: download_base_weights_once(
+                FALCON_MODEL_URL, Path(FALCON_MODEL_CACHE)
+            ),
+        )
+        graph.add(
+            "download_dev",
+            lambda: download_base_weights_once(
+                MODEL_URL_DEV, Path("."), check_path=FLUX_DEV_PATH
+            ),
+        )
+        graph.add(
+            "download_schnell",
+            lambda: download_base_weights_once(MODEL_URL_SCHNELL, FLUX_SCHNELL_PATH),
+        )
+
+        # Models are deserialized on the CPU in parallel, while the copies to
+        # the GPU run one at a time so they don't compete for bandwidth
+        graph.add(
+            "load_safety",
+            lambda _: StableDiffusionSafetyChecker.from_pretrained(
+                SAFETY_CACHE_PATH, torch_dtype=torch.float16
+            ),
+            deps=["download_safety"],
+        )
+        graph.add(
+            "safety_checker",
+            lambda checker: checker.to("cuda"),
+            deps=["load_safety"],
+            resource="gpu",
+        )
+        graph.add(
+            "feature_extractor",
+            lambda: CLIPImageProcessor.from_pretrained(FEATURE_EXTRACTOR),
+        )
+        graph.add(
+            "falcon",
+            lambda _: AutoModelForImageClassification.from_pretrained(
+                FALCON_MODEL_NAME,
+                cache_dir=FALCON_MODEL_CACHE,
+            ),
+            deps=["download_falcon"],
+        )
+        graph.add(
+            "falcon_processor",
+            lambda _: ViTImageProcessor.from_pretrained(FALCON_MODEL_NAME),
+            deps=["download_falcon"],
+        )
+        graph.add(
+            "load_dev",
+            lambda _: FluxPipeline.from_pretrained(
+                "FLUX.1-dev",
+                torch_dtype=torch.bfloat16,
+            ),
+            deps=["download_dev"],
+        )
+        graph.add(
+            "dev",
+            lambda pipe: pipe.to("cuda"),
+            deps=["load_dev"],
+            resource="gpu",
+        )
+        # schnell shares everything but the transformer with dev
+        graph.add(
+            "load_schnell",
+            lambda _, dev_pipe: FluxPipeline.from_pretrained(
+                "FLUX.1-schnell",
+                vae=dev_pipe.vae,
+                text_encoder=dev_pipe.text_encoder,
+                text_encoder_2=dev_pipe.text_encoder_2,
+                tokenizer=dev_pipe.tokenizer,
+                tokenizer_2=dev_pipe.tokenizer_2,
+                torch_dtype=torch.bfloat16,
+            ),
+            deps=["download_schnell", "load_dev"],
+        )
+        graph.add(
+            "schnell",
+            lambda pipe, _: pipe.to("cuda"),
+            deps=["load_schnell", "dev"],
+            resource="gpu",
+        )
+        for model in ["dev", "schnell"]:
+            # img2img and inpainting wrap the txt2img pipeline's components
+            graph.add(
+                f"{model}_img2img",
+                lambda pipe: wrap_pipeline(FluxImg2ImgPipeline, pipe),
+                deps=[model],
+            )
+            graph.add(
+                f"{model}_inpaint",
+                lambda pipe: wrap_pipeline(FluxInpaintPipeline, pipe),
+                deps=[model],
+            )
+        self.components = graph
+
+        # Most traffic is dev txt2img, so by default everything else is only
+        # loaded when a request first needs it
+        eager = os.environ.get("EAGER_COMPONENTS", DEFAULT_EAGER_COMPONENTS)
+        graph.run([name for name in eager.split(",") if name])
+        # Downloads only use disk, so get the lazy components' files in now
+        graph.warm_up(
+            [name for name in graph.step_names() if name.startswith("download_")]
+        )
+        # Set to load the lazy components in the background after the first request
+        self.warm_up_after_first_request = (
+            os.environ.get("WARM_UP_LAZY_COMPONENTS") == "1"
+        )
+        self.first_request_done = False
+
+        # Resident LoRA adapters per transformer, created with the pipeline
+        self.adapter_pools: dict[str, AdapterPool | LoRASlots] = {}
+        # Set to fuse the LoRAs into the weights after this many consecutive
+        # requests with the same LoRAs and scales, 0 to never fuse
+        self.lora_fuse_after = int(os.environ.get("LORA_FUSE_AFTER", 0))
+        self.lora_fusers: dict[str, LoRAFuser] = {}
+        # Set to batch requests with different LoRAs into one pipeline call,
+        # each image with its own LoRA. Main and extra LoRAs are then merged
+        # into one adapter, with "concat" unless LORA_MERGE says otherwise,
+        # and text encoder LoRA weights are ignored like with LORA_SLOTS.
+        self.lora_batching = os.environ.get("LORA_BATCHING") == "1"
+        self.batched_loras: dict[str, BatchedLoRAs] = {}
+        # Layers of each model's transformer a batched LoRA can target, see
+        # batchable_modules()
+        self.batchable: dict[str, list[str]] = {}
+        self.batchable_lock = threading.Lock()
+        self.lora_batch_max_rank = int(
+            os.environ.get("LORA_SLOT_MAX_RANK", DEFAULT_MAX_RANK)
+        )
+        # Set to "concat" or "svd" to run main and extra LoRAs as one merged adapter
+        merge_method = os.environ.get("LORA_MERGE") or (
+            "concat" if self.lora_batching else None
+        )
+        self.merged_loras = (
+            MergedLoRACache(
+                self.weights_cache.base_dir / MERGED_LORAS_DIR_NAME,
+                method=merge_method,
+                rank=int(os.environ.get("LORA_MERGE_RANK", 0)) or None,
+                resolve=self.resolve_lora,
+            )
+            if merge_method
+            else None
+        )
+        # Set to copy LoRAs into fixed-rank slots injected once per transformer,
+        # instead of adding and removing PEFT adapters
+        self.use_lora_slots = os.environ.get("LORA_SLOTS") == "1"
+        # Set to load the next queued request's LoRA into spare slot memory
+        # while each request runs, when using slots
+        self.lora_staging = os.environ.get("LORA_STAGING") == "1"
+        # Set to "1" for the default T5 sequence length buckets, or to a list
+        # like "64,128,256,512", to pad prompts to the smallest bucket that
+        # fits them instead of the model's full sequence length
+        buckets = os.environ.get("T5_SEQUENCE_BUCKETS", "")
+        self.sequence_buckets = None
+        if buckets == "1":
+            self.sequence_buckets = DEFAULT_SEQUENCE_BUCKETS
+        elif buckets:
+            self.sequence_buckets = parse_buckets(buckets)
+        self.sequence_bucket_stats = SequenceBucketStats()
+        # Each CPU pool thread counts tokens with its own copies of the T5
+        # tokenizers, see counting_tokenizer()
+        self.counting_tokenizers = threading.local()
+        # Fraction of bucketed requests that are also rendered at the full
+        # sequence length, to compare the images
+        self.sequence_bucket_guard_rate = float(
+            os.environ.get("T5_SEQUENCE_BUCKET_GUARD_RATE", 0)
+        )
+        # Pipeline calls go through the scheduler, which batches requests
+        # that arrive within MICRO_BATCH_WAIT_MS of each other
+        self.scheduler = MicroBatchScheduler(
+            self.run_generations,
+            max_batch_size=int(os.environ.get("MICRO_BATCH_MAX_SIZE", 4)),
+            max_wait=float(os.environ.get("MICRO_BATCH_WAIT_MS", 0)) / 1000,
+        )
+        # Shared by dev and schnell, which share their text encoders
+        self.prompt_cache = PromptEmbeddingCache(
+            max_bytes=int(
+                os.environ.get("PROMPT_CACHE_BYTES", DEFAULT_PROMPT_CACHE_BYTES)
+            )
+        )
+        # Worker pools for the stages of a request around the pipeline call,
+        # which cog runs concurrently up to the concurrency in cog.yaml
+        self.cpu_pool = ThreadPoolExecutor(
+            max_workers=int(os.environ.get("CPU_WORKERS", 4)),
+            thread_name_prefix="cpu",
+        )
+        self.io_pool = ThreadPoolExecutor(
+            max_workers=int(os.environ.get("IO_WORKERS", 4)),
+            thread_name_prefix="io",
+        )
+        # Safety checks run one at a time, so at most one batch of checker
+        # activations shares the GPU with the pipeline
+        self.safety_pool = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="safety"
+        )
+        # Set OUTPUT_ENCODE_PRESET to "fast" or "small" to trade output size
+        # for encode time, and OUTPUT_ENCODE_PROCESSES to encode in processes
+        self.image_encoder = ImageEncoder(
+            preset=os.environ.get("OUTPUT_ENCODE_PRESET", DEFAULT_ENCODE_PRESET),
+            max_workers=int(os.environ.get("OUTPUT_ENCODE_WORKERS", 0)) or None,
+            use_processes=os.environ.get("OUTPUT_ENCODE_PROCESSES") == "1",
+        )
+        self.output_dirs: deque[Path] = deque()
         print("setup took: ", time.time() - start)
 
-    @torch.inference_mode()
-    def predict(  # pyright: ignore
+    async def predict(  # pyright: ignore
         self,
         prompt: str = Input(
             description="Prompt for generated image. If you include the `trigger_word` used in the training process you are more likely to activate the trained object, style, or concept in the resulting image."
@@ -305,60 +509,6 @@ class Predictor(BasePredictor):
             height = make_multiple_of_16(height)
         else:
             width, height = self.aspect_ratio_to_width_height(aspect_ratio)
-        max_sequence_length = 512
-
-        is_img2img_mode = image is not None and mask is None
-        is_inpaint_mode = image is not None and mask is not None
-
-        flux_kwargs = {}
-        print(f"Prompt: {prompt}")
-
-        if is_img2img_mode or is_inpaint_mode:
-            input_image = Image.open(image).convert("RGB")
-            original_width, original_height = input_image.size
-
-            # Calculate dimensions that are multiples of 16
-            target_width = make_multiple_of_16(original_width)
-            target_height = make_multiple_of_16(original_height)
-            target_size = (target_width, target_height)
-
-            print(
-                f"[!] Resizing input image from {original_width}x{original_height} to {target_width}x{target_height}"
-            )
-
-            # Determine if we should use highest quality settings
-            use_highest_quality = output_quality == 100 or output_format == "png"
-
-            # Resize the input image
-            resampling_method = Image.LANCZOS if use_highest_quality else Image.BICUBIC
-            input_image = input_image.resize(target_size, resampling_method)
-            flux_kwargs["image"] = input_image
-
-            # Set width and height to match the resized input image
-            flux_kwargs["width"], flux_kwargs["height"] = target_size
-
-            if is_img2img_mode:
-                print("[!] img2img mode")
-                pipe = self.img2img_pipes[model]
-            else:  # is_inpaint_mode
-                print("[!] inpaint mode")
-                mask_image = Image.open(mask).convert("RGB")
-                mask_image = mask_image.resize(target_size, Image.NEAREST)
-                flux_kwargs["mask_image"] = mask_image
-                pipe = self.inpaint_pipes[model]
-
-            flux_kwargs["strength"] = prompt_strength
-            print(
-                f"[!] Using {model} model for {'img2img' if is_img2img_mode else 'inpainting'}"
-            )
-        else:  # is_txt2img_mode
-            print("[!] txt2img mode")
-            pipe = self.pipes[model]
-            flux_kwargs["width"] = width
-            flux_kwargs["height"] = height
-
-        if replicate_weights:
-            flux_kwargs["joint_attention_kwargs"] = {"scale": lora_scale}
 
         assert model in ["dev", "schnell"]
         if model == "dev":
@@ -368,113 +518,549 @@ class Predictor(BasePredictor):
             print("Using schnell model")
             max_sequence_length = 256
             guidance_scale = 0
+        full_sequence_length = max_sequence_length
+        print(f"Prompt: {prompt}")
 
-        if replicate_weights:
-            start_time = time.time()
-            if extra_lora:
-                flux_kwargs["joint_attention_kwargs"] = {"scale": 1.0}
-                print(f"Loading extra LoRA weights from: {extra_lora}")
-                self.load_multiple_loras(replicate_weights, extra_lora, model)
-                pipe.set_adapters(
-                    ["main", "extra"], adapter_weights=[lora_scale, extra_lora_scale]
-                )
-            else:
-                flux_kwargs["joint_attention_kwargs"] = {"scale": lora_scale}
-                self.load_single_lora(replicate_weights, model)
-                pipe.set_adapters(["main"], adapter_weights=[lora_scale])
-            print(f"Loaded LoRAs in {time.time() - start_time:.2f}s")
+        # Everything but the pipeline call runs on the worker pools, so the
+        # CPU and IO work of queued requests overlaps with the GPU work of
+        # the running one
+        if image is not None:
+            use_highest_quality = output_quality == 100 or output_format == "png"
+            flux_kwargs = await run_in_pool(
+                self.cpu_pool,
+                load_input_images,
+                image,
+                mask,
+                prompt_strength,
+                use_highest_quality,
+            )
+            pipe_name = f"{model}_img2img" if mask is None else f"{model}_inpaint"
+            print(f"[!] Using {model} model for {pipe_name.split('_')[1]}")
         else:
-            pipe.unload_lora_weights()
-            self.loaded_lora_urls[model] = LoadedLoRAs(main=None, extra=None)
+            print("[!] txt2img mode")
+            flux_kwargs = {"width": width, "height": height}
+            pipe_name = model
+
+        pipe = await run_in_pool(self.io_pool, self.get_pipe, pipe_name)
+        if self.sequence_buckets is not None:
+            max_sequence_length = await run_in_pool(
+                self.cpu_pool,
+                self.bucket_sequence_length,
+                pipe,
+                prompt,
+                full_sequence_length,
+            )
+
+        loras, joint_scale = await run_in_pool(
+            self.io_pool,
+            self.prepare_loras,
+            model,
+            replicate_weights,
+            lora_scale,
+            extra_lora,
+            extra_lora_scale,
+        )
+        if joint_scale is not None:
+            flux_kwargs["joint_attention_kwargs"] = {"scale": joint_scale}
 
-        generator = torch.Generator(device="cuda").manual_seed(seed)
+        generation = Generation(
+            pipe_name=pipe_name,
+            model=model,
+            prompt=prompt,
+            num_outputs=num_outputs,
+            seed=seed,
+            guidance_scale=guidance_scale,
+            num_inference_steps=num_inference_steps,
+            max_sequence_length=max_sequence_length,
+            loras=loras,
+            flux_kwargs=flux_kwargs,
+        )
+        images = await asyncio.wrap_future(self.generate(generation))
 
-        common_args = {
-            "prompt": [prompt] * num_outputs,
-            "guidance_scale": guidance_scale,
-            "generator": generator,
-            "num_inference_steps": num_inference_steps,
-            "max_sequence_length": max_sequence_length,
-            "output_type": "pil",
-        }
+        if (
+            max_sequence_length < full_sequence_length
+            and random.random() < self.sequence_bucket_guard_rate
+        ):
+            baseline = await asyncio.wrap_future(
+                self.generate(
+                    replace(generation, max_sequence_length=full_sequence_length)
+                )
+            )
+            for image, reference in zip(images, baseline):
+                self.sequence_bucket_stats.record_guard(image_psnr(image, reference))
+            print(f"Sequence buckets: {self.sequence_bucket_stats.summary()}")
 
-        output = pipe(**common_args, **flux_kwargs)
+        if self.warm_up_after_first_request and not self.first_request_done:
+            self.components.warm_up(LAZY_COMPONENTS)
+        self.first_request_done = True
 
-        has_nsfw_content = None
+        nsfw = set()
         if not disable_safety_checker:
-            _, has_nsfw_content = self.run_safety_checker(output.images)
-
-        output_paths = []
-        for i, image in enumerate(output.images):
-            if has_nsfw_content is not None and has_nsfw_content[i]:
-                try:
-                    falcon_is_safe = self.run_falcon_safety_checker(image)
-                except Exception as e:
-                    print(f"Error running safety checker: {e}")
-                    falcon_is_safe = False
-                if not falcon_is_safe:
-                    print(f"NSFW content detected in image {i}")
-                    continue
-            output_path = f"/tmp/out-{i}.{output_format}"
-            if output_format != "png":
-                image.save(output_path, quality=output_quality, optimize=True)
-            else:
-                image.save(output_path)
-            output_paths.append(Path(output_path))
-
-        if len(output_paths) == 0:
+            nsfw = await run_in_pool(self.safety_pool, self.find_nsfw_images, images)
+        safe_images = [(i, image) for i, image in enumerate(images) if i not in nsfw]
+        if len(safe_images) == 0:
             raise Exception(
                 "NSFW content detected. Try running it again, or try a different prompt."
             )
 
-        return output_paths
+        output_dir = self.new_output_dir()
+        encoded = await run_in_pool(
+            self.cpu_pool,
+            self.image_encoder.encode,
+            safe_images,
+            output_format,
+            output_quality,
+            output_dir,
+        )
+        for encoded_image in encoded:
+            print(f"Encoded {encoded_image.summary()}")
+        print(f"Output encoding: {self.image_encoder.stats()}")
+        return [Path(encoded_image.path) for encoded_image in encoded]
 
-    def load_single_lora(self, lora_url: str, model: str):
-        # If no change, skip
-        if lora_url == self.loaded_lora_urls[model].main:
-            print("Weights already loaded")
-            return
+    def new_output_dir(self) -> Path:
+        """A directory for one request's outputs.
 
-        pipe = self.pipes[model]
-        pipe.unload_lora_weights()
-        lora_path = self.weights_cache.ensure(lora_url)
-        pipe.load_lora_weights(lora_path, adapter_name="main")
-        self.loaded_lora_urls[model] = LoadedLoRAs(main=lora_url, extra=None)
-        pipe = pipe.to("cuda")
+        Concurrent requests can't overwrite each other's outputs, and only
+        the last `KEPT_OUTPUT_DIRS` directories are kept.
+        """
+        output_dir = Path(tempfile.mkdtemp(prefix="out-"))
+        self.output_dirs.append(output_dir)
+        while len(self.output_dirs) > KEPT_OUTPUT_DIRS:
+            shutil.rmtree(self.output_dirs.popleft(), ignore_errors=True)
+        return output_dir
 
-    def load_multiple_loras(self, main_lora_url: str, extra_lora_url: str, model: str):
-        pipe = self.pipes[model]
-        loaded_lora_urls = self.loaded_lora_urls[model]
+    def prepare_loras(
+        self,
+        model: str,
+        replicate_weights: str | None,
+        lora_scale: float,
+        extra_lora: str | None,
+        extra_lora_scale: float,
+    ) -> tuple[list[tuple[str, float]], float | None]:
+        """The (url, scale) LoRAs to activate and the joint attention scale.
 
-        # If no change, skip
-        if (
-            main_lora_url == loaded_lora_urls.main
-            and extra_lora_url == self.loaded_lora_urls[model].extra
-        ):
-            print("Weights already loaded")
+        Downloads, checks and converts the LoRA files, so the GPU queue
+        doesn't wait on them, and merges main and extra LoRAs if enabled. With
+        `LORA_BATCHING`, raises ValueError for LoRAs that can't be batched,
+        before the request can join a batch.
+        """
+        if not replicate_weights:
+            return [], None
+        self.prefetcher.record(replicate_weights)
+        loras = [(replicate_weights, lora_scale)]
+        joint_scale = lora_scale
+        if not extra_lora:
+            with self.prefetcher.foreground():
+                self.inspect_lora(replicate_weights)
+        else:
+            self.prefetcher.record(extra_lora)
+            print(f"Loading extra LoRA weights from: {extra_lora}")
+            loras.append((extra_lora, extra_lora_scale))
+            joint_scale = 1.0
+            with self.prefetcher.foreground():
+                infos = [self.inspect_lora(url) for url, _ in loras]
+            if (
+                self.merged_loras is not None
+                and not self.lora_batching
+                and any(info.text_encoder_modules for info in infos)
+            ):
+                # Merged adapters only hold transformer weights
+                print("Not merging LoRAs that have text encoder weights")
+            elif self.merged_loras is not None:
+                with self.prefetcher.foreground():
+                    merged_path = self.merged_loras.ensure(
+                        loras,
+                        self.load_lora_peft_state_dict,
+                    )
+                print(f"Merged LoRAs: {self.merged_loras.cache_info()}")
+                loras = [(f"{MERGED_URL_PREFIX}{merged_path.name}", 1.0)]
+
+        if self.lora_batching:
+            # Converts the LoRAs to check them
+            self.check_batchable(model, loras)
+        else:
+            with self.prefetcher.foreground():
+                for url, _ in loras:
+                    # Merged LoRAs aren't in the weights cache, so they are
+                    # converted where they are loaded
+                    if not url.startswith(MERGED_URL_PREFIX):
+                        self.load_converted_lora(url)
+        return loras, joint_scale
+
+    def check_batchable(self, model: str, loras: list[tuple[str, float]]) -> None:
+        """Raise ValueError if `get_batched_loras(model)` can't hold `loras`.
+
+        A request fails here on its own, where inside `set_batch` it would
+        fail every request batched with it.
+        """
+        if len(loras) > 1:
+            raise ValueError("Batched LoRAs need one merged LoRA per request")
+        for url, _ in loras:
+            with self.prefetcher.foreground():
+                lora = self.load_converted_lora(url)
+            check_batchable(
+                lora.state_dict,
+                self.batchable_modules(model),
+                self.lora_batch_max_rank,
+            )
+
+    def batchable_modules(self, model: str) -> list[str]:
+        """The transformer layers `get_batched_loras(model)` batches."""
+        with self.batchable_lock:
+            if model not in self.batchable:
+                # Found before BatchedLoRAs wraps the layers, which hides them
+                # from targetable_modules
+                self.batchable[model] = targetable_modules(
+                    self.get_pipe(model).transformer
+                )
+            return self.batchable[model]
+
+    def generate(self, generation: Generation) -> Future:
+        """Queue `generation` to run batched with compatible ones.
+
+        The future's result is the generation's images.
+        """
+        return self.scheduler.submit(
+            generation.batch_key(share_loras=self.lora_batching),
+            generation,
+            size=generation.num_outputs,
+        )
+
+    @torch.inference_mode()
+    def run_generations(
+        self, _key: Hashable, generations: list[Generation]
+    ) -> list[list[Image.Image]]:
+        """Run generations with the same batch key as one pipeline call."""
+        first = generations[0]
+        pipe = self.get_pipe(first.pipe_name)
+        flux_kwargs = first.flux_kwargs
+        if self.lora_batching:
+            self.set_lora_batch(first.model, generations)
+            # Each image's LoRA scale is applied by the batched layers
+            flux_kwargs = {
+                k: v for k, v in flux_kwargs.items() if k != "joint_attention_kwargs"
+            }
+            text_encoder_loras = ()
+        else:
+            self.activate_loras(first.model, first.loras, first.joint_scale)
+            text_encoder_loras = self.text_encoder_loras(first.loras, first.model)
+
+        prompt_embeds, pooled_prompt_embeds, generators = [], [], []
+        for generation in generations:
+            embeds, pooled_embeds = self.encode_prompt(
+                pipe,
+                generation.prompt,
+                generation.max_sequence_length,
+                generation.num_outputs,
+                text_encoder_loras,
+                lora_scale=None if self.lora_batching else generation.joint_scale,
+            )
+            prompt_embeds.append(embeds)
+            pooled_prompt_embeds.append(pooled_embeds)
+            # One generator per image, so a request's images only depend on
+            # its own seed and not on what it was batched with
+            generators += [
+                torch.Generator(device="cuda").manual_seed(generation.seed + i)
+                for i in range(generation.num_outputs)
+            ]
+        if len(generations) > 1:
+            print(f"Batched {len(generations)} requests: {self.scheduler.stats()}")
+
+        try:
+            output = pipe(
+                prompt_embeds=torch.cat(prompt_embeds),
+                pooled_prompt_embeds=torch.cat(pooled_prompt_embeds),
+                guidance_scale=first.guidance_scale,
+                generator=generators,
+                num_inference_steps=first.num_inference_steps,
+                max_sequence_length=first.max_sequence_length,
+                output_type="pil",
+                **flux_kwargs,
+            )
+        finally:
+            if self.lora_batching:
+                self.get_batched_loras(first.model).clear_batch()
+
+        images = []
+        start = 0
+        for generation in generations:
+            images.append(output.images[start : start + generation.num_outputs])
+            start += generation.num_outputs
+        return images
+
+    def set_lora_batch(self, model: str, generations: list[Generation]) -> None:
+        """Give every image of `generations` its request's LoRA, for one pipeline call."""
+        batched_loras = self.get_batched_loras(model)
+        samples = []
+        for generation in generations:
+            if len(generation.loras) > 1:
+                raise ValueError("Batched LoRAs need one merged LoRA per request")
+            lora = None
+            if generation.loras:
+                url, scale = generation.loras[0]
+                # The joint attention scale multiplies the adapter's own scale
+                lora = (url, scale * (generation.joint_scale or 1.0))
+            samples += [lora] * generation.num_outputs
+        start_time = time.time()
+        with self.prefetcher.foreground():
+            batched_loras.set_batch(samples)
+        print(f"Loaded batched LoRAs in {time.time() - start_time:.2f}s")
+        print(f"Batched LoRAs: {batched_loras.cache_info()}")
+
+    def activate_loras(
+        self, model: str, loras: list[tuple[str, float]], joint_scale: float | None
+    ) -> None:
+        """Make exactly `loras` active in the model's transformer."""
+        if not loras:
+            if model in self.adapter_pools:
+                fuser = self.get_lora_fuser(model)
+                if fuser is not None:
+                    fuser.unfuse()
+                    fuser.observe(None)
+                self.adapter_pools[model].deactivate()
             return
 
-        # We always need to load both?
-        pipe.unload_lora_weights()
+        start_time = time.time()
+        adapter_pool = self.get_adapter_pool(model)
+        fuser = self.get_lora_fuser(model)
+        fuse_key = fuser.key(loras, joint_scale) if fuser is not None else None
+        if fuser is not None and fuser.fused_key == fuse_key:
+            print("Using LoRAs fused into the transformer")
+        else:
+            if fuser is not None:
+                fuser.unfuse()
+            with self.prefetcher.foreground():
+                adapter_pool.activate(loras)
+        if fuser is not None:
+            fuser.observe(fuse_key, scale=joint_scale or 1.0)
+            print(f"LoRA fusion: {fuser.stats()}")
+        print(f"Loaded LoRAs in {time.time() - start_time:.2f}s")
+        print(f"Adapter pool: {adapter_pool.cache_info()}")
+        if self.lora_staging and isinstance(adapter_pool, LoRASlots):
+            self.stage_next_lora(adapter_pool, model, [url for url, _ in loras])
+
+    def get_pipe(self, name: str) -> FluxPipeline:
+        """The pipeline named e.g. "dev" or "schnell_img2img", built if needed."""
+        return cast("FluxPipeline", self.components.get(name))
+
+    def get_adapter_pool(self, model: str) -> AdapterPool | LoRASlots:
+        if model in self.adapter_pools:
+            return self.adapter_pools[model]
+
+        pipe = self.get_pipe(model)
+        if self.use_lora_slots:
+            self.adapter_pools[model] = LoRASlots(
+                pipe.transformer,
+                self.load_lora_peft_state_dict,
+                max_rank=int(os.environ.get("LORA_SLOT_MAX_RANK", DEFAULT_MAX_RANK)),
+                resolve=self.resolve_lora,
+            )
+        else:
+            self.adapter_pools[model] = AdapterPool(
+                pipe,
+                self.load_converted_lora,
+                inspect=lambda url: self.inspect_lora(url).nbytes,
+                resolve=self.resolve_lora,
+                max_bytes=int(
+                    os.environ.get(
+                        "LORA_ADAPTER_POOL_BYTES", DEFAULT_ADAPTER_POOL_BYTES
+                    )
+                ),
+            )
+        return self.adapter_pools[model]
+
+    def get_batched_loras(self, model: str) -> BatchedLoRAs:
+        if model not in self.batched_loras:
+            num_adapters = int(os.environ.get("LORA_BATCH_ADAPTERS", 8))
+            self.batched_loras[model] = BatchedLoRAs(
+                self.get_pipe(model).transformer,
+                self.load_lora_peft_state_dict,
+                # Enough for every request of a full batch to have its own
+                num_adapters=max(num_adapters, self.scheduler.max_batch_size),
+                max_rank=self.lora_batch_max_rank,
+                target_modules=self.batchable_modules(model),
+                resolve=self.resolve_lora,
+            )
+        return self.batched_loras[model]
+
+    def bucket_sequence_length(
+        self, pipe: FluxPipeline, prompt: str, max_length: int
+    ) -> int:
+        """The T5 sequence length to pad `prompt` to, from `self.sequence_buckets`."""
+        assert self.sequence_buckets is not None
+        num_tokens = len(self.counting_tokenizer(pipe)(prompt).input_ids)
+        length = bucket_length(num_tokens, self.sequence_buckets, max_length)
+        self.sequence_bucket_stats.record(max_length, length)
+        print(
+            f"Prompt has {num_tokens} T5 tokens, padding to {length} "
+            f"instead of {max_length}"
+        )
+        print(f"Sequence buckets: {self.sequence_bucket_stats.summary()}")
+        return length
+
+    def counting_tokenizer(self, pipe: FluxPipeline) -> T5TokenizerFast:
+        """This thread's own copy of `pipe`'s T5 tokenizer.
+
+        A fast tokenizer sets its truncation and padding on every call, so
+        counting tokens with the one `encode_prompt` uses on the GPU thread
+        would change the length of both calls' ids.
+        """
+        if not hasattr(self.counting_tokenizers, "by_id"):
+            self.counting_tokenizers.by_id = {}
+        tokenizers = self.counting_tokenizers.by_id
+        key = id(pipe.tokenizer_2)
+        if key not in tokenizers:
+            tokenizers[key] = copy.deepcopy(pipe.tokenizer_2)
+        return tokenizers[key]
 
-        main_lora_path = self.weights_cache.ensure(main_lora_url)
-        pipe.load_lora_weights(main_lora_path, adapter_name="main")
+    def encode_prompt(
+        self,
+        pipe: FluxPipeline,
+        prompt: str,
+        max_sequence_length: int,
+        num_outputs: int,
+        text_encoder_loras: tuple,
+        lora_scale: float | None = None,
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        """The prompt's T5 and pooled CLIP embeddings, repeated for each output."""
+        key = (
+            prompt,
+            max_sequence_length,
+            # dev and schnell share these, so they share cache entries
+            id(pipe.tokenizer),
+            id(pipe.tokenizer_2),
+            id(pipe.text_encoder),
+            id(pipe.text_encoder_2),
+            text_encoder_loras,
+            lora_scale if text_encoder_loras else None,
+        )
 
-        extra_lora_path = self.weights_cache.ensure(extra_lora_url)
-        pipe.load_lora_weights(extra_lora_path, adapter_name="extra")
+        def encode() -> tuple[torch.Tensor, torch.Tensor]:
+            prompt_embeds, pooled_prompt_embeds, _ = pipe.encode_prompt(
+                prompt=prompt,
+                prompt_2=None,
+                device="cuda",
+                num_images_per_prompt=1,
+                max_sequence_length=max_sequence_length,
+                lora_scale=lora_scale,
+            )
+            return prompt_embeds, pooled_prompt_embeds
+
+        prompt_embeds, pooled_prompt_embeds = self.prompt_cache.get(
+            key, encode, batch_size=num_outputs
+        )
+        print(f"Prompt embedding cache: {self.prompt_cache.cache_info()}")
+        return prompt_embeds, pooled_prompt_embeds
 
-        self.loaded_lora_urls[model] = LoadedLoRAs(
-            main=main_lora_url, extra=extra_lora_url
+    def text_encoder_loras(
+        self, loras: list[tuple[str, float]], model: str
+    ) -> tuple[tuple[str, float], ...]:
+        """The active LoRAs that change the text encoders' embeddings."""
+        if not isinstance(self.adapter_pools.get(model), AdapterPool):
+            # Slots and merged adapters only hold transformer weights
+            return ()
+        return tuple(
+            (url, scale)
+            for url, scale in loras
+            if not url.startswith(MERGED_URL_PREFIX)
+            and self.inspect_lora(url).text_encoder_modules
         )
-        pipe = pipe.to("cuda")
+
+    def stage_next_lora(self, slots: LoRASlots, model: str, active: list[str]) -> None:
+        """Stage the first LoRA of the queued generations that isn't active.
+
+        Runs while this batch denoises, so the next batch with that LoRA
+        only has to copy it into a slot.
+        """
+        for generation in self.scheduler.pending():
+            if generation.model != model:
+                continue
+            for url, _ in generation.loras:
+                if url not in active:
+                    slots.stage(url)
+                    return
+
+    def get_lora_fuser(self, model: str) -> LoRAFuser | None:
+        if self.lora_fuse_after <= 0:
+            return None
+        if model not in self.lora_fusers:
+            self.lora_fusers[model] = LoRAFuser(
+                self.get_pipe(model).transformer,
+                threshold=self.lora_fuse_after,
+                resolve=self.resolve_lora,
+            )
+        return self.lora_fusers[model]
+
+    def load_lora_peft_state_dict(
+        self, lora_url: str
+    ) -> tuple[dict[str, torch.Tensor], dict | None]:
+        """The transformer's LoRA weights for `lora_url`, converted to PEFT format."""
+        lora = self.load_converted_lora(lora_url)
+        return lora.state_dict, lora.network_alphas
+
+    def resolve_lora(self, lora_url: str) -> str:
+        """The weights `lora_url` points at now, as the name of their cache entry.
+
+        Mutable URLs like <owner>/<model> are revalidated here, so resident
+        adapters pick up new versions.
+        """
+        if lora_url.startswith(MERGED_URL_PREFIX):
+            # Merged files are named after the weights they were merged from
+            return lora_url
+        return self.weights_cache.ensure(lora_url).name
+
+    def inspect_lora(self, lora_url: str) -> LoRAInfo:
+        """Check the file behind `lora_url` from its header, raising ValueError if bad."""
+        if lora_url.startswith(MERGED_URL_PREFIX):
+            assert self.merged_loras is not None
+            return inspect_lora(
+                self.merged_loras.path(lora_url[len(MERGED_URL_PREFIX) :])
+            )
+        with self.weights_cache.lease(lora_url) as lora_path:
+            info = inspect_lora(lora_path)
+        print(f"Inspected LoRA {lora_url}: {info.summary()}")
+        return info
+
+    def load_converted_lora(self, lora_url: str) -> ConvertedLoRA:
+        if lora_url.startswith(MERGED_URL_PREFIX):
+            assert self.merged_loras is not None
+            merged_path = self.merged_loras.path(lora_url[len(MERGED_URL_PREFIX) :])
+            return self.converted_loras.load(merged_path, persist=False)
+        with self.weights_cache.lease(lora_url) as lora_path:
+            lora = self.converted_loras.load(lora_path)
+        print(f"LoRA conversions: {self.converted_loras.cache_info()}")
+        print(f"LoRA memory cache: {self.lora_memory_cache.cache_info()}")
+        return lora
+
+    @torch.inference_mode()
+    def find_nsfw_images(self, images: list[Image.Image]) -> set[int]:
+        """Indices of the images both safety checkers flag."""
+        _, has_nsfw_content = self.run_safety_checker(images)
+        nsfw = set()
+        for i, image in enumerate(images):
+            if not has_nsfw_content[i]:
+                continue
+            try:
+                falcon_is_safe = self.run_falcon_safety_checker(image)
+            except Exception as e:
+                print(f"Error running safety checker: {e}")
+                falcon_is_safe = False
+            if not falcon_is_safe:
+                print(f"NSFW content detected in image {i}")
+                nsfw.add(i)
+        return nsfw
 
     @torch.amp.autocast("cuda")  # pyright: ignore
     def run_safety_checker(self, image):
-        safety_checker_input = self.feature_extractor(image, return_tensors="pt").to(
-            "cuda"
+        feature_extractor = cast(
+            "CLIPImageProcessor", self.components.get("feature_extractor")
+        )
+        safety_checker = cast(
+            "StableDiffusionSafetyChecker", self.components.get("safety_checker")
         )
+        safety_checker_input = feature_extractor(image, return_tensors="pt").to("cuda")
         np_image = [np.array(val) for val in image]
-        image, has_nsfw_concept = self.safety_checker(
+        image, has_nsfw_concept = safety_checker(
             images=np_image,
             clip_input=safety_checker_input.pixel_values.to(torch.float16),
         )
@@ -483,11 +1069,13 @@ class Predictor(BasePredictor):
     @torch.amp.autocast("cuda")  # pyright: ignore
     def run_falcon_safety_checker(self, image):
         with torch.no_grad():
-            inputs = self.falcon_processor(images=image, return_tensors="pt")
-            outputs = self.falcon_model(**inputs)
+            falcon_processor = self.components.get("falcon_processor")
+            falcon_model = self.components.get("falcon")
+            inputs = falcon_processor(images=image, return_tensors="pt")  # pyright: ignore
+            outputs = falcon_model(**inputs)  # pyright: ignore
             logits = outputs.logits
             predicted_label = logits.argmax(-1).item()
-            result = self.falcon_model.config.id2label[predicted_label]
+            result = falcon_model.config.id2label[predicted_label]  # pyright: ignore
 
         return result == "normal"
 
@@ -495,6 +1083,94 @@ class Predictor(BasePredictor):
         return ASPECT_RATIOS[aspect_ratio]
 
 
+def convert_lora(state_dict: dict[str, torch.Tensor]) -> ConvertedLoRA:
+    """Convert a LoRA file's state dict for `ConvertedLoRACache`.
+
+    Does the work of `load_lora_weights` short of touching a pipeline, which
+    is the same for every Flux pipeline.
+    """
+    state_dict, network_alphas = FluxPipeline.lora_state_dict(
+        state_dict, return_alphas=True
+    )
+    text_encoder_state_dict = {
+        k: v for k, v in state_dict.items() if "text_encoder." in k
+    }
+    transformer_state_dict, transformer_alphas = transformer_peft_state_dict(
+        state_dict, network_alphas, FluxPipeline.transformer_name
+    )
+    return ConvertedLoRA(
+        state_dict=transformer_state_dict,
+        network_alphas=transformer_alphas,
+        config_kwargs=transformer_lora_config_kwargs(
+            transformer_state_dict, transformer_alphas
+        )
+        if transformer_state_dict
+        else {},
+        text_encoder_state_dict=text_encoder_state_dict,
+        text_encoder_alphas=network_alphas,
+    )
+
+
+async def run_in_pool(pool: ThreadPoolExecutor, fn: Callable, *args):
+    """Run `fn(*args)` on `pool` without blocking the event loop."""
+    return await asyncio.get_running_loop().run_in_executor(pool, fn, *args)
+
+
+def load_input_images(
+    image: Path, mask: Path | None, prompt_strength: float, use_highest_quality: bool
+) -> dict:
+    """Pipeline kwargs for an img2img or inpainting request's input images."""
+    input_image = Image.open(image).convert("RGB")
+    original_width, original_height = input_image.size
+
+    # Calculate dimensions that are multiples of 16
+    target_width = make_multiple_of_16(original_width)
+    target_height = make_multiple_of_16(original_height)
+    target_size = (target_width, target_height)
+
+    print(
+        f"[!] Resizing input image from {original_width}x{original_height} to {target_width}x{target_height}"
+    )
+
+    # Resize the input image
+    resampling_method = Image.LANCZOS if use_highest_quality else Image.BICUBIC
+    input_image = input_image.resize(target_size, resampling_method)
+    flux_kwargs = {
+        "image": input_image,
+        # Width and height match the resized input image
+        "width": target_width,
+        "height": target_height,
+        "strength": prompt_strength,
+    }
+
+    if mask is None:
+        print("[!] img2img mode")
+    else:
+        print("[!] inpaint mode")
+        mask_image = Image.open(mask).convert("RGB")
+        flux_kwargs["mask_image"] = mask_image.resize(target_size, Image.NEAREST)
+    return flux_kwargs
+
+
+def wrap_pipeline(pipeline_class, pipe: FluxPipeline):
+    """Build a pipeline of another kind that shares every component with `pipe`."""
+    return pipeline_class(
+        transformer=pipe.transformer,
+        scheduler=pipe.scheduler,
+        vae=pipe.vae,
+        text_encoder=pipe.text_encoder,
+        text_encoder_2=pipe.text_encoder_2,
+        tokenizer=pipe.tokenizer,
+        tokenizer_2=pipe.tokenizer_2,
+    ).to("cuda")
+
+
+def download_base_weights_once(url: str, dest: Path, check_path: Path | None = None):
+    """Download and extract `url` into `dest`, unless `check_path` or `dest` exists."""
+    if not (check_path or dest).exists():
+        download_base_weights(url, dest)
+
+
 def download_base_weights(url: str, dest: Path):
     start = time.time()
     print("downloading url: ", url)
@@ -0,0 +1,183 @@
+import json
+import os
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable
+
+from weights import WeightsDownloadCache
+
+ACCESS_HISTORY_NAME = ".access_history.json"
+# An access counts half as much after this many seconds
+DEFAULT_HALF_LIFE = 24 * 60 * 60
+# Number of URLs remembered, the coldest are forgotten first
+DEFAULT_MAX_URLS = 1000
+
+
+class AccessHistory:
+    """
+    Per-URL access frequency and recency, persisted as JSON so it survives
+    restarts and seeds the prefetcher of a freshly started instance. Each URL
+    has a score that grows by one per access and decays exponentially with
+    `half_life`, so popular and recently popular URLs rank highest.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        half_life: float = DEFAULT_HALF_LIFE,
+        max_urls: int = DEFAULT_MAX_URLS,
+    ):
+        self.path = path
+        self.half_life = half_life
+        self.max_urls = max_urls
+        self._lock = threading.Lock()
+        try:
+            self._entries: dict[str, dict[str, float]] = json.loads(path.read_text())
+        except (FileNotFoundError, json.JSONDecodeError):
+            self._entries = {}
+
+    def record(self, url: str) -> None:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(url)
+            score = self._score(entry, now) if entry else 0.0
+            self._entries[url] = {"score": score + 1, "last": now}
+            if len(self._entries) > self.max_urls:
+                coldest = min(
+                    self._entries, key=lambda u: self._score(self._entries[u], now)
+                )
+                del self._entries[coldest]
+            self._save()
+
+    def hottest(self, n: int) -> list[str]:
+        """The `n` URLs with the highest score, hottest first."""
+        now = time.time()
+        with self._lock:
+            ranked = sorted(
+                self._entries,
+                key=lambda u: self._score(self._entries[u], now),
+                reverse=True,
+            )
+        return ranked[:n]
+
+    def _score(self, entry: dict[str, float], now: float) -> float:
+        return entry["score"] * 0.5 ** ((now - entry["last"]) / self.half_life)
+
+    def _save(self) -> None:
+        tmp_path = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+        tmp_path.write_text(json.dumps(self._entries))
+        tmp_path.replace(self.path)
+
+
+class Prefetcher:
+    """
+    Warms the weights cache in a background thread, so the first request for
+    a popular LoRA on a new instance doesn't wait for its download. URLs from
+    an explicit warm list are fetched first, then the hottest URLs in the
+    access history that aren't cached yet.
+
+    Prefetching runs below foreground work: it waits while any caller is
+    inside `foreground()`, downloads one file at a time, and only downloads
+    what fits in the cache without evicting anything. After a download,
+    `warm` is called with the cached path, e.g. to load it into memory.
+    """
+
+    def __init__(
+        self,
+        cache: WeightsDownloadCache,
+        history: AccessHistory,
+        warm: Callable[[Path], object] | None = None,
+        top_n: int = 16,
+        interval: float = 60,
+    ):
+        self.cache = cache
+        self.history = history
+        self.warm = warm
+        self.top_n = top_n
+        self.interval = interval
+
+        self._lock = threading.Lock()
+        # Signalled when foreground work finishes or the prefetcher is stopped
+        self._wakeup = threading.Condition(self._lock)
+        self._foreground = 0
+        self._stopped = threading.Event()
+        self._warm_list: list[str] = []
+        # URLs that failed to prefetch are left to the foreground to retry
+        self._failed: set[str] = set()
+        self._thread: threading.Thread | None = None
+
+    def start(self, warm_list: list[str] | None = None) -> None:
+        with self._lock:
+            self._warm_list = list(warm_list or [])
+        self._thread = threading.Thread(target=self._run, name="prefetch", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        with self._lock:
+            self._stopped.set()
+            self._wakeup.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+
+    def record(self, url: str) -> None:
+        """Note a foreground access to `url`."""
+        self.history.record(url)
+
+    @contextmanager
+    def foreground(self) -> Iterator[None]:
+        """Pause starting new prefetches while the block runs."""
+        with self._lock:
+            self._foreground += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._foreground -= 1
+                self._wakeup.notify_all()
+
+    def run_once(self) -> list[str]:
+        """Prefetch everything currently wanted. Returns the URLs that were cached."""
+        with self._lock:
+            warm_list, self._warm_list = self._warm_list, []
+        candidates = warm_list + [
+            url for url in self.history.hottest(self.top_n) if url not in warm_list
+        ]
+
+        prefetched = []
+        for url in candidates:
+            if url in self._failed or not self._wait_for_idle():
+                continue
+            try:
+                path = self.cache.prefetch(url)
+                if path is None:
+                    continue
+                if self.warm is not None:
+                    with self.cache.lease(url) as leased_path:
+                        self.warm(leased_path)
+            except Exception as e:
+                print(f"Failed to prefetch {url}: {e}")
+                self._failed.add(url)
+                continue
+            prefetched.append(url)
+        return prefetched
+
+    def _wait_for_idle(self) -> bool:
+        """Block while foreground work is running. False once stopped."""
+        with self._lock:
+            while self._foreground > 0 and not self._stopped.is_set():
+                self._wakeup.wait()
+            return not self._stopped.is_set()
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            self.run_once()
+            self._stopped.wait(self.interval)
+
+
+def read_warm_list(path: Path) -> list[str]:
+    """URLs to prefetch at startup, one per line. Blank and # comment lines are skipped."""
+    lines = (line.strip() for line in path.read_text().splitlines())
+    return [line for line in lines if line and not line.startswith("#")]
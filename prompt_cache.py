@@ -0,0 +1,81 @@
+import threading
+from collections import OrderedDict
+from collections.abc import Hashable
+from typing import Callable
+
+import torch
+
+# Default budget for cached embeddings, which stay on the text encoders' device
+DEFAULT_PROMPT_CACHE_BYTES = 512 * (2**20)
+
+
+class PromptEmbeddingCache:
+    """
+    Recently used prompt embeddings, so a prompt that is submitted again,
+    e.g. with another seed or LoRA, skips the CLIP and T5 encoders. Each
+    entry holds the tensors `encode` returned for a single prompt and is
+    evicted least recently used first once `max_bytes` is exceeded.
+
+    Keys must capture everything the embeddings depend on: the prompt, the
+    sequence length, the text encoders and any LoRAs applied to them.
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_PROMPT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.total_bytes = 0
+
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[Hashable, tuple[tuple[torch.Tensor, ...], int]] = (
+            OrderedDict()
+        )
+
+    def get(
+        self,
+        key: Hashable,
+        encode: Callable[[], tuple[torch.Tensor, ...]],
+        batch_size: int = 1,
+    ) -> tuple[torch.Tensor, ...]:
+        """The embeddings for `key`, encoded with `encode` if they aren't cached.
+
+        `encode` returns tensors for a batch of one. They are repeated
+        along the batch dimension to `batch_size`, without encoding again.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self.hits += 1
+                self._entries.move_to_end(key)
+            else:
+                self.misses += 1
+
+        if entry is not None:
+            tensors = entry[0]
+        else:
+            tensors = encode()
+            size = sum(t.numel() * t.element_size() for t in tensors)
+            with self._lock:
+                self._insert(key, tensors, size)
+        return tuple(expand_batch(t, batch_size) for t in tensors)
+
+    def cache_info(self) -> str:
+        return f"CacheInfo(hits={self.hits}, misses={self.misses}, currsize={len(self._entries)}, bytes={self.total_bytes})"
+
+    def _insert(
+        self, key: Hashable, tensors: tuple[torch.Tensor, ...], size: int
+    ) -> None:
+        if size > self.max_bytes or key in self._entries:
+            return
+        self._entries[key] = (tensors, size)
+        self.total_bytes += size
+        while self.total_bytes > self.max_bytes:
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self.total_bytes -= evicted_size
+
+
+def expand_batch(tensor: torch.Tensor, batch_size: int) -> torch.Tensor:
+    """Repeat a batch of one `batch_size` times along the first dimension."""
+    if batch_size == 1:
+        return tensor
+    return tensor.repeat(batch_size, *[1] * (tensor.dim() - 1))
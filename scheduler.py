@@ -0,0 +1,126 @@
+import threading
+import time
+from collections.abc import Hashable
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Any, Callable
+
+
+@dataclass
+class _Pending:
+    key: Hashable
+    item: Any
+    size: int
+    future: Future
+    submitted: float = field(default_factory=time.monotonic)
+
+
+class MicroBatchScheduler:
+    """
+    Runs submitted work items in batches on a single worker thread, so
+    compatible requests that arrive close together share one GPU call.
+
+    Items with the same key can be batched together. The oldest waiting
+    item picks the next batch: it waits up to `max_wait` seconds for more
+    items with its key, and the batch is flushed as soon as their sizes
+    (e.g. images per request) add up to `max_batch_size`. An item bigger
+    than `max_batch_size` runs alone.
+
+    `run_batch(key, items)` returns one result per item, in order. If it
+    raises, every item in the batch fails with the exception.
+    """
+
+    def __init__(
+        self,
+        run_batch: Callable[[Hashable, list], list],
+        max_batch_size: int = 4,
+        max_wait: float = 0.0,
+    ):
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.batches = 0
+        self.items = 0
+
+        self._lock = threading.Lock()
+        # Signalled when an item is submitted or the scheduler is stopped
+        self._wakeup = threading.Condition(self._lock)
+        self._pending: list[_Pending] = []
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="scheduler", daemon=True)
+        self._thread.start()
+
+    def submit(self, key: Hashable, item: Any, size: int = 1) -> Future:
+        """Queue `item` for a batch of items with the same `key`."""
+        future = Future()
+        with self._lock:
+            if self._stopped:
+                raise RuntimeError("Scheduler is stopped")
+            self._pending.append(_Pending(key, item, size, future))
+            self._wakeup.notify_all()
+        return future
+
+    def pending(self) -> list:
+        """The items waiting for a batch, oldest first."""
+        with self._lock:
+            return [p.item for p in self._pending]
+
+    def stop(self) -> None:
+        """Stop once the items already submitted have run."""
+        with self._lock:
+            self._stopped = True
+            self._wakeup.notify_all()
+        self._thread.join()
+
+    def stats(self) -> str:
+        mean = self.items / self.batches if self.batches else 0.0
+        return f"BatchStats(batches={self.batches}, items={self.items}, mean_batch={mean:.2f}, max_batch_size={self.max_batch_size}, max_wait={self.max_wait})"
+
+    def _run(self) -> None:
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            self.batches += 1
+            self.items += len(batch)
+            try:
+                results = self.run_batch(batch[0].key, [p.item for p in batch])
+            except Exception as e:
+                for pending in batch:
+                    pending.future.set_exception(e)
+                continue
+            for pending, result in zip(batch, results):
+                pending.future.set_result(result)
+
+    def _next_batch(self) -> list[_Pending] | None:
+        with self._lock:
+            while not self._pending:
+                if self._stopped:
+                    return None
+                self._wakeup.wait()
+
+            oldest = self._pending[0]
+            deadline = oldest.submitted + self.max_wait
+            while not self._stopped:
+                remaining = deadline - time.monotonic()
+                if (
+                    remaining <= 0
+                    or self._batch_size(oldest.key) >= self.max_batch_size
+                ):
+                    break
+                self._wakeup.wait(remaining)
+
+            batch = []
+            size = 0
+            for pending in list(self._pending):
+                if pending.key != oldest.key:
+                    continue
+                if batch and size + pending.size > self.max_batch_size:
+                    break
+                batch.append(pending)
+                size += pending.size
+                self._pending.remove(pending)
+            return batch
+
+    def _batch_size(self, key: Hashable) -> int:
+        return sum(p.size for p in self._pending if p.key == key)
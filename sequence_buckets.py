@@ -0,0 +1,68 @@
+import threading
+
+import numpy as np
+from PIL import Image
+
+# T5 sequence lengths prompts are padded to in adaptive mode
+DEFAULT_SEQUENCE_BUCKETS = (64, 128, 256, 512)
+
+
+def parse_buckets(value: str) -> tuple[int, ...]:
+    """Parse a comma-separated list of sequence lengths, e.g. "64,128,256,512"."""
+    try:
+        buckets = sorted({int(length) for length in value.split(",") if length})
+    except ValueError as e:
+        raise ValueError(f"Invalid sequence buckets: {value}") from e
+    if not buckets or buckets[0] <= 0:
+        raise ValueError(f"Invalid sequence buckets: {value}")
+    return tuple(buckets)
+
+
+def bucket_length(num_tokens: int, buckets: tuple[int, ...], max_length: int) -> int:
+    """The smallest bucket that fits `num_tokens`, capped at `max_length`.
+
+    Prompts longer than `max_length` are truncated to it, like with fixed
+    padding.
+    """
+    for length in buckets:
+        if num_tokens <= length:
+            return min(length, max_length)
+    return max_length
+
+
+def image_psnr(image: Image.Image, reference: Image.Image) -> float:
+    """Peak signal-to-noise ratio of `image` against `reference`, in dB."""
+    a = np.asarray(image.convert("RGB"), dtype=np.float64)
+    b = np.asarray(reference.convert("RGB"), dtype=np.float64)
+    mse = np.mean((a - b) ** 2)
+    if mse == 0:
+        return float("inf")
+    return float(10 * np.log10(255**2 / mse))
+
+
+class SequenceBucketStats:
+    """
+    Running totals for adaptive sequence lengths: how many T5 tokens were
+    saved compared to fixed padding, and how close guarded requests came to
+    their fixed-length baseline.
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.tokens_saved = 0
+        self.guard_checks = 0
+        self.min_psnr = float("inf")
+        self._lock = threading.Lock()
+
+    def record(self, max_length: int, length: int) -> None:
+        with self._lock:
+            self.requests += 1
+            self.tokens_saved += max_length - length
+
+    def record_guard(self, psnr: float) -> None:
+        with self._lock:
+            self.guard_checks += 1
+            self.min_psnr = min(self.min_psnr, psnr)
+
+    def summary(self) -> str:
+        return f"SequenceBucketStats(requests={self.requests}, tokens_saved={self.tokens_saved}, guard_checks={self.guard_checks}, min_psnr={self.min_psnr:.1f})"
@@ -0,0 +1,209 @@
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from typing import Callable
+
+
+@dataclass
+class _Task:
+    name: str
+    fn: Callable[..., object]
+    deps: tuple[str, ...]
+    resource: str | None
+
+
+@dataclass
+class TimelineEntry:
+    name: str
+    # Seconds since the graph started running
+    start: float
+    end: float
+    # Time spent waiting for the step's resource before it started
+    waited: float = 0.0
+
+
+class StartupGraph:
+    """
+    Runs setup steps as a dependency graph on a thread pool. Each step starts
+    as soon as all of its dependencies have finished, and is called with
+    their results as positional arguments in the order they were listed.
+
+    Steps that name the same `resource` run one at a time, e.g. copies to
+    the GPU, which would only compete for bandwidth, while CPU-bound steps
+    like deserializing the next model overlap with them.
+
+    Steps don't all have to run up front. `run` can be limited to some
+    targets, and the rest are materialized on first use with `get`, or
+    ahead of time in the background with `warm_up`. Each step runs at most
+    once, however many callers ask for it concurrently.
+    """
+
+    def __init__(self, max_workers: int = 8):
+        self.max_workers = max_workers
+        self.results: dict[str, object] = {}
+        self.timeline: list[TimelineEntry] = []
+        self._tasks: dict[str, _Task] = {}
+        self._resources: dict[str, threading.Lock] = {}
+        # Guards results and _running, which may be shared by concurrent runs
+        self._lock = threading.Lock()
+        self._running: dict[str, Future] = {}
+        self._pool = ThreadPoolExecutor(max_workers, thread_name_prefix="setup")
+        self._start_time: float | None = None
+
+    def add(
+        self,
+        name: str,
+        fn: Callable[..., object],
+        deps: list[str] | None = None,
+        resource: str | None = None,
+    ) -> None:
+        if name in self._tasks:
+            raise ValueError(f"Duplicate setup step: {name}")
+        self._tasks[name] = _Task(name, fn, tuple(deps or ()), resource)
+        if resource is not None:
+            self._resources.setdefault(resource, threading.Lock())
+
+    def run(self, targets: list[str] | None = None) -> dict[str, object]:
+        """Run `targets` (default: every step) and their dependencies.
+
+        Steps that already ran are skipped, and steps already running for
+        another caller are waited for. Returns the results of all steps so
+        far by name. If a step fails, no new steps are started, the running
+        ones are waited for, and the first error is raised. A failed step is
+        retried by the next run that needs it.
+        """
+        self._check()
+        if self._start_time is None:
+            self._start_time = time.time()
+        names = self._with_dependencies(targets or list(self._tasks))
+        pending = {name: self._tasks[name] for name in names}
+        running: dict[Future, str] = {}
+
+        while pending or running:
+            with self._lock:
+                for name, task in list(pending.items()):
+                    if name in self.results:
+                        del pending[name]
+                    elif name in self._running:
+                        del pending[name]
+                        running[self._running[name]] = name
+                    elif all(dep in self.results for dep in task.deps):
+                        del pending[name]
+                        future = self._pool.submit(self._run_task, task)
+                        self._running[name] = future
+                        running[future] = name
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                with self._lock:
+                    if self._running.get(name) is future:
+                        del self._running[name]
+                    if future.exception() is None:
+                        self.results[name] = future.result()
+                if future.exception() is not None:
+                    wait(running)
+                    print(self.format_timeline(names))
+                    future.result()  # Re-raises the failure
+
+        print(self.format_timeline(names))
+        return self.results
+
+    def step_names(self) -> list[str]:
+        return list(self._tasks)
+
+    def get(self, name: str) -> object:
+        """The result of step `name`, running it and its dependencies if needed."""
+        with self._lock:
+            if name in self.results:
+                return self.results[name]
+        return self.run([name])[name]
+
+    def warm_up(self, targets: list[str]) -> threading.Thread:
+        """Run `targets` in a background thread, so later `get` calls are instant."""
+
+        def run() -> None:
+            try:
+                self.run(targets)
+            except Exception as e:
+                print(f"Background warm-up of {', '.join(targets)} failed: {e}")
+
+        thread = threading.Thread(target=run, name="warm-up", daemon=True)
+        thread.start()
+        return thread
+
+    def format_timeline(self, names: set[str] | None = None) -> str:
+        """Timeline of the finished steps, or of the ones in `names`."""
+        entries = [e for e in self.timeline if names is None or e.name in names]
+        lines = ["Setup timeline:"]
+        width = max((len(entry.name) for entry in entries), default=0)
+        for entry in sorted(entries, key=lambda e: e.start):
+            line = (
+                f"  {entry.name:<{width}}  {entry.start:7.2f}s -> {entry.end:7.2f}s"
+                f"  ({entry.end - entry.start:.2f}s)"
+            )
+            if entry.waited >= 0.01:
+                line += f", waited {entry.waited:.2f}s for the resource"
+            lines.append(line)
+        return "\n".join(lines)
+
+    def _run_task(self, task: _Task) -> object:
+        assert self._start_time is not None
+        start_time = self._start_time
+        with self._lock:
+            args = [self.results[dep] for dep in task.deps]
+        queued = time.time()
+        lock = self._resources.get(task.resource) if task.resource else None
+        if lock is not None:
+            lock.acquire()
+        started = time.time()
+        try:
+            return task.fn(*args)
+        finally:
+            if lock is not None:
+                lock.release()
+            self.timeline.append(
+                TimelineEntry(
+                    name=task.name,
+                    start=started - start_time,
+                    end=time.time() - start_time,
+                    waited=started - queued,
+                )
+            )
+
+    def _with_dependencies(self, targets: list[str]) -> set[str]:
+        names: set[str] = set()
+        stack = list(targets)
+        while stack:
+            name = stack.pop()
+            if name not in self._tasks:
+                raise ValueError(f"Unknown setup step: {name}")
+            if name not in names:
+                names.add(name)
+                stack.extend(self._tasks[name].deps)
+        return names
+
+    def _check(self) -> None:
+        """Reject unknown dependencies and cycles before anything runs."""
+        for task in self._tasks.values():
+            for dep in task.deps:
+                if dep not in self._tasks:
+                    raise ValueError(f"Setup step {task.name} depends on unknown {dep}")
+
+        visited: set[str] = set()
+        visiting: set[str] = set()
+
+        def visit(name: str) -> None:
+            if name in visited:
+                return
+            if name in visiting:
+                raise ValueError(f"Setup steps have a dependency cycle through {name}")
+            visiting.add(name)
+            for dep in self._tasks[name].deps:
+                visit(dep)
+            visiting.remove(name)
+            visited.add(name)
+
+        for name in self._tasks:
+            visit(name)
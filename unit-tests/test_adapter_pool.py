@@ -0,0 +1,193 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.append(str(Path(__file__).parent.parent))
+from adapter_pool import AdapterPool
+
+
+class FakeTensor:
+    def __init__(self, numel: int):
+        self._numel = numel
+
+    def numel(self) -> int:
+        return self._numel
+
+    def element_size(self) -> int:
+        return 2
+
+
+class FakePipe:
+    """Records the diffusers LoRA calls an AdapterPool makes."""
+
+    def __init__(self, text_encoder: set[str] | None = None):
+        self.adapters: set[str] = set()
+        # Adapters in the text encoder, which can be shared between pipelines
+        self.text_encoder = set() if text_encoder is None else text_encoder
+        self.active: list[tuple[str, float]] = []
+        self.enabled = True
+        self.loads = 0
+
+    def load_lora_weights(self, _state_dict, adapter_name):
+        assert adapter_name not in self.adapters
+        assert adapter_name not in self.text_encoder
+        self.adapters.add(adapter_name)
+        self.text_encoder.add(adapter_name)
+        self.loads += 1
+
+    def delete_adapters(self, adapter_name):
+        self.adapters.remove(adapter_name)
+        self.text_encoder.discard(adapter_name)
+
+    def set_adapters(self, names, adapter_weights):
+        assert set(names) <= self.adapters
+        self.active = list(zip(names, adapter_weights))
+
+    def enable_lora(self):
+        self.enabled = True
+
+    def disable_lora(self):
+        self.enabled = False
+
+    def to(self, _device):
+        return self
+
+
+class FakeConvertedLoRA:
+    def __init__(self, nbytes: int):
+        self.nbytes = nbytes
+
+    def load_into(self, pipe, adapter_name):
+        pipe.adapters.add(adapter_name)
+
+
+def make_pool(max_bytes=1000):
+    pipe = FakePipe()
+    # Every LoRA is 200 bytes
+    pool = AdapterPool(pipe, lambda _: {"lora_A": FakeTensor(100)}, max_bytes=max_bytes)
+    return pool, pipe
+
+
+def test_switching_between_resident_adapters_doesnt_reload():
+    pool, pipe = make_pool()
+    [a] = pool.activate([("owner/a", 1.0)])
+    [b] = pool.activate([("owner/b", 0.5)])
+    assert pool.activate([("owner/a", 0.8)]) == [a]
+
+    assert pipe.loads == 2
+    assert pipe.active == [(a, 0.8)]
+    assert a != b
+    assert pool.hits == 1
+
+
+def test_changing_extra_lora_only_loads_extra():
+    pool, pipe = make_pool()
+    main, _ = pool.activate([("owner/main", 1.0), ("owner/extra1", 1.0)])
+    names = pool.activate([("owner/main", 1.0), ("owner/extra2", 0.5)])
+
+    assert names[0] == main
+    assert pipe.loads == 3
+    assert pipe.active == [(main, 1.0), (names[1], 0.5)]
+
+
+def test_url_pointing_at_new_weights_loads_them():
+    pipe = FakePipe()
+    versions = {"owner/a": "v1"}
+    pool = AdapterPool(
+        pipe,
+        lambda _: {"lora_A": FakeTensor(100)},
+        resolve=lambda url: versions[url],
+    )
+    [old] = pool.activate([("owner/a", 1.0)])
+    assert pool.activate([("owner/a", 1.0)]) == [old]
+    versions["owner/a"] = "v2"
+    [new] = pool.activate([("owner/a", 1.0)])
+
+    assert new != old
+    assert pipe.loads == 2
+    assert pipe.active == [(new, 1.0)]
+    assert pool.resident() == ["v1", "v2"]
+
+
+def test_pools_sharing_a_text_encoder_use_distinct_names():
+    text_encoder: set[str] = set()
+    dev_pipe, schnell_pipe = FakePipe(text_encoder), FakePipe(text_encoder)
+    dev = AdapterPool(dev_pipe, lambda _: {"lora_A": FakeTensor(100)}, max_bytes=200)
+    schnell = AdapterPool(schnell_pipe, lambda _: {"lora_A": FakeTensor(100)})
+    [dev_a] = dev.activate([("owner/a", 1.0)])
+    [schnell_b] = schnell.activate([("owner/b", 1.0)])
+    assert dev_a != schnell_b
+
+    # Evicting a dev adapter leaves schnell's in the text encoder
+    [dev_c] = dev.activate([("owner/c", 1.0)])
+    assert text_encoder == {schnell_b, dev_c}
+
+
+def test_same_lora_twice_is_merged():
+    pool, pipe = make_pool()
+    [name] = pool.activate([("owner/a", 1.0), ("owner/a", 0.5)])
+    assert pipe.active == [(name, 1.5)]
+
+
+def test_least_recently_used_adapters_are_deleted():
+    pool, pipe = make_pool(max_bytes=600)
+    a, b = pool.activate([("owner/a", 1.0), ("owner/b", 1.0)])
+    pool.activate([("owner/c", 1.0)])
+    pool.activate([("owner/a", 1.0)])
+    pool.activate([("owner/d", 1.0)])
+
+    # b was the least recently used, and a was just used again
+    assert pool.resident() == ["owner/c", "owner/a", "owner/d"]
+    assert a in pipe.adapters
+    assert b not in pipe.adapters
+    assert pool.total_bytes == 600
+
+
+def test_adapters_in_use_are_not_deleted():
+    pool, pipe = make_pool(max_bytes=200)
+    names = pool.activate([("owner/a", 1.0), ("owner/b", 1.0)])
+    # Over budget, but both are needed by the request
+    assert set(names) == pipe.adapters
+
+
+def test_deactivate_keeps_adapters():
+    pool, pipe = make_pool()
+    pool.activate([("owner/a", 1.0)])
+    pool.deactivate()
+    assert not pipe.enabled
+
+    pool.activate([("owner/a", 1.0)])
+    assert pipe.enabled
+    assert pipe.loads == 1
+
+
+def test_converted_loras_are_loaded_without_the_pipeline_converter():
+    pipe = FakePipe()
+    pool = AdapterPool(pipe, lambda _: FakeConvertedLoRA(300), max_bytes=500)
+    [a] = pool.activate([("owner/a", 1.0)])
+    [b] = pool.activate([("owner/b", 1.0)])
+
+    assert pipe.loads == 0
+    assert pipe.adapters == {b}
+    assert a != b
+    assert pool.total_bytes == 300
+
+
+def test_bad_loras_are_rejected_before_anything_changes():
+    pipe = FakePipe()
+
+    def inspect(url):
+        if url == "owner/bad":
+            raise ValueError("bad LoRA")
+        return 200
+
+    pool = AdapterPool(
+        pipe, lambda _: {"lora_A": FakeTensor(100)}, max_bytes=400, inspect=inspect
+    )
+    a, b = pool.activate([("owner/a", 1.0), ("owner/b", 1.0)])
+    with pytest.raises(ValueError):
+        pool.activate([("owner/c", 1.0), ("owner/bad", 1.0)])
+
+    assert pipe.adapters == {a, b}
+    assert pipe.loads == 2
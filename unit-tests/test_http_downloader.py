@@ -0,0 +1,216 @@
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+
+sys.path.append(str(Path(__file__).parent.parent))
+from http_downloader import ParallelDownloader
+
+CONTENT = os.urandom(10 * 1000 + 123)
+CHUNK_SIZE = 1000
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """Serves CONTENT at any path, honouring single byte ranges."""
+
+    supports_ranges = True
+    # Number of GET responses to cut short after sending half of the body
+    truncate_responses = 0
+    # Number of range requests to serve before answering every other one with 404
+    ranges_before_failing: int | None = None
+    ranges_served: list[str] = []
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(CONTENT)))
+        self.send_header("ETag", '"v1"')
+        if self.supports_ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+
+    def do_GET(self):
+        body = CONTENT
+        range_header = self.headers.get("Range")
+        if self.supports_ranges and range_header:
+            if type(self).ranges_before_failing is not None:
+                if len(type(self).ranges_served) >= type(self).ranges_before_failing:
+                    self.send_error(404)
+                    return
+            start, end = map(int, re.match(r"bytes=(\d+)-(\d+)", range_header).groups())
+            body = CONTENT[start : end + 1]
+            type(self).ranges_served.append(range_header)
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(CONTENT)}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+
+        if type(self).truncate_responses > 0:
+            type(self).truncate_responses -= 1
+            self.wfile.write(body[: len(body) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    RangeHandler.supports_ranges = True
+    RangeHandler.truncate_responses = 0
+    RangeHandler.ranges_before_failing = None
+    RangeHandler.ranges_served = []
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+    thread = threading.Thread(target=httpd.serve_forever, args=(0.01,), daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}/lora.safetensors"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def downloader():
+    return ParallelDownloader(concurrency=4, chunk_size=CHUNK_SIZE)
+
+
+def test_parallel_download(server, downloader, tmp_path):
+    path = tmp_path / "lora.safetensors"
+    progress = []
+
+    digest = downloader.download(
+        server, path, on_progress=lambda done, total: progress.append((done, total))
+    )
+
+    assert path.read_bytes() == CONTENT
+    assert digest == hashlib.sha256(CONTENT).hexdigest()
+    assert len(RangeHandler.ranges_served) == 11
+    assert progress[-1] == (len(CONTENT), len(CONTENT))
+    assert not (tmp_path / "lora.safetensors.progress").exists()
+
+
+def test_download_without_ranges(server, downloader, tmp_path):
+    RangeHandler.supports_ranges = False
+    path = tmp_path / "lora.safetensors"
+
+    digest = downloader.download(server, path)
+
+    assert path.read_bytes() == CONTENT
+    assert digest == hashlib.sha256(CONTENT).hexdigest()
+
+
+def test_download_retries_interrupted_chunks(server, tmp_path):
+    RangeHandler.truncate_responses = 2
+    path = tmp_path / "lora.safetensors"
+    downloader = ParallelDownloader(concurrency=4, chunk_size=CHUNK_SIZE, read_size=100)
+
+    digest = downloader.download(server, path)
+
+    assert path.read_bytes() == CONTENT
+    assert digest == hashlib.sha256(CONTENT).hexdigest()
+    # The retries only asked for the missing half of the interrupted chunks
+    starts = [
+        int(re.match(r"bytes=(\d+)-", r).group(1)) for r in RangeHandler.ranges_served
+    ]
+    assert len([start for start in starts if start % CHUNK_SIZE != 0]) == 2
+
+
+def test_download_resumes_partial_file(server, downloader, tmp_path):
+    path = tmp_path / "lora.safetensors"
+    # An earlier attempt finished the first 4 chunks
+    path.write_bytes(CONTENT[: 4 * CHUNK_SIZE])
+    (tmp_path / "lora.safetensors.progress").write_text(
+        json.dumps({"size": len(CONTENT), "etag": '"v1"', "chunks": [0, 1, 2, 3]})
+    )
+
+    digest = downloader.download(server, path)
+
+    assert path.read_bytes() == CONTENT
+    assert digest == hashlib.sha256(CONTENT).hexdigest()
+    assert len(RangeHandler.ranges_served) == 7
+
+
+def test_download_ignores_stale_progress(server, downloader, tmp_path):
+    path = tmp_path / "lora.safetensors"
+    path.write_bytes(b"\0" * len(CONTENT))
+    (tmp_path / "lora.safetensors.progress").write_text(
+        json.dumps({"size": len(CONTENT), "etag": '"v0"', "chunks": [0, 1, 2, 3]})
+    )
+
+    downloader.download(server, path)
+
+    assert path.read_bytes() == CONTENT
+    assert len(RangeHandler.ranges_served) == 11
+
+
+def test_download_checks_sha256(server, downloader, tmp_path):
+    path = tmp_path / "lora.safetensors"
+    with pytest.raises(RuntimeError, match="SHA-256 mismatch"):
+        downloader.download(server, path, sha256="0" * 64)
+    assert not path.exists()
+
+
+def test_weights_native_backend(server, tmp_path, monkeypatch):
+    import weights
+
+    monkeypatch.setattr(weights, "DOWNLOAD_BACKEND", "pget")
+    weights.set_download_backend("native")
+    path = tmp_path / "lora.safetensors"
+
+    digest = weights.download_weights_url(server, path)
+
+    assert path.read_bytes() == CONTENT
+    assert digest == hashlib.sha256(CONTENT).hexdigest()
+    with pytest.raises(ValueError, match="Unknown download backend"):
+        weights.set_download_backend("curl")
+
+
+def test_weights_cache_resumes_failed_download(server, tmp_path, monkeypatch):
+    import weights
+
+    monkeypatch.setattr(weights, "DOWNLOAD_BACKEND", "native")
+    monkeypatch.setattr(
+        weights,
+        "_parallel_downloader",
+        ParallelDownloader(concurrency=1, chunk_size=CHUNK_SIZE),
+    )
+    base_dir = tmp_path / "weights-cache"
+    cache = weights.WeightsDownloadCache(min_disk_free=0, base_dir=base_dir)
+
+    RangeHandler.ranges_before_failing = 4
+    with pytest.raises(RuntimeError):
+        cache.ensure(server)
+    # The partial file and its progress are kept for the next attempt
+    leftovers = sorted(p.name for p in base_dir.glob(".*.partial*"))
+    assert [name.rsplit(".", 1)[1] for name in leftovers] == ["partial", "progress"]
+
+    RangeHandler.ranges_before_failing = None
+    RangeHandler.ranges_served = []
+    path = cache.ensure(server)
+
+    assert path.read_bytes() == CONTENT
+    # Only the chunks that failed were downloaded again
+    assert len(RangeHandler.ranges_served) == 7
+    assert not list(base_dir.glob(".*.partial*"))
+
+
+def test_weights_cache_removes_orphaned_progress(tmp_path):
+    import weights
+
+    base_dir = tmp_path / "weights-cache"
+    base_dir.mkdir()
+    (base_dir / ".abc.partial").write_bytes(b"x")
+    (base_dir / ".abc.partial.progress").write_text("{}")
+    (base_dir / ".def.partial.progress").write_text("{}")
+
+    weights.WeightsDownloadCache(min_disk_free=0, base_dir=base_dir)
+
+    assert not list(base_dir.glob(".*.partial*"))
@@ -0,0 +1,181 @@
+import copy
+import sys
+from pathlib import Path
+
+import pytest
+
+torch = pytest.importorskip("torch")
+peft = pytest.importorskip("peft")
+
+sys.path.append(str(Path(__file__).parent.parent))
+from lora_batching import (
+    NO_ADAPTER,
+    BatchedLoRAs,
+    check_batchable,
+    lora_row_groups,
+    reference_lora_delta,
+    segmented_lora_delta,
+)
+from lora_slots import targetable_modules
+from scheduler import MicroBatchScheduler
+
+MODULES = ["transformer_blocks.0.attn.to_q", "transformer_blocks.0.attn.to_k"]
+
+
+class Attention(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.to_q = torch.nn.Linear(8, 8)
+        self.to_k = torch.nn.Linear(8, 8)
+
+
+class Block(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.attn = Attention()
+
+    def forward(self, x):
+        return self.attn.to_k(torch.relu(self.attn.to_q(x)))
+
+
+class Transformer(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.transformer_blocks = torch.nn.ModuleList([Block()])
+
+    def forward(self, x):
+        return self.transformer_blocks[0](x)
+
+
+def make_lora(rank, seed, modules=MODULES):
+    generator = torch.Generator().manual_seed(seed)
+    state_dict = {}
+    for module in modules:
+        state_dict[f"{module}.lora_A.weight"] = torch.randn(
+            rank, 8, generator=generator
+        )
+        state_dict[f"{module}.lora_B.weight"] = torch.randn(
+            8, rank, generator=generator
+        )
+    return state_dict
+
+
+LORAS = {
+    "owner/a": (make_lora(2, 0), {f"{m}.alpha": 4.0 for m in MODULES}),
+    "owner/b": (make_lora(3, 1, modules=MODULES[:1]), None),
+}
+
+
+def peft_output(transformer, url, scale, x):
+    """The output of `transformer` with one LoRA loaded through PEFT."""
+    state_dict, network_alphas = LORAS[url]
+    rank = next(iter(state_dict.values())).shape[0]
+    alpha = next(iter(network_alphas.values())) if network_alphas else rank
+    model = copy.deepcopy(transformer)
+    modules = sorted({k.rsplit(".lora_", 1)[0] for k in state_dict})
+    config = peft.LoraConfig(r=rank, lora_alpha=alpha, target_modules=modules)
+    peft.inject_adapter_in_model(config, model, adapter_name="lora")
+    peft.set_peft_model_state_dict(model, state_dict, adapter_name="lora")
+    for module in model.modules():
+        if isinstance(module, peft.tuners.lora.LoraLayer):
+            module.set_scale("lora", scale)
+    return model(x)
+
+
+def test_batched_loras_match_peft():
+    transformer = Transformer()
+    x = torch.randn(3, 5, 8)
+    base = transformer(x)
+    expected = [
+        peft_output(transformer, "owner/a", 0.5, x[0]),
+        base[1],
+        peft_output(transformer, "owner/b", 1.0, x[2]),
+    ]
+
+    batched = BatchedLoRAs(transformer, LORAS.get, num_adapters=2, max_rank=4)
+    with torch.no_grad():
+        indices = batched.set_batch([("owner/a", 0.5), None, ("owner/b", 1.0)])
+        output = transformer(x)
+    assert indices[1] == NO_ADAPTER
+    for i in range(3):
+        torch.testing.assert_close(output[i], expected[i], atol=1e-5, rtol=1e-5)
+
+    batched.clear_batch()
+    torch.testing.assert_close(transformer(x), base)
+
+
+def test_segmented_matches_reference():
+    generator = torch.Generator().manual_seed(0)
+    x = torch.randn(6, 4, 16, generator=generator)
+    lora_a = torch.randn(3, 4, 16, generator=generator)
+    lora_b = torch.randn(3, 12, 4, generator=generator)
+    indices = [2, 0, NO_ADAPTER, 2, 1, 0]
+    scales = torch.tensor([1.0, 0.5, 0.0, 0.25, 2.0, 1.0])
+    groups = lora_row_groups(indices)
+    assert [(i, rows.tolist()) for i, rows in groups] == [
+        (2, [0, 3]),
+        (0, [1, 5]),
+        (1, [4]),
+    ]
+
+    torch.testing.assert_close(
+        segmented_lora_delta(x, groups, scales, lora_a, lora_b),
+        reference_lora_delta(x, torch.tensor(indices), scales, lora_a, lora_b),
+        atol=1e-4,
+        rtol=1e-4,
+    )
+
+
+def test_batched_loras_reuse_loaded_adapters():
+    loads = []
+
+    def load(url):
+        loads.append(url)
+        return LORAS[url]
+
+    batched = BatchedLoRAs(Transformer(), load, num_adapters=2, max_rank=4)
+    first = batched.set_batch([("owner/a", 1.0), ("owner/b", 1.0)])
+    second = batched.set_batch([("owner/b", 0.5), ("owner/a", 1.0)])
+    assert second == first[::-1]
+    assert loads == ["owner/a", "owner/b"]
+
+    with pytest.raises(ValueError, match="3 LoRAs"):
+        batched.set_batch([("owner/a", 1.0), ("owner/b", 1.0), ("owner/c", 1.0)])
+
+
+def test_check_batchable():
+    check_batchable(make_lora(4, 0), MODULES, max_rank=4)
+    with pytest.raises(ValueError, match="rank 5"):
+        check_batchable(make_lora(5, 0), MODULES, max_rank=4)
+    with pytest.raises(ValueError, match="can't be batched"):
+        check_batchable(make_lora(2, 0), MODULES[:1], max_rank=4)
+    dora = {**make_lora(2, 0), f"{MODULES[0]}.lora_magnitude_vector": torch.ones(8)}
+    with pytest.raises(ValueError, match="plain LoRA"):
+        check_batchable(dora, MODULES, max_rank=4)
+
+
+def test_bad_lora_fails_only_its_own_request():
+    transformer = Transformer()
+    target_modules = targetable_modules(transformer)
+    # owner/b has rank 3, above the batched rank
+    batched = BatchedLoRAs(transformer, LORAS.get, num_adapters=2, max_rank=2)
+
+    def run_batch(_key, loras):
+        batched.set_batch(loras)
+        return [lora[0] for lora in loras]
+
+    def submit(url):
+        # The way predict checks a request's LoRA before queueing it
+        check_batchable(LORAS[url][0], target_modules, batched.max_rank)
+        return scheduler.submit("batch", (url, 1.0))
+
+    scheduler = MicroBatchScheduler(run_batch, max_batch_size=2, max_wait=0.2)
+    good = submit("owner/a")
+    with pytest.raises(ValueError, match="rank 3"):
+        submit("owner/b")
+    assert good.result(timeout=5) == "owner/a"
+    scheduler.stop()
+
+    # Without the check, the bad LoRA fails the whole batch
+    with pytest.raises(ValueError, match="rank 3"):
+        batched.set_batch([("owner/a", 1.0), ("owner/b", 1.0)])
@@ -0,0 +1,119 @@
+import json
+import sys
+from pathlib import Path
+
+import pytest
+
+torch = pytest.importorskip("torch")
+safetensors_torch = pytest.importorskip("safetensors.torch")
+
+sys.path.append(str(Path(__file__).parent.parent))
+from lora_conversion import (
+    CONVERTED_CONFIG_SUFFIX,
+    CONVERTED_WEIGHTS_SUFFIX,
+    ConvertedLoRA,
+    ConvertedLoRACache,
+)
+from lora_memory_cache import LoRAMemoryCache
+from weights import sidecar_path
+
+
+class FakeConverter:
+    """Renames kohya-style keys to PEFT ones, counting its calls."""
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, state_dict):
+        self.calls += 1
+        transformer = {
+            k.replace("lora_down", "lora_A").replace("lora_up", "lora_B"): v
+            for k, v in state_dict.items()
+            if not k.startswith("text_encoder.")
+        }
+        return ConvertedLoRA(
+            state_dict=transformer,
+            network_alphas={"blocks.0.alpha": torch.tensor(8.0)},
+            config_kwargs={"r": 4, "lora_alpha": 8, "target_modules": ["blocks.0"]},
+            text_encoder_state_dict={
+                k: v for k, v in state_dict.items() if k.startswith("text_encoder.")
+            },
+        )
+
+
+@pytest.fixture
+def lora_path(tmp_path):
+    path = tmp_path / "abc123"
+    weight = torch.randn(8, 16)
+    safetensors_torch.save_file(
+        {
+            "blocks.0.lora_down.weight": weight[:4].clone(),
+            "blocks.0.lora_up.weight": torch.randn(16, 4),
+            "text_encoder.q.lora_A.weight": torch.randn(4, 16),
+        },
+        path,
+    )
+    return path
+
+
+def test_conversion_is_saved_next_to_the_file(lora_path):
+    convert = FakeConverter()
+    cache = ConvertedLoRACache(LoRAMemoryCache(), convert)
+    first = cache.load(lora_path)
+    second = cache.load(lora_path)
+
+    assert convert.calls == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert sidecar_path(lora_path, CONVERTED_WEIGHTS_SUFFIX).exists()
+    assert second.state_dict.keys() == first.state_dict.keys()
+    torch.testing.assert_close(
+        second.state_dict["blocks.0.lora_A.weight"],
+        first.state_dict["blocks.0.lora_A.weight"],
+    )
+    assert list(second.text_encoder_state_dict) == ["text_encoder.q.lora_A.weight"]
+    assert second.network_alphas == {"blocks.0.alpha": 8.0}
+    assert second.config_kwargs == first.config_kwargs
+    assert second.nbytes == first.nbytes
+
+
+def test_conversion_is_kept_in_memory(lora_path):
+    memory_cache = LoRAMemoryCache()
+    cache = ConvertedLoRACache(memory_cache, FakeConverter())
+    cache.load(lora_path)
+    cache.load(lora_path)
+    assert (memory_cache.hits, memory_cache.misses) == (1, 0)
+
+
+def test_warm_converts_and_loads_into_memory(lora_path):
+    memory_cache = LoRAMemoryCache()
+    convert = FakeConverter()
+    cache = ConvertedLoRACache(memory_cache, convert)
+    assert cache.warm(lora_path)
+    assert convert.calls == 1
+
+    cache.load(lora_path)
+    assert convert.calls == 1
+    assert (cache.hits, cache.misses) == (1, 0)
+    assert (memory_cache.hits, memory_cache.misses) == (1, 0)
+
+
+def test_other_conversion_versions_are_ignored(lora_path):
+    convert = FakeConverter()
+    cache = ConvertedLoRACache(LoRAMemoryCache(), convert)
+    cache.load(lora_path)
+    config_path = sidecar_path(lora_path, CONVERTED_CONFIG_SUFFIX)
+    config = json.loads(config_path.read_text())
+    config_path.write_text(json.dumps({**config, "version": 0}))
+
+    cache.load(lora_path)
+    assert convert.calls == 2
+
+
+def test_conversion_without_persist(lora_path):
+    convert = FakeConverter()
+    cache = ConvertedLoRACache(LoRAMemoryCache(), convert)
+    cache.load(lora_path, persist=False)
+    cache.load(lora_path, persist=False)
+
+    assert convert.calls == 2
+    assert list(lora_path.parent.iterdir()) == [lora_path]
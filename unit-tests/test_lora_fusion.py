@@ -0,0 +1,79 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+torch = pytest.importorskip("torch")
+peft = pytest.importorskip("peft")
+
+sys.path.append(str(Path(__file__).parent.parent))
+from lora_fusion import LoRAFuser
+
+
+class Transformer(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.to_q = torch.nn.Linear(8, 8)
+        self.to_k = torch.nn.Linear(8, 8)
+
+    def forward(self, x):
+        return self.to_k(self.to_q(x))
+
+
+@pytest.fixture
+def transformer():
+    torch.manual_seed(0)
+    model = Transformer()
+    config = peft.LoraConfig(r=2, lora_alpha=4, target_modules=["to_q"])
+    peft.inject_adapter_in_model(config, model, adapter_name="main")
+    torch.nn.init.normal_(model.to_q.lora_B["main"].weight)
+    return model
+
+
+def test_fuser_fuses_after_threshold(transformer):
+    fuser = LoRAFuser(transformer, threshold=3)
+    x = torch.randn(2, 8)
+    expected = transformer(x)
+    base_weight = transformer.to_q.base_layer.weight.clone()
+
+    assert not fuser.observe(("owner/a", 1.0))
+    assert not fuser.observe(("owner/b", 1.0))
+    assert not fuser.observe(("owner/b", 1.0))
+    assert fuser.observe(("owner/b", 1.0))
+
+    # Same output, but without going through the adapter
+    assert transformer.to_q.disable_adapters
+    assert torch.allclose(transformer(x), expected, atol=1e-5)
+    assert not torch.equal(transformer.to_q.base_layer.weight, base_weight)
+    assert fuser.observe(("owner/b", 1.0))
+    assert len(fuser.fuse_times) == 1
+
+    fuser.unfuse()
+    assert torch.equal(transformer.to_q.base_layer.weight, base_weight)
+    assert not transformer.to_q.disable_adapters
+    assert torch.allclose(transformer(x), expected, atol=1e-5)
+    assert len(fuser.unfuse_times) == 1
+
+
+def test_fuser_applies_scale(transformer):
+    fuser = LoRAFuser(transformer, threshold=1)
+    x = torch.randn(2, 8)
+    base = transformer.to_q.base_layer(x)
+    expected = transformer.to_k(base + 0.5 * (transformer.to_q(x) - base))
+
+    fuser.observe(("owner/a", 0.5), scale=0.5)
+
+    assert torch.allclose(transformer(x), expected, atol=1e-5)
+
+
+def test_fuser_key_follows_resolved_weights(transformer):
+    versions = {"owner/a": "v1"}
+    fuser = LoRAFuser(transformer, threshold=1, resolve=versions.__getitem__)
+    loras = [("owner/a", 1.0)]
+    assert fuser.observe(fuser.key(loras, None))
+    assert fuser.fused_key == fuser.key(loras, None)
+
+    # Same URL, new weights: the fused LoRA no longer matches
+    versions["owner/a"] = "v2"
+    assert fuser.fused_key != fuser.key(loras, None)
+    assert fuser.key(loras, 0.5) != fuser.key(loras, None)
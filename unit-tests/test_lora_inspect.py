@@ -0,0 +1,125 @@
+import json
+import struct
+import sys
+from math import prod
+from pathlib import Path
+
+import pytest
+
+sys.path.append(str(Path(__file__).parent.parent))
+from lora_inspect import DTYPE_SIZES, inspect_lora
+
+
+def write_safetensors(path: Path, tensors: dict, truncate: int = 0) -> Path:
+    """Write a safetensors file of zeros with the given {key: (dtype, shape)}."""
+    header = {"__metadata__": {"format": "pt"}}
+    offset = 0
+    for key, (dtype, shape) in tensors.items():
+        size = prod(shape) * DTYPE_SIZES[dtype]
+        header[key] = {
+            "dtype": dtype,
+            "shape": shape,
+            "data_offsets": [offset, offset + size],
+        }
+        offset += size
+    header_bytes = json.dumps(header).encode()
+    data = bytes(offset - truncate)
+    path.write_bytes(struct.pack("<Q", len(header_bytes)) + header_bytes + data)
+    return path
+
+
+def test_peft_lora(tmp_path):
+    path = write_safetensors(
+        tmp_path / "lora.safetensors",
+        {
+            "transformer.blocks.0.attn.to_q.lora_A.weight": ("BF16", [16, 64]),
+            "transformer.blocks.0.attn.to_q.lora_B.weight": ("BF16", [64, 16]),
+            "transformer.blocks.1.ff.lora_A.weight": ("BF16", [4, 64]),
+            "transformer.blocks.1.ff.lora_B.weight": ("BF16", [256, 4]),
+        },
+    )
+    info = inspect_lora(path)
+
+    assert info.key_format == "peft"
+    assert info.ranks == {
+        "transformer.blocks.0.attn.to_q": 16,
+        "transformer.blocks.1.ff": 4,
+    }
+    assert info.target_modules == [
+        "transformer.blocks.0.attn.to_q",
+        "transformer.blocks.1.ff",
+    ]
+    assert info.max_rank == 16
+    assert info.dtypes == {"BF16"}
+    assert info.nbytes == 2 * (16 * 64 * 2 + 4 * 64 + 256 * 4)
+    assert info.metadata == {"format": "pt"}
+
+
+def test_kohya_lora_with_alphas(tmp_path):
+    path = write_safetensors(
+        tmp_path / "lora.safetensors",
+        {
+            "lora_unet_double_blocks_0_img_attn_qkv.alpha": ("F32", []),
+            "lora_unet_double_blocks_0_img_attn_qkv.lora_down.weight": (
+                "F16",
+                [8, 32],
+            ),
+            "lora_unet_double_blocks_0_img_attn_qkv.lora_up.weight": ("F16", [96, 8]),
+        },
+    )
+    info = inspect_lora(path)
+    assert info.key_format == "kohya"
+    assert info.ranks == {"lora_unet_double_blocks_0_img_attn_qkv": 8}
+    assert info.dtypes == {"F16", "F32"}
+
+
+@pytest.mark.parametrize(
+    ("tensors", "error"),
+    [
+        ({"a.lora_A.weight": ("F16", [4, 8])}, "no up weight"),
+        ({"a.lora_B.weight": ("F16", [8, 4])}, "no down weight"),
+        (
+            {"a.lora_A.weight": ("F16", [4, 8]), "a.lora_B.weight": ("F16", [8, 2])},
+            "mismatched ranks",
+        ),
+        (
+            {"a.lora_A.weight": ("I8", [4, 8]), "a.lora_B.weight": ("I8", [8, 4])},
+            "non-float",
+        ),
+        (
+            {
+                "a.lora_A.weight": ("F16", [4, 8]),
+                "a.lora_B.weight": ("F16", [8, 4]),
+                "b.lora_down.weight": ("F16", [4, 8]),
+                "b.lora_up.weight": ("F16", [8, 4]),
+            },
+            "mixes",
+        ),
+        ({"model.weight": ("F16", [8, 8])}, "isn't part of a LoRA"),
+        ({}, "no LoRA weights"),
+    ],
+)
+def test_rejects_bad_loras(tmp_path, tensors, error):
+    path = write_safetensors(tmp_path / "lora.safetensors", tensors)
+    with pytest.raises(ValueError, match=error):
+        inspect_lora(path)
+
+
+def test_rejects_truncated_file(tmp_path):
+    path = write_safetensors(
+        tmp_path / "lora.safetensors",
+        {"a.lora_A.weight": ("F16", [4, 8]), "a.lora_B.weight": ("F16", [8, 4])},
+        truncate=1,
+    )
+    with pytest.raises(ValueError, match="past the end"):
+        inspect_lora(path)
+
+
+@pytest.mark.parametrize(
+    "content", [b"", b"\xff" * 8 + b"{}", struct.pack("<Q", 5) + b"nope!"]
+)
+def test_rejects_files_that_arent_safetensors(tmp_path, content):
+    path = tmp_path / "lora.safetensors"
+    path.write_bytes(content)
+    with pytest.raises(ValueError):
+        inspect_lora(path)
@@ -0,0 +1,100 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("safetensors")
+
+sys.path.append(str(Path(__file__).parent.parent))
+from lora_merge import MergedLoRACache, merge_loras
+
+MODULES = ["blocks.0.attn", "blocks.1.attn"]
+
+
+def make_lora(rank: int, seed: int, modules=MODULES) -> dict:
+    generator = torch.Generator().manual_seed(seed)
+    state_dict = {}
+    for module in modules:
+        state_dict[f"{module}.lora_A.weight"] = torch.randn(
+            rank, 16, generator=generator
+        )
+        state_dict[f"{module}.lora_B.weight"] = torch.randn(
+            24, rank, generator=generator
+        )
+    return state_dict
+
+
+def delta(state_dict: dict, module: str, alpha: float | None = None):
+    lora_a = state_dict[f"{module}.lora_A.weight"]
+    lora_b = state_dict[f"{module}.lora_B.weight"]
+    rank = lora_a.shape[0]
+    return lora_b @ lora_a * ((alpha or rank) / rank)
+
+
+def test_concat_is_exact():
+    first, second = make_lora(4, 0), make_lora(8, 1, modules=MODULES[:1])
+    alphas = {f"{MODULES[0]}.alpha": torch.tensor(2.0)}
+    merged = merge_loras([(first, None, 1.0), (second, alphas, 0.5)])
+
+    expected = delta(first, MODULES[0]) + 0.5 * delta(second, MODULES[0], alpha=2.0)
+    torch.testing.assert_close(delta(merged, MODULES[0]), expected)
+    # Padded to the combined rank, without changing the update
+    assert merged[f"{MODULES[1]}.lora_A.weight"].shape[0] == 12
+    torch.testing.assert_close(delta(merged, MODULES[1]), delta(first, MODULES[1]))
+
+
+def test_svd_reduces_rank():
+    first, second = make_lora(4, 0), make_lora(4, 1)
+    full = merge_loras([(first, None, 1.0), (second, None, 1.0)], method="svd", rank=8)
+    small = merge_loras([(first, None, 1.0), (second, None, 1.0)], method="svd", rank=2)
+
+    expected = delta(first, MODULES[0]) + delta(second, MODULES[0])
+    torch.testing.assert_close(delta(full, MODULES[0]), expected, rtol=1e-4, atol=1e-4)
+    assert small[f"{MODULES[0]}.lora_A.weight"].shape == (2, 16)
+    assert small[f"{MODULES[0]}.lora_B.weight"].shape == (24, 2)
+
+
+def test_svd_needs_rank():
+    with pytest.raises(ValueError):
+        merge_loras([(make_lora(4, 0), None, 1.0)], method="svd")
+
+
+def test_cache_merges_each_combination_once(tmp_path):
+    loads = []
+
+    def load(url):
+        loads.append(url)
+        return make_lora(4, len(url)), None
+
+    cache = MergedLoRACache(tmp_path, max_entries=2)
+    path = cache.ensure([("owner/a", 1.0), ("owner/b", 0.5)], load)
+    assert cache.ensure([("owner/a", 1.0), ("owner/b", 0.5)], load) == path
+    assert loads == ["owner/a", "owner/b"]
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # A different scale is a different adapter
+    assert cache.ensure([("owner/a", 1.0), ("owner/b", 1.0)], load) != path
+
+
+def test_cache_merges_again_when_a_url_moves(tmp_path):
+    versions = {"owner/a": "v1", "owner/b": "v1"}
+    cache = MergedLoRACache(tmp_path, resolve=lambda url: f"{url}@{versions[url]}")
+    loras = [("owner/a", 1.0), ("owner/b", 0.5)]
+    path = cache.ensure(loras, lambda _: (make_lora(4, 0), None))
+    versions["owner/b"] = "v2"
+    assert cache.ensure(loras, lambda _: (make_lora(4, 0), None)) != path
+    assert (cache.hits, cache.misses) == (0, 2)
+
+
+def test_cache_removes_oldest_entries(tmp_path):
+    cache = MergedLoRACache(tmp_path, max_entries=2)
+    paths = [
+        cache.ensure(
+            [("owner/a", 1.0), ("owner/b", scale)], lambda _: (make_lora(4, 0), None)
+        )
+        for scale in (0.25, 0.5, 0.75)
+    ]
+    assert not paths[0].exists()
+    assert paths[1].exists()
+    assert paths[2].exists()
@@ -0,0 +1,178 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("peft")
+
+sys.path.append(str(Path(__file__).parent.parent))
+from lora_slots import LoRASlots
+
+
+class Attention(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.to_q = torch.nn.Linear(8, 8, bias=False)
+        self.to_k = torch.nn.Linear(8, 8, bias=False)
+
+
+class Block(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.attn = Attention()
+
+    def forward(self, x):
+        return self.attn.to_k(self.attn.to_q(x))
+
+
+class Transformer(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.transformer_blocks = torch.nn.ModuleList([Block()])
+
+    def forward(self, x):
+        return self.transformer_blocks[0](x)
+
+
+def make_lora(rank, seed):
+    generator = torch.Generator().manual_seed(seed)
+    return {
+        "transformer_blocks.0.attn.to_q.lora_A.weight": torch.randn(
+            rank, 8, generator=generator
+        ),
+        "transformer_blocks.0.attn.to_q.lora_B.weight": torch.randn(
+            8, rank, generator=generator
+        ),
+    }
+
+
+def reference(transformer, lora, alpha, scale, x):
+    """The output of `transformer` with `lora` merged in, computed by hand."""
+    to_q = transformer.transformer_blocks[0].attn.to_q.base_layer.weight
+    to_k = transformer.transformer_blocks[0].attn.to_k.base_layer.weight
+    delta = (
+        lora["transformer_blocks.0.attn.to_q.lora_B.weight"]
+        @ lora["transformer_blocks.0.attn.to_q.lora_A.weight"]
+    )
+    rank = lora["transformer_blocks.0.attn.to_q.lora_A.weight"].shape[0]
+    q = x @ (to_q + scale * alpha / rank * delta).T
+    return q @ to_k.T
+
+
+@pytest.fixture
+def loras():
+    return {
+        "owner/a": (make_lora(2, 0), {"transformer_blocks.0.attn.to_q.alpha": 4.0}),
+        "owner/b": (make_lora(3, 1), None),
+        "owner/big": (make_lora(16, 2), None),
+    }
+
+
+def test_lora_slots_copy_lora_in_place(loras):
+    transformer = Transformer()
+    loads = []
+
+    def load(url):
+        loads.append(url)
+        return loras[url]
+
+    slots = LoRASlots(transformer, load, num_slots=2, max_rank=4)
+    parameters = [p.data_ptr() for p in transformer.parameters()]
+    x = torch.randn(1, 8)
+
+    slots.activate([("owner/a", 0.5)])
+    lora_a = loras["owner/a"][0]
+    assert torch.allclose(
+        transformer(x), reference(transformer, lora_a, 4.0, 0.5, x), atol=1e-5
+    )
+
+    slots.activate([("owner/b", 1.0)])
+    lora_b = loras["owner/b"][0]
+    assert torch.allclose(
+        transformer(x), reference(transformer, lora_b, 3.0, 1.0, x), atol=1e-5
+    )
+
+    # Both stay in their slots, and nothing was reallocated
+    slots.activate([("owner/a", 1.0)])
+    assert loads == ["owner/a", "owner/b"]
+    assert [p.data_ptr() for p in transformer.parameters()] == parameters
+
+    slots.deactivate()
+    assert torch.allclose(
+        transformer(x), reference(transformer, lora_a, 4.0, 0.0, x), atol=1e-5
+    )
+
+
+def test_lora_slots_reject_rank_above_max(loras):
+    slots = LoRASlots(Transformer(), loras.get, num_slots=2, max_rank=4)
+    with pytest.raises(ValueError, match="rank 16"):
+        slots.activate([("owner/big", 1.0)])
+    with pytest.raises(ValueError, match="3 LoRAs"):
+        slots.activate([("owner/a", 1.0), ("owner/b", 1.0), ("owner/big", 1.0)])
+
+
+def test_lora_slots_activate_staged_lora(loras):
+    transformer = Transformer()
+    loads = []
+
+    def load(url):
+        loads.append(url)
+        return loras[url]
+
+    slots = LoRASlots(transformer, load, num_slots=2, max_rank=4)
+    x = torch.randn(1, 8)
+    slots.activate([("owner/a", 1.0)])
+    slots.stage("owner/b")
+    # Already in a slot, so there is nothing to stage
+    slots.stage("owner/a")
+
+    slots.activate([("owner/b", 0.5)])
+    lora_b = loras["owner/b"][0]
+    assert torch.allclose(
+        transformer(x), reference(transformer, lora_b, 3.0, 0.5, x), atol=1e-5
+    )
+    assert loads == ["owner/a", "owner/b"]
+    assert slots.staged_hits == 1
+
+
+def test_lora_slots_load_again_if_staging_failed(loras):
+    attempts = []
+
+    def load(url):
+        attempts.append(url)
+        if len(attempts) == 1:
+            raise OSError("download failed")
+        return loras[url]
+
+    slots = LoRASlots(Transformer(), load, num_slots=2, max_rank=4)
+    slots.stage("owner/a")
+    slots.activate([("owner/a", 1.0)])
+    assert attempts == ["owner/a", "owner/a"]
+    assert slots.staged_hits == 0
+
+
+def test_lora_slots_load_new_weights_of_a_url(loras):
+    transformer = Transformer()
+    versions = {"owner/a": "v1"}
+    served = {"owner/a": loras["owner/a"]}
+    slots = LoRASlots(
+        transformer,
+        lambda url: served[url],
+        num_slots=2,
+        max_rank=4,
+        resolve=lambda url: versions[url],
+    )
+    x = torch.randn(1, 8)
+    slots.activate([("owner/a", 1.0)])
+
+    # The URL now points at other weights
+    versions["owner/a"] = "v2"
+    served["owner/a"] = loras["owner/b"]
+    slots.activate([("owner/a", 1.0)])
+
+    lora_b = loras["owner/b"][0]
+    assert torch.allclose(
+        transformer(x), reference(transformer, lora_b, 3.0, 1.0, x), atol=1e-5
+    )
+    assert slots.misses == 2
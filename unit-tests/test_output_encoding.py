@@ -0,0 +1,83 @@
+import io
+import sys
+from pathlib import Path
+
+import pytest
+
+Image = pytest.importorskip("PIL.Image")
+
+sys.path.append(str(Path(__file__).parent.parent))
+from output_encoding import ENCODE_PRESETS, ImageEncoder
+
+
+def make_image(seed: int) -> "Image.Image":
+    # A gradient with some texture, so compression settings make a difference
+    image = Image.new("RGB", (64, 48))
+    image.putdata(
+        [
+            ((x * 4 + seed) % 256, (y * 5) % 256, (x * y + seed) % 256)
+            for y in range(48)
+            for x in range(64)
+        ]
+    )
+    return image
+
+
+@pytest.mark.parametrize("output_format", ["webp", "jpg", "png"])
+def test_encode_to_files(tmp_path, output_format):
+    encoder = ImageEncoder()
+    images = [(0, make_image(0)), (2, make_image(1))]
+    encoded = encoder.encode(images, output_format, quality=90, output_dir=tmp_path)
+    encoder.shutdown()
+
+    assert [e.index for e in encoded] == [0, 2]
+    for e in encoded:
+        assert e.path == tmp_path / f"out-{e.index}.{output_format}"
+        assert e.data is None
+        assert e.nbytes == e.path.stat().st_size
+        assert e.seconds >= 0
+        with Image.open(e.path) as decoded:
+            assert decoded.size == (64, 48)
+    assert encoder.images == 2
+    assert encoder.total_bytes == sum(e.nbytes for e in encoded)
+
+
+def test_encode_in_memory():
+    encoder = ImageEncoder()
+    (encoded,) = encoder.encode([(0, make_image(0))], "png", quality=90)
+    encoder.shutdown()
+
+    assert encoded.path is None
+    assert encoded.data is not None
+    assert encoded.nbytes == len(encoded.data)
+
+
+def test_png_is_lossless_in_every_preset():
+    image = make_image(3)
+    for preset in ENCODE_PRESETS:
+        encoder = ImageEncoder(preset)
+        (encoded,) = encoder.encode([(0, image)], "png", quality=90)
+        encoder.shutdown()
+        assert encoded.data is not None
+        with Image.open(io.BytesIO(encoded.data)) as decoded:
+            assert list(decoded.convert("RGB").getdata()) == list(image.getdata())
+
+
+def test_small_preset_is_not_bigger_than_fast():
+    image = make_image(5)
+    sizes = {}
+    for preset in ["fast", "small"]:
+        encoder = ImageEncoder(preset)
+        (encoded,) = encoder.encode([(0, image)], "png", quality=90)
+        encoder.shutdown()
+        sizes[preset] = encoded.nbytes
+    assert sizes["small"] <= sizes["fast"]
+
+
+def test_unknown_preset_and_format():
+    with pytest.raises(ValueError):
+        ImageEncoder("tiny")
+    encoder = ImageEncoder()
+    with pytest.raises(ValueError):
+        encoder.encode([(0, make_image(0))], "gif", quality=90)
+    encoder.shutdown()
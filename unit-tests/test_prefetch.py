@@ -0,0 +1,113 @@
+import sys
+import threading
+import time
+from pathlib import Path
+from unittest.mock import MagicMock
+
+import pytest
+
+sys.path.append(str(Path(__file__).parent.parent))
+from prefetch import AccessHistory, Prefetcher, read_warm_list
+from weights import DownloadProbe, WeightsDownloadCache
+
+
+@pytest.fixture
+def mock_download(monkeypatch):
+    download = MagicMock(side_effect=write_fake_weights)
+    monkeypatch.setattr("weights.download_weights_url", download)
+    monkeypatch.setattr(
+        "weights.probe_download",
+        MagicMock(side_effect=lambda url, **_: DownloadProbe(url=url, size=100)),
+    )
+    return download
+
+
+def write_fake_weights(url, path):
+    path.write_bytes(url.encode().ljust(100, b"x"))
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return WeightsDownloadCache(
+        min_disk_free=0, base_dir=tmp_path / "weights-cache", max_bytes=250
+    )
+
+
+def test_access_history_ranks_by_frequency_and_recency(tmp_path):
+    history = AccessHistory(tmp_path / "history.json", half_life=60)
+    for _ in range(3):
+        history.record("https://example.com/popular.safetensors")
+    history.record("https://example.com/rare.safetensors")
+    assert history.hottest(1) == ["https://example.com/popular.safetensors"]
+
+    # Restored from disk, and old accesses fade
+    restarted = AccessHistory(tmp_path / "history.json", half_life=1e-3)
+    time.sleep(0.01)
+    restarted.record("https://example.com/new.safetensors")
+    assert restarted.hottest(3)[0] == "https://example.com/new.safetensors"
+
+
+def test_access_history_forgets_coldest(tmp_path):
+    history = AccessHistory(tmp_path / "history.json", max_urls=2)
+    history.record("https://example.com/a.safetensors")
+    history.record("https://example.com/a.safetensors")
+    history.record("https://example.com/b.safetensors")
+    history.record("https://example.com/c.safetensors")
+    assert "https://example.com/a.safetensors" in history.hottest(2)
+    assert len(history.hottest(10)) == 2
+
+
+@pytest.mark.usefixtures("mock_download")
+def test_prefetcher_warms_hottest_urls_within_budget(cache, tmp_path):
+    history = AccessHistory(tmp_path / "history.json")
+    for i, count in enumerate([3, 2, 1]):
+        for _ in range(count):
+            history.record(f"https://example.com/weights{i}.safetensors")
+    warm = MagicMock()
+    prefetcher = Prefetcher(cache, history, warm=warm)
+
+    prefetched = prefetcher.run_once()
+
+    # The third doesn't fit in the 250 byte budget without evicting the others
+    assert prefetched == [
+        "https://example.com/weights0.safetensors",
+        "https://example.com/weights1.safetensors",
+    ]
+    assert warm.call_count == 2
+    assert cache.prefetched == 2
+    assert not cache.contains("https://example.com/weights2.safetensors")
+
+
+def test_prefetcher_warm_list_comes_first(cache, mock_download, tmp_path):
+    warm_list_path = tmp_path / "warm.txt"
+    warm_list_path.write_text(
+        "# Popular LoRAs\nhttps://example.com/listed.safetensors\n\n"
+    )
+    history = AccessHistory(tmp_path / "history.json")
+    history.record("https://example.com/hot.safetensors")
+    prefetcher = Prefetcher(cache, history)
+
+    prefetcher.start(read_warm_list(warm_list_path))
+    deadline = time.time() + 5
+    while mock_download.call_count < 2 and time.time() < deadline:
+        time.sleep(0.01)
+    prefetcher.stop()
+
+    assert [c.args[0] for c in mock_download.call_args_list] == [
+        "https://example.com/listed.safetensors",
+        "https://example.com/hot.safetensors",
+    ]
+
+
+def test_prefetcher_waits_for_foreground(cache, mock_download, tmp_path):
+    history = AccessHistory(tmp_path / "history.json")
+    history.record("https://example.com/weights1.safetensors")
+    prefetcher = Prefetcher(cache, history)
+
+    with prefetcher.foreground():
+        thread = threading.Thread(target=prefetcher.run_once)
+        thread.start()
+        time.sleep(0.1)
+        assert mock_download.call_count == 0
+    thread.join()
+    assert mock_download.call_count == 1
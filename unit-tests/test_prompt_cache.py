@@ -0,0 +1,55 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+sys.path.append(str(Path(__file__).parent.parent))
+from prompt_cache import PromptEmbeddingCache
+
+
+def make_encoder(calls):
+    def encode(prompt):
+        def run():
+            calls.append(prompt)
+            # A T5-like sequence and a pooled CLIP-like vector, 4 bytes per element
+            return torch.full((1, 8, 4), float(len(prompt))), torch.ones(1, 4)
+
+        return run
+
+    return encode
+
+
+def test_prompt_cache_encodes_each_prompt_once():
+    calls = []
+    encode = make_encoder(calls)
+    cache = PromptEmbeddingCache()
+    first = cache.get(("a cat", 512), encode("a cat"))
+    embeds, pooled = cache.get(("a cat", 512), encode("a cat"), batch_size=3)
+
+    assert calls == ["a cat"]
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert embeds.shape == (3, 8, 4)
+    assert pooled.shape == (3, 4)
+    assert torch.equal(embeds[2], first[0][0])
+
+    # Another sequence length is another entry
+    cache.get(("a cat", 256), encode("a cat"))
+    assert calls == ["a cat", "a cat"]
+
+
+def test_prompt_cache_evicts_least_recently_used():
+    calls = []
+    encode = make_encoder(calls)
+    # Each entry takes (32 + 4) * 4 bytes
+    cache = PromptEmbeddingCache(max_bytes=2 * 144)
+    cache.get("a", encode("a"))
+    cache.get("b", encode("b"))
+    cache.get("a", encode("a"))
+    cache.get("c", encode("c"))
+    assert cache.total_bytes == 288
+
+    cache.get("a", encode("a"))
+    cache.get("b", encode("b"))
+    assert calls == ["a", "b", "c", "b"]
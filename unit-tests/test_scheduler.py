@@ -0,0 +1,113 @@
+import sys
+import threading
+from pathlib import Path
+
+import pytest
+
+sys.path.append(str(Path(__file__).parent.parent))
+from scheduler import MicroBatchScheduler
+
+
+class Recorder:
+    """A run_batch that records its batches and can be held back."""
+
+    def __init__(self):
+        self.batches = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+
+    def __call__(self, key, items):
+        self.started.set()
+        self.release.wait(timeout=5)
+        self.batches.append((key, items))
+        if "fail" in items:
+            raise ValueError("batch failed")
+        return [f"{key}:{item}" for item in items]
+
+
+def test_compatible_items_share_a_batch():
+    run = Recorder()
+    scheduler = MicroBatchScheduler(run, max_batch_size=4, max_wait=5)
+    futures = [scheduler.submit("schnell", i) for i in range(4)]
+
+    # The batch is full, so it runs without waiting for max_wait
+    assert [f.result(timeout=5) for f in futures] == [f"schnell:{i}" for i in range(4)]
+    assert run.batches == [("schnell", [0, 1, 2, 3])]
+    scheduler.stop()
+
+
+def test_batches_split_by_key_and_size():
+    run = Recorder()
+    run.release.clear()
+    scheduler = MicroBatchScheduler(run, max_batch_size=4, max_wait=0)
+    # Held back, so everything below is queued behind it
+    first = scheduler.submit("dev", "first")
+    run.started.wait(timeout=5)
+    futures = [
+        scheduler.submit("dev", "a", size=2),
+        scheduler.submit("schnell", "b"),
+        scheduler.submit("dev", "c", size=2),
+        scheduler.submit("dev", "d", size=1),
+    ]
+    run.release.set()
+    first.result(timeout=5)
+    assert [f.result(timeout=5) for f in futures] == [
+        "dev:a",
+        "schnell:b",
+        "dev:c",
+        "dev:d",
+    ]
+
+    # The oldest item picks the key, and items join in order while they fit
+    assert run.batches[1:] == [
+        ("dev", ["a", "c"]),
+        ("schnell", ["b"]),
+        ("dev", ["d"]),
+    ]
+    scheduler.stop()
+
+
+def test_pending_lists_queued_items():
+    run = Recorder()
+    run.release.clear()
+    scheduler = MicroBatchScheduler(run, max_batch_size=4, max_wait=0)
+    running = scheduler.submit("dev", "running")
+    run.started.wait(timeout=5)
+    queued = [scheduler.submit("dev", "a"), scheduler.submit("schnell", "b")]
+
+    # The running batch isn't pending anymore
+    assert scheduler.pending() == ["a", "b"]
+    run.release.set()
+    for future in [running, *queued]:
+        future.result(timeout=5)
+    assert scheduler.pending() == []
+    scheduler.stop()
+
+
+def test_max_wait_flushes_partial_batches():
+    run = Recorder()
+    scheduler = MicroBatchScheduler(run, max_batch_size=4, max_wait=0.05)
+    assert scheduler.submit("dev", "alone").result(timeout=5) == "dev:alone"
+    assert run.batches == [("dev", ["alone"])]
+    scheduler.stop()
+
+
+def test_failed_batch_fails_every_item():
+    run = Recorder()
+    run.release.clear()
+    scheduler = MicroBatchScheduler(run, max_batch_size=4, max_wait=0)
+    blocker = scheduler.submit("dev", "blocker")
+    run.started.wait(timeout=5)
+    futures = [scheduler.submit("dev", "ok"), scheduler.submit("dev", "fail")]
+    run.release.set()
+    blocker.result(timeout=5)
+    for future in futures:
+        with pytest.raises(ValueError, match="batch failed"):
+            future.result(timeout=5)
+
+    # The scheduler keeps going
+    assert scheduler.submit("dev", "next").result(timeout=5) == "dev:next"
+    scheduler.stop()
+    with pytest.raises(RuntimeError):
+        scheduler.submit("dev", "late")
@@ -0,0 +1,57 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("numpy")
+Image = pytest.importorskip("PIL.Image")
+
+sys.path.append(str(Path(__file__).parent.parent))
+from sequence_buckets import (
+    DEFAULT_SEQUENCE_BUCKETS,
+    SequenceBucketStats,
+    bucket_length,
+    image_psnr,
+    parse_buckets,
+)
+
+
+@pytest.mark.parametrize(
+    ("num_tokens", "max_length", "expected"),
+    [
+        (12, 512, 64),
+        (64, 512, 64),
+        (65, 512, 128),
+        (300, 512, 512),
+        (300, 256, 256),
+        (900, 512, 512),
+    ],
+)
+def test_bucket_length(num_tokens, max_length, expected):
+    assert bucket_length(num_tokens, DEFAULT_SEQUENCE_BUCKETS, max_length) == expected
+
+
+def test_parse_buckets():
+    assert parse_buckets("256,64,128") == (64, 128, 256)
+    for value in ["", "64,abc", "0,64"]:
+        with pytest.raises(ValueError):
+            parse_buckets(value)
+
+
+def test_stats():
+    stats = SequenceBucketStats()
+    stats.record(512, 64)
+    stats.record(256, 128)
+    stats.record_guard(32.5)
+    stats.record_guard(40.0)
+    assert stats.tokens_saved == 576
+    assert stats.min_psnr == 32.5
+    assert "tokens_saved=576" in stats.summary()
+
+
+def test_image_psnr():
+    image = Image.new("RGB", (4, 4), (100, 100, 100))
+    assert image_psnr(image, image) == float("inf")
+    # Every pixel off by 1 gives an MSE of 1
+    other = Image.new("RGB", (4, 4), (101, 101, 101))
+    assert image_psnr(image, other) == pytest.approx(48.13, abs=0.01)
@@ -0,0 +1,130 @@
+import sys
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+sys.path.append(str(Path(__file__).parent.parent))
+from startup import StartupGraph
+
+
+def test_startup_graph_passes_results_to_dependents():
+    graph = StartupGraph()
+    graph.add("download", lambda: "files")
+    graph.add("load", lambda files: f"model from {files}", deps=["download"])
+    graph.add("to_cuda", lambda model: f"{model} on cuda", deps=["load"])
+
+    results = graph.run()
+
+    assert results["to_cuda"] == "model from files on cuda"
+    assert [entry.name for entry in graph.timeline] == ["download", "load", "to_cuda"]
+    assert "to_cuda" in graph.format_timeline()
+
+
+def test_startup_graph_runs_independent_steps_in_parallel():
+    barrier = threading.Barrier(3, timeout=5)
+    graph = StartupGraph()
+    for name in ["safety", "falcon", "dev"]:
+        # Deadlocks unless all three run at the same time
+        graph.add(f"download_{name}", barrier.wait)
+
+    graph.run()
+
+    assert len(graph.timeline) == 3
+
+
+def test_startup_graph_serializes_steps_sharing_a_resource():
+    active = []
+    overlaps = []
+
+    def copy():
+        active.append(1)
+        overlaps.append(len(active))
+        time.sleep(0.05)
+        active.pop()
+
+    graph = StartupGraph()
+    graph.add("dev_to_cuda", copy, resource="gpu")
+    graph.add("schnell_to_cuda", copy, resource="gpu")
+    graph.add("load_falcon", lambda: time.sleep(0.05))
+
+    graph.run()
+
+    assert overlaps == [1, 1]
+    assert max(entry.waited for entry in graph.timeline) > 0.02
+
+
+def test_startup_graph_raises_first_error():
+    ran = []
+    graph = StartupGraph()
+
+    def fail():
+        raise RuntimeError("download failed")
+
+    graph.add("download", fail)
+    graph.add("load", ran.append, deps=["download"])
+
+    with pytest.raises(RuntimeError, match="download failed"):
+        graph.run()
+    assert ran == []
+
+
+def test_startup_graph_rejects_bad_dependencies():
+    graph = StartupGraph()
+    graph.add("a", lambda _: None, deps=["b"])
+    graph.add("b", lambda _: None, deps=["a"])
+    with pytest.raises(ValueError, match="cycle"):
+        graph.run()
+
+    graph = StartupGraph()
+    graph.add("a", lambda _: None, deps=["missing"])
+    with pytest.raises(ValueError, match="unknown missing"):
+        graph.run()
+
+
+def test_startup_graph_materializes_lazy_steps_once():
+    calls = []
+    started = threading.Event()
+
+    def load_schnell(dev):
+        calls.append("schnell")
+        started.wait(5)
+        return f"schnell sharing {dev}"
+
+    graph = StartupGraph()
+    graph.add("dev", lambda: "dev")
+    graph.add("schnell", load_schnell, deps=["dev"])
+    graph.add("falcon", lambda: calls.append("falcon"))
+
+    graph.run(["dev"])
+    assert "schnell" not in graph.results
+
+    # Concurrent callers share a single run of the step
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(graph.get("schnell")))
+        for _ in range(3)
+    ]
+    for thread in threads:
+        thread.start()
+    started.set()
+    for thread in threads:
+        thread.join()
+
+    assert results == ["schnell sharing dev"] * 3
+    assert calls == ["schnell"]
+
+
+def test_startup_graph_warm_up():
+    graph = StartupGraph()
+    graph.add("falcon", lambda: "falcon")
+    graph.add("broken", lambda: 1 / 0)
+
+    graph.warm_up(["falcon"]).join()
+    assert graph.results == {"falcon": "falcon"}
+
+    # Failures are reported, and left for `get` to retry
+    graph.warm_up(["broken"]).join()
+    with pytest.raises(ZeroDivisionError):
+        graph.get("broken")
@@ -1,4 +1,10 @@
+import base64
+import io
+import os
 import sys
+import tarfile
+import threading
+import time
 from pathlib import Path
 from unittest.mock import MagicMock, patch
 
@@ -6,7 +12,16 @@ import pytest
 import requests_mock
 
 sys.path.append(str(Path(__file__).parent.parent))
-from weights import WeightsDownloadCache, make_download_url
+from weights import (
+    DownloadProbe,
+    URLResolver,
+    WeightsDownloadCache,
+    download_data_url,
+    download_safetensors_tarball,
+    make_download_url,
+    probe_download,
+    sidecar_path,
+)
 
 
 def test_replicate_model_url():
@@ -139,23 +154,37 @@ def cache(mock_base_dir):
     return WeightsDownloadCache(min_disk_free=1000, base_dir=mock_base_dir)
 
 
-@patch("weights.download_weights")
+@pytest.fixture
+def mock_download(monkeypatch):
+    # Every download writes a distinct 100 byte file, and announces that size up front
+    download = MagicMock(side_effect=write_fake_weights)
+    monkeypatch.setattr("weights.download_weights_url", download)
+    monkeypatch.setattr(
+        "weights.probe_download",
+        MagicMock(side_effect=lambda url, **_: DownloadProbe(url=url, size=100)),
+    )
+    return download
+
+
+def write_fake_weights(url, path):
+    path.write_bytes(url.encode().ljust(100, b"x"))
+
+
 @patch("shutil.disk_usage")
-@patch("pathlib.Path.unlink")
-def test_weights_download_cache(
-    mock_unlink, mock_disk_usage, mock_download_weights, cache, mock_base_dir
-):
+def test_weights_download_cache(mock_disk_usage, mock_download, cache, mock_base_dir):
     # Setup
-    disk_space = [1500, 1000, 500, 1000]  # Simulate changing disk space
+    disk_space = [1500, 1500, 1050]  # Simulate changing disk space
     mock_disk_usage.side_effect = [MagicMock(free=space) for space in disk_space]
 
     # Test ensure method
-    url1 = "https://example.com/weights1.tar"
-    url2 = "https://example.com/weights2.tar"
+    url1 = "https://example.com/weights1.safetensors"
+    url2 = "https://example.com/weights2.safetensors"
 
     # First call should download
     path1 = cache.ensure(url1)
-    mock_download_weights.assert_called_once_with(url1, path1)
+    mock_download.assert_called_once()
+    assert mock_download.call_args.args[0] == url1
+    assert path1.read_bytes() == url1.encode().ljust(100, b"x")
     assert path1.parent == mock_base_dir
     assert cache.hits == 0
     assert cache.misses == 1
@@ -166,15 +195,19 @@ def test_weights_download_cache(
     assert cache.misses == 1
 
     # Call with new URL should download again
-    _ = cache.ensure(url2)
-    assert mock_download_weights.call_count == 2
+    path2 = cache.ensure(url2)
+    assert mock_download.call_count == 2
     assert cache.hits == 1
     assert cache.misses == 2
 
-    # Test LRU behavior
-    url3 = "https://example.com/weights3.tar"
-    cache.ensure(url3)
-    mock_unlink.assert_called_once_with()  # Check that unlink was called
+    # Test LRU behavior: 1050 free - 100 incoming < 1000, so url1 gets evicted
+    url3 = "https://example.com/weights3.safetensors"
+    path3 = cache.ensure(url3)
+    assert not path1.exists()
+    assert list(cache.lru_entries) == [path2, path3]
+    assert cache.total_bytes == 200
+    # The disk is only queried once per download
+    assert mock_disk_usage.call_count == 3
 
     # Test cache_info
     info = cache.cache_info()
@@ -183,7 +216,435 @@ def test_weights_download_cache(
     assert str(mock_base_dir) in info
 
 
+@pytest.mark.usefixtures("mock_download")
+def test_weights_download_cache_max_bytes(mock_base_dir):
+    cache = WeightsDownloadCache(min_disk_free=0, base_dir=mock_base_dir, max_bytes=250)
+    paths = [
+        cache.ensure(f"https://example.com/weights{i}.safetensors") for i in range(3)
+    ]
+
+    assert list(cache.lru_entries) == paths[1:]
+    assert cache.total_bytes == 200
+
+    # Touching an entry protects it from the next eviction
+    cache.ensure("https://example.com/weights1.safetensors")
+    path3 = cache.ensure("https://example.com/weights3.safetensors")
+    assert list(cache.lru_entries) == [paths[1], path3]
+
+
+@pytest.mark.usefixtures("mock_download")
+def test_weights_download_cache_removes_sidecars(mock_base_dir):
+    cache = WeightsDownloadCache(min_disk_free=0, base_dir=mock_base_dir, max_bytes=150)
+    path1 = cache.ensure("https://example.com/weights1.safetensors")
+    sidecar = sidecar_path(path1, "json")
+    sidecar.write_text("{}")
+
+    # Sidecars aren't entries of their own
+    cache = WeightsDownloadCache(min_disk_free=0, base_dir=mock_base_dir, max_bytes=150)
+    assert list(cache.lru_entries) == [path1]
+
+    cache.ensure("https://example.com/weights2.safetensors")
+    assert not path1.exists()
+    assert not sidecar.exists()
+
+
+@pytest.mark.usefixtures("mock_download")
+def test_weights_download_cache_unknown_size(monkeypatch, mock_base_dir):
+    monkeypatch.setattr("weights.probe_download", DownloadProbe)
+    cache = WeightsDownloadCache(min_disk_free=0, base_dir=mock_base_dir, max_bytes=150)
+    cache.ensure("https://example.com/weights1.safetensors")
+    path2 = cache.ensure("https://example.com/weights2.safetensors")
+
+    # Without a size hint the budget is enforced after the download
+    assert list(cache.lru_entries) == [path2]
+    assert cache.total_bytes == 100
+
+
+def test_probe_download():
+    with requests_mock.Mocker() as m:
+        m.head(
+            "https://example.com/model.safetensors",
+            headers={"Content-Length": "1234", "ETag": '"abc"'},
+        )
+        m.head("https://example.com/missing.safetensors", status_code=404)
+        assert probe_download("https://example.com/model.safetensors") == DownloadProbe(
+            url="https://example.com/model.safetensors", size=1234, etag='"abc"'
+        )
+        assert probe_download("https://example.com/missing.safetensors").size is None
+    assert probe_download("data:application/x-tar;base64,AAAA").size == 3
+
+
 def test_weights_download_cache_initialization(mock_base_dir):
     cache = WeightsDownloadCache(base_dir=mock_base_dir)
     assert cache.base_dir == mock_base_dir
     assert mock_base_dir.exists()
+
+
+def test_weights_download_cache_restores_index(mock_download, mock_base_dir):
+    cache = WeightsDownloadCache(min_disk_free=0, base_dir=mock_base_dir)
+    path1 = cache.ensure("https://example.com/weights1.safetensors")
+    path2 = cache.ensure("https://example.com/weights2.safetensors")
+    cache.ensure("https://example.com/weights1.safetensors")
+    mock_download.reset_mock()
+
+    # A new instance, as after a container restart, picks up the existing files
+    restarted = WeightsDownloadCache(min_disk_free=0, base_dir=mock_base_dir)
+    assert list(restarted.lru_entries) == [path2, path1]
+    assert restarted.total_bytes == 200
+
+    restarted.ensure("https://example.com/weights1.safetensors")
+    mock_download.assert_not_called()
+    assert restarted.hits == 1
+    assert restarted.misses == 0
+
+
+def test_weights_download_cache_adopts_files_without_journal(mock_base_dir):
+    mock_base_dir.mkdir(parents=True)
+    old = mock_base_dir / "0123456789abcdef"
+    new = mock_base_dir / "fedcba9876543210"
+    empty = mock_base_dir / "00000000deadbeef"
+    old.write_bytes(b"old")
+    new.write_bytes(b"new")
+    empty.touch()
+    os.utime(old, (1000, 1000))
+    os.utime(new, (2000, 2000))
+
+    cache = WeightsDownloadCache(min_disk_free=0, base_dir=mock_base_dir)
+
+    assert list(cache.lru_entries) == [old, new]
+    assert cache.total_bytes == 6
+    assert not empty.exists()
+    assert (mock_base_dir / ".journal").exists()
+
+
+def test_weights_download_cache_failed_download(mock_download, mock_base_dir):
+    cache = WeightsDownloadCache(min_disk_free=0, base_dir=mock_base_dir)
+    url = "https://example.com/weights1.safetensors"
+
+    def failing_download(_, path):
+        path.write_bytes(b"trunc")
+        raise RuntimeError("Failed to download safetensors file")
+
+    mock_download.side_effect = failing_download
+    with pytest.raises(RuntimeError, match="Failed to download"):
+        cache.ensure(url)
+    assert len(cache.lru_entries) == 0
+    assert list(mock_base_dir.iterdir()) == [mock_base_dir / ".journal"]
+
+    # The failure is not remembered, so the next call retries
+    mock_download.side_effect = write_fake_weights
+    path = cache.ensure(url)
+    assert path.read_bytes() == url.encode().ljust(100, b"x")
+    assert cache.misses == 2
+
+
+def test_weights_download_cache_single_flight(mock_download, mock_base_dir):
+    cache = WeightsDownloadCache(min_disk_free=0, base_dir=mock_base_dir)
+    url = "https://example.com/weights1.safetensors"
+    release = threading.Event()
+
+    def slow_download(url, path):
+        release.wait(timeout=5)
+        write_fake_weights(url, path)
+
+    mock_download.side_effect = slow_download
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(cache.ensure(url)))
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    while cache.misses + cache.coalesced < 4:
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert mock_download.call_count == 1
+    assert len(set(results)) == 1
+    assert len(results) == 4
+    assert cache.misses == 1
+    assert cache.coalesced == 3
+
+
+def test_weights_download_cache_download_limit(mock_download, mock_base_dir):
+    cache = WeightsDownloadCache(
+        min_disk_free=0, base_dir=mock_base_dir, max_concurrent_downloads=2
+    )
+    lock = threading.Lock()
+    active = []
+    max_active = []
+
+    def tracked_download(url, path):
+        with lock:
+            active.append(path)
+            max_active.append(len(active))
+        time.sleep(0.05)
+        write_fake_weights(url, path)
+        with lock:
+            active.remove(path)
+
+    mock_download.side_effect = tracked_download
+    threads = [
+        threading.Thread(
+            target=cache.ensure, args=(f"https://example.com/w{i}.safetensors",)
+        )
+        for i in range(5)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(cache.lru_entries) == 5
+    assert max(max_active) == 2
+
+
+def test_shared_weights_download_cache_sees_other_downloads(
+    mock_download, mock_base_dir
+):
+    # Two instances on the same directory behave like two processes
+    cache1 = WeightsDownloadCache(min_disk_free=0, base_dir=mock_base_dir, shared=True)
+    cache2 = WeightsDownloadCache(min_disk_free=0, base_dir=mock_base_dir, shared=True)
+    url = "https://example.com/weights1.safetensors"
+
+    path = cache1.ensure(url)
+    assert cache2.ensure(url) == path
+    assert mock_download.call_count == 1
+    assert cache2.hits == 1
+
+
+def test_shared_weights_download_cache_waits_for_other_download(
+    mock_download, mock_base_dir
+):
+    cache1 = WeightsDownloadCache(min_disk_free=0, base_dir=mock_base_dir, shared=True)
+    cache2 = WeightsDownloadCache(min_disk_free=0, base_dir=mock_base_dir, shared=True)
+    url = "https://example.com/weights1.safetensors"
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow_download(url, path):
+        started.set()
+        release.wait(timeout=5)
+        write_fake_weights(url, path)
+
+    mock_download.side_effect = slow_download
+    thread = threading.Thread(target=cache1.ensure, args=(url,))
+    thread.start()
+    started.wait(timeout=5)
+
+    result = []
+    waiter = threading.Thread(target=lambda: result.append(cache2.ensure(url)))
+    waiter.start()
+    time.sleep(0.05)
+    assert not result  # Blocked on the entry lock held by the downloader
+    release.set()
+    thread.join()
+    waiter.join()
+
+    assert result[0].read_bytes() == url.encode().ljust(100, b"x")
+    assert mock_download.call_count == 1
+    assert cache2.coalesced == 1
+
+
+def test_shared_weights_download_cache_lease(mock_download, mock_base_dir):
+    cache1 = WeightsDownloadCache(
+        min_disk_free=0, base_dir=mock_base_dir, max_bytes=150, shared=True
+    )
+    cache2 = WeightsDownloadCache(
+        min_disk_free=0, base_dir=mock_base_dir, max_bytes=150, shared=True
+    )
+
+    with cache1.lease("https://example.com/weights1.safetensors") as leased:
+        # Over budget, but the only candidate is leased by the other instance
+        cache2.ensure("https://example.com/weights2.safetensors")
+        assert leased.exists()
+
+    cache2.ensure("https://example.com/weights3.safetensors")
+    assert not leased.exists()
+    assert mock_download.call_count == 3
+
+    # The first instance learns about the eviction and downloads again
+    cache1.ensure("https://example.com/weights1.safetensors")
+    assert mock_download.call_count == 4
+
+
+def test_weights_download_cache_dedupes_by_identity(mock_download, mock_base_dir):
+    cache = WeightsDownloadCache(min_disk_free=0, base_dir=mock_base_dir)
+
+    # Both forms resolve to https://replicate.com/owner/model/_weights
+    path1 = cache.ensure("owner/model")
+    path2 = cache.ensure("https://replicate.com/owner/model")
+
+    assert path1 == path2
+    assert mock_download.call_count == 1
+    assert cache.deduplicated == 1
+    # Each call is counted once, the second as a miss served without downloading
+    assert cache.misses == 2
+    assert cache.hits == 0
+    assert len(cache.lru_entries) == 1
+
+
+def test_url_resolver_revalidates_huggingface_listing(tmp_path):
+    resolver = URLResolver(tmp_path / ".resolutions.json", ttl=0)
+    url = "https://huggingface.co/owner/model"
+    listing_url = "https://huggingface.co/api/models/owner/model/tree/main"
+    expected = "https://huggingface.co/owner/model/resolve/main/lora.safetensors"
+
+    with requests_mock.Mocker() as m:
+        m.get(
+            listing_url,
+            json=[{"path": "lora.safetensors", "type": "file"}],
+            headers={"ETag": '"listing-v1"'},
+        )
+        assert resolver.resolve(url) == expected
+
+        # Once stale, the listing is fetched conditionally
+        m.get(listing_url, status_code=304)
+        assert URLResolver(tmp_path / ".resolutions.json", ttl=0).resolve(url) == (
+            expected
+        )
+        assert m.last_request.headers["If-None-Match"] == '"listing-v1"'
+
+    # While fresh, nothing is fetched at all
+    resolver.validated(url, '"lora-v1"')
+    resolver.ttl = 60
+    with requests_mock.Mocker():
+        assert resolver.resolve(url) == expected
+
+
+def test_probe_download_not_modified():
+    with requests_mock.Mocker() as m:
+        m.head("https://example.com/model.safetensors", status_code=304)
+        probe = probe_download("https://example.com/model.safetensors", etag='"abc"')
+        assert m.last_request.headers["If-None-Match"] == '"abc"'
+    assert probe.not_modified
+    assert probe.etag == '"abc"'
+
+
+def test_weights_download_cache_revalidates_mutable_urls(
+    monkeypatch, mock_download, mock_base_dir
+):
+    cache = WeightsDownloadCache(min_disk_free=0, base_dir=mock_base_dir)
+    etag = '"v1"'
+    probe = MagicMock(
+        side_effect=lambda url, etag=None: DownloadProbe(
+            url=url, size=100, etag=current_etag, not_modified=etag == current_etag
+        )
+    )
+    monkeypatch.setattr("weights.probe_download", probe)
+
+    current_etag = etag
+    path1 = cache.ensure("owner/model")
+    # Fresh, so served without asking the server
+    assert cache.ensure("owner/model") == path1
+    assert probe.call_count == 1
+
+    cache.resolver.ttl = 0
+    assert cache.ensure("owner/model") == path1
+    assert probe.call_args.kwargs["etag"] == etag
+    assert cache.revalidated == 1
+    assert mock_download.call_count == 1
+
+    # A new version of the model is downloaded
+    current_etag = '"v2"'
+    cache.ensure("owner/model")
+    assert mock_download.call_count == 2
+    assert cache.resolver.etag("owner/model") == '"v2"'
+
+
+def test_weights_download_cache_dedupes_by_content(mock_download, mock_base_dir):
+    cache = WeightsDownloadCache(min_disk_free=0, base_dir=mock_base_dir)
+
+    def same_download(_, path):
+        path.write_bytes(b"same")
+
+    mock_download.side_effect = same_download
+
+    path1 = cache.ensure("https://example.com/a.safetensors")
+    path2 = cache.ensure("https://mirror.example.com/a.safetensors")
+
+    assert path1 == path2
+    assert mock_download.call_count == 2
+    assert cache.deduplicated == 1
+    assert len(cache.lru_entries) == 1
+    assert cache.total_bytes == 4
+
+    # Aliases survive a restart
+    restarted = WeightsDownloadCache(min_disk_free=0, base_dir=mock_base_dir)
+    assert restarted.ensure("https://mirror.example.com/a.safetensors") == path1
+    assert mock_download.call_count == 2
+
+
+def make_tar(files: dict[str, bytes], mode: str = "w") -> bytes:
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode=mode) as tar:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+
+def make_data_url(data: bytes) -> str:
+    return "data:application/x-tar;base64," + base64.b64encode(data).decode()
+
+
+@pytest.mark.parametrize("mode", ["w", "w:gz"])
+def test_download_data_url(tmp_path, mode):
+    weights = os.urandom(3 * 2**20 + 7)  # Spans several decoding chunks
+    data = make_tar(
+        {"README.md": b"hello", "output/lora.safetensors": weights}, mode=mode
+    )
+    path = tmp_path / "weights"
+
+    download_data_url(make_data_url(data), path)
+
+    assert path.read_bytes() == weights
+    assert list(tmp_path.iterdir()) == [path]
+
+
+def test_download_data_url_wrapped_base64(tmp_path):
+    weights = os.urandom(3 * 2**20 + 7)
+    data_url = make_data_url(make_tar({"lora.safetensors": weights}))
+    header, encoded = data_url.split(",", 1)
+    # Wrapped at 76 columns like MIME base64, so lines straddle chunk boundaries
+    wrapped = "\r\n".join(encoded[i : i + 76] for i in range(0, len(encoded), 76))
+    path = tmp_path / "weights"
+
+    download_data_url(f"{header},{wrapped}\n", path)
+
+    assert path.read_bytes() == weights
+
+
+def test_download_data_url_no_safetensors(tmp_path):
+    data = make_tar({"README.md": b"hello"})
+    path = tmp_path / "weights"
+    with pytest.raises(ValueError, match="No .safetensors file found in data URI"):
+        download_data_url(make_data_url(data), path)
+    assert not path.exists()
+
+
+def test_download_data_url_multiple_safetensors(tmp_path):
+    data = make_tar({"a.safetensors": b"a", "b.safetensors": b"b"})
+    path = tmp_path / "weights"
+    with pytest.raises(ValueError, match="Multiple .safetensors files found"):
+        download_data_url(make_data_url(data), path)
+    assert not path.exists()
+
+
+def test_download_safetensors_tarball(tmp_path):
+    url = "https://replicate.delivery/pbxt/ABC123/model.tar"
+    data = make_tar({"lora.safetensors": b"weights", "config.yaml": b"x: 1"})
+    path = tmp_path / "weights"
+
+    with requests_mock.Mocker() as m:
+        m.get(url, body=io.BytesIO(data))
+        download_safetensors_tarball(url, path)
+
+        assert path.read_bytes() == b"weights"
+
+        m.get(url, status_code=404)
+        with pytest.raises(RuntimeError, match="Failed to download tarball"):
+            download_safetensors_tarball(url, path)
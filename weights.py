@@ -1,72 +1,679 @@
 import base64
+import fcntl
 import hashlib
+import io
+import json
 import os
 import re
 import shutil
 import subprocess
 import tarfile
-import tempfile
+import threading
 import time
-from collections import deque
-from io import BytesIO
+from collections import OrderedDict
+from collections.abc import Callable, Iterator
+from concurrent.futures import Future
+from contextlib import contextmanager
+from dataclasses import dataclass
 from pathlib import Path
+from typing import BinaryIO
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from http_downloader import PROGRESS_SUFFIX, ParallelDownloader, progress_path
 
 DEFAULT_CACHE_BASE_DIR = Path("/src/weights-cache")
+JOURNAL_NAME = ".journal"
+RESOLUTIONS_NAME = ".resolutions.json"
+HUGGINGFACE_REPO_PATTERN = r"^(?:https?://)?huggingface\.co/([^/]+)/([^/]+)/?$"
+# How long a mutable URL like <owner>/<model> is trusted before it is revalidated
+DEFAULT_REVALIDATE_AFTER = 60 * 60
+# (connect, read) timeouts for metadata requests
+HTTP_TIMEOUT = (10, 30)
+LOCKS_DIR_NAME = ".locks"
+INDEX_LOCK_NAME = "index.lock"
+# Characters `base64.b64decode` discards
+NON_BASE64_PATTERN = re.compile(r"[^A-Za-z0-9+/=]")
+# Size of the reads when streaming archives and hashing files
+STREAM_CHUNK_SIZE = 2**20
+# "pget" shells out to the pget binary, "native" uses ParallelDownloader
+DOWNLOAD_BACKEND = os.environ.get("WEIGHTS_DOWNLOAD_BACKEND", "pget")
+_parallel_downloader: ParallelDownloader | None = None
+_parallel_downloader_lock = threading.Lock()
+_http_session: requests.Session | None = None
+_http_session_lock = threading.Lock()
+# Rewrite the journal once it holds this many records per live entry
+JOURNAL_COMPACT_FACTOR = 4
 
 
 class WeightsDownloadCache:
     def __init__(
-        self, min_disk_free: int = 10 * (2**30), base_dir: Path = DEFAULT_CACHE_BASE_DIR
+        self,
+        min_disk_free: int = 10 * (2**30),
+        base_dir: Path = DEFAULT_CACHE_BASE_DIR,
+        max_bytes: int | None = None,
+        max_concurrent_downloads: int = 4,
+        shared: bool = False,
+        revalidate_after: float = DEFAULT_REVALIDATE_AFTER,
     ):
+        """
+        Set `shared` when several processes use the same base_dir. The index
+        is then kept in the journal under a file lock, downloads are
+        serialized per entry across processes, and entries leased by any
+        process are never evicted.
+
+        Entries for mutable URLs, which may point at new weights over time,
+        are revalidated with a conditional request once they are older than
+        `revalidate_after` seconds.
+        """
         self.min_disk_free = min_disk_free
+        self.max_bytes = max_bytes
         self.base_dir = base_dir
+        self.shared = shared
         self.hits = 0
         self.misses = 0
-
-        # Least Recently Used (LRU) cache for paths
-        self.lru_paths = deque()
+        # Callers that found their URL already being downloaded and waited for it
+        self.coalesced = 0
+        # Misses that were served by an entry already downloaded for another URL
+        self.deduplicated = 0
+        # Hits on mutable URLs that were confirmed unchanged by the server
+        self.revalidated = 0
+        # Downloads started by `prefetch` rather than by a caller needing the file
+        self.prefetched = 0
+
+        # Guards all bookkeeping below. Downloads themselves run outside of it.
+        self._lock = threading.Lock()
+        # Downloads in progress by URL or identity key, so concurrent callers
+        # share a download
+        self._inflight: dict[str, Future] = {}
+        self._download_slots = threading.BoundedSemaphore(max_concurrent_downloads)
+        # Expected size of downloads in progress, which eviction has to account for
+        self._reserved_bytes = 0
+        # Number of active leases per path in this process
+        self._leases: dict[Path, int] = {}
+
+        # Least Recently Used (LRU) cache mapping paths to their size in bytes,
+        # ordered from least to most recently used. Entries are named after
+        # the hash of their content.
+        self.lru_entries: OrderedDict[Path, int] = OrderedDict()
+        self.total_bytes = 0
+        # Maps the hash of a URL, or of a resolved download identity, to the
+        # name of the entry holding its content. Many aliases can point at
+        # the same entry.
+        self._aliases: dict[str, str] = {}
         base_dir.mkdir(parents=True, exist_ok=True)
 
-    def ensure(self, url: str) -> Path:
-        path = self._weights_path(url)
+        self.journal_path = base_dir / JOURNAL_NAME
+        self.locks_dir = base_dir / LOCKS_DIR_NAME
+        self._journal_records = 0
+        # Position up to which the shared journal has been applied
+        self._journal_offset = 0
+        self._journal_inode = None
+        if shared:
+            self.locks_dir.mkdir(exist_ok=True)
+        with self._locked(sync=False):
+            self._load_index()
 
-        if path in self.lru_paths:
-            # here we remove to re-add to the end of the LRU (marking it as recently used)
-            self.hits += 1
-            self.lru_paths.remove(path)
-        else:
-            self.misses += 1
+        self.resolver = URLResolver(base_dir / RESOLUTIONS_NAME, revalidate_after)
 
-            while not self._has_enough_space() and len(self.lru_paths) > 0:
-                self._remove_least_recent()
+    def ensure(self, url: str) -> Path:
+        """Return the local path of the weights at `url`, downloading them if needed.
+
+        Safe to call from several threads. Concurrent calls for the same URL
+        share a single download, and a failed download is reported to every
+        waiting caller without leaving anything behind in the cache.
+
+        The returned file may be evicted by a later call. Use `lease` to keep
+        it around while it is being read.
+        """
+        alias = _short_hash(url)
+
+        with self._locked():
+            path = self._resolve(alias)
+            if path is not None and self.resolver.is_fresh(url):
+                self.hits += 1
+                self._touch(path)
+                return path
+
+        return self._single_flight(alias, lambda: self._fetch(url, alias))
+
+    def contains(self, url: str) -> bool:
+        """Whether `ensure(url)` would be served from the cache without a request."""
+        with self._locked():
+            path = self._resolve(_short_hash(url))
+            return path is not None and self.resolver.is_fresh(url)
+
+    def prefetch(self, url: str) -> Path | None:
+        """Download `url` ahead of time if that doesn't require evicting anything.
+
+        Meant for background warming: it never pushes out entries that are
+        already cached, and skips downloads whose size isn't known up front.
+        Returns the cached path, or None if the download was skipped.
+        """
+        with self._locked():
+            path = self._resolve(_short_hash(url))
+            # Already cached entries are left where they are in the LRU order
+            if path is not None and self.resolver.is_fresh(url):
+                return path
+        probe = probe_download(self.resolver.resolve(url))
+        if probe.size is None:
+            return None
+        with self._locked():
+            if self._bytes_to_free(probe.size) > 0:
+                return None
+            self.prefetched += 1
+        return self.ensure(url)
+
+    @contextmanager
+    def lease(self, url: str) -> Iterator[Path]:
+        """Like `ensure`, but the file can't be evicted until the block exits.
+
+        In shared mode the lease holds a shared lock on the entry, so it also
+        protects against eviction by other processes.
+        """
+        while True:
+            path = self.ensure(url)
+            with self._lock:
+                self._leases[path] = self._leases.get(path, 0) + 1
+            try:
+                with self._entry_lock(path.name, fcntl.LOCK_SH):
+                    # Another process may have evicted the file between
+                    # ensure() returning and the lock being taken
+                    if path.exists():
+                        yield path
+                        return
+            finally:
+                with self._lock:
+                    self._leases[path] -= 1
+                    if self._leases[path] == 0:
+                        del self._leases[path]
+            with self._locked():
+                self._forget(path)
+
+    def _single_flight(self, key: str, fetch: Callable[[], Path]) -> Path:
+        """Run `fetch`, or wait for the fetch for `key` that is already running."""
+        with self._lock:
+            future = self._inflight.get(key)
+            is_owner = future is None
+            if is_owner:
+                future = self._inflight[key] = Future()
+            else:
+                self.coalesced += 1
+
+        if not is_owner:
+            return future.result()  # Re-raises the error if the fetch failed
 
-            download_weights(url, path)
+        try:
+            path = fetch()
+        except BaseException as e:
+            with self._lock:
+                del self._inflight[key]
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            del self._inflight[key]
+        future.set_result(path)
+        return path
 
-        self.lru_paths.append(path)  # Add file to end of cache
+    def _fetch(self, url: str, alias: str) -> Path:
+        download_url = self.resolver.resolve(url)
+
+        with self._locked():
+            is_cached = self._resolve(alias) is not None
+        # A stale entry is kept if the server confirms it hasn't changed
+        etag = self.resolver.etag(url) if is_cached else None
+        probe = probe_download(download_url, etag=etag)
+        if probe.not_modified:
+            with self._locked():
+                path = self._resolve(alias)
+                if path is not None:
+                    self.hits += 1
+                    self.revalidated += 1
+                    self.resolver.validated(url, etag)
+                    self._touch(path)
+                    return path
+            # Evicted while we were asking, so we need the content after all
+            probe = probe_download(download_url)
+
+        # URLs that resolve to the same file share an identity, so their
+        # duplicates are skipped before anything is downloaded
+        identity = _short_hash(f"{probe.url}\n{probe.etag or ''}")
+
+        with self._locked():
+            self.misses += 1
+            path = self._resolve(identity)
+            if path is not None:
+                self.deduplicated += 1
+                self._add_alias(alias, path.name)
+                self._touch(path)
+                self.resolver.validated(url, probe.etag)
+                return path
+
+        path = self._single_flight(
+            identity, lambda: self._download(download_url, probe, identity)
+        )
+        with self._locked():
+            self._add_alias(alias, path.name)
+        self.resolver.validated(url, probe.etag)
         return path
 
-    def cache_info(self) -> str:
-        return f"CacheInfo(hits={self.hits}, misses={self.misses}, base_dir='{self.base_dir}', currsize={len(self.lru_paths)})"
+    def _download(
+        self, download_url: str, probe: "DownloadProbe", identity: str
+    ) -> Path:
+        expected_size = probe.size or 0
+
+        with self._download_slots, self._entry_lock(identity, fcntl.LOCK_EX):
+            with self._locked():
+                # Another process may have downloaded it while we waited for the lock
+                path = self._resolve(identity)
+                if path is not None:
+                    self.coalesced += 1
+                    self._touch(path)
+                    return path
+
+                self._make_room(expected_size)
+                self._reserved_bytes += expected_size
+
+            # Download next to the final path and rename into place, so a
+            # failed or interrupted download never looks like a cache entry
+            partial_path = self.base_dir / f".{identity}.partial"
+            partial_progress_path = progress_path(partial_path)
+            try:
+                sha256 = download_weights_url(download_url, partial_path)
+                sha256 = sha256 or _file_sha256(partial_path)
+                path = self.base_dir / sha256[:16]
+
+                with self._locked():
+                    if path in self.lru_entries or path.exists():
+                        # Same content as an entry downloaded through another URL
+                        self.deduplicated += 1
+                        self._forget(path)
+                    else:
+                        partial_path.replace(path)
+                    self._add_entry(path, path.stat().st_size)
+                    # The expected size is only a hint, so correct for any overshoot
+                    # using our own bookkeeping rather than asking the filesystem again
+                    self._enforce_max_bytes(keep=path)
+                    self._append_journal(path)
+                    self._add_alias(identity, path.name)
+            except BaseException:
+                # Downloads that recorded their progress are resumed by the
+                # next attempt, anything else starts over
+                if not partial_progress_path.exists():
+                    partial_path.unlink(missing_ok=True)
+                raise
+            finally:
+                with self._lock:
+                    self._reserved_bytes -= expected_size
+            partial_path.unlink(missing_ok=True)
+            partial_progress_path.unlink(missing_ok=True)
 
-    def _remove_least_recent(self) -> None:
-        oldest = self.lru_paths.popleft()
-        print("removing oldest", oldest)
-        oldest.unlink()
+        return path
 
-    def _has_enough_space(self) -> bool:
-        disk_usage = shutil.disk_usage(self.base_dir)
+    def cache_info(self) -> str:
+        return f"CacheInfo(hits={self.hits}, misses={self.misses}, base_dir='{self.base_dir}', currsize={len(self.lru_entries)}, bytes={self.total_bytes}, coalesced={self.coalesced}, deduplicated={self.deduplicated}, revalidated={self.revalidated}, prefetched={self.prefetched})"
+
+    @contextmanager
+    def _locked(self, sync: bool = True) -> Iterator[None]:
+        """Hold the lock over the index, and in shared mode bring it up to date."""
+        with self._lock:
+            if not self.shared:
+                yield
+                return
+            with _flock(self.locks_dir / INDEX_LOCK_NAME, fcntl.LOCK_EX):
+                if sync:
+                    self._sync_journal()
+                yield
+
+    @contextmanager
+    def _entry_lock(self, name: str, operation: int) -> Iterator[bool]:
+        """Lock an entry or identity against other processes, if in shared mode."""
+        if not self.shared:
+            yield True
+            return
+        with _flock(self.locks_dir / f"{name}.lock", operation) as locked:
+            yield locked
+
+    def _resolve(self, key: str) -> Path | None:
+        """Return the cached entry an alias points at, if any."""
+        # Entries written before aliases existed are named after their URL hash
+        path = self.base_dir / self._aliases.get(key, key)
+        return path if path in self.lru_entries else None
+
+    def _add_alias(self, alias: str, name: str) -> None:
+        if self._aliases.get(alias) != name:
+            self._aliases[alias] = name
+            self._append_journal(self.base_dir / name, op="alias", alias=alias)
+
+    def _touch(self, path: Path) -> None:
+        self.lru_entries.move_to_end(path)  # Mark as most recently used
+        self._append_journal(path)
+
+    def _load_index(self, compact: bool = True) -> None:
+        """Rebuild the LRU order from the files already in base_dir.
+
+        Every regular file is an entry. Entries are ordered by the time the
+        journal last saw them, falling back to their last-access time for
+        files the journal doesn't know about (e.g. caches written before the
+        journal existed). Empty files are leftovers of interrupted downloads
+        and are removed, as are partial downloads and their progress files.
+        """
+        last_used = {}
+        sizes = {}
+        for path in self.base_dir.iterdir():
+            if path.name.endswith(".partial"):
+                # In shared mode, the partial file may be a download in progress
+                identity = path.name[1 : -len(".partial")]
+                with self._entry_lock(identity, fcntl.LOCK_EX | fcntl.LOCK_NB) as ok:
+                    if ok:
+                        print("removing partial download", path)
+                        path.unlink(missing_ok=True)
+                        progress_path(path).unlink(missing_ok=True)
+                continue
+            if path.name.endswith(f".partial{PROGRESS_SUFFIX}"):
+                if not path.with_name(path.name[: -len(PROGRESS_SUFFIX)]).exists():
+                    print("removing orphaned download progress", path)
+                    path.unlink(missing_ok=True)
+                continue
+            if path.name.startswith(".") or not path.is_file():
+                continue
+            stat = path.stat()
+            if stat.st_size == 0:
+                print("removing empty cache file", path)
+                path.unlink()
+                continue
+            last_used[path.name] = stat.st_atime
+            sizes[path.name] = stat.st_size
+
+        records, offset = self._read_journal()
+        aliases = {}
+        for record in records:
+            if record.get("op") == "alias":
+                aliases[record["alias"]] = record["key"]
+            elif record["key"] in last_used and record.get("op") != "remove":
+                last_used[record["key"]] = record["t"]
+        self._aliases = {a: n for a, n in aliases.items() if n in last_used}
+
+        for name in sorted(last_used, key=last_used.__getitem__):
+            self._add_entry(self.base_dir / name, sizes[name])
+
+        if compact:
+            self._compact_journal(last_used)
+        else:
+            self._journal_records = len(records)
+            self._journal_offset = offset
+            self._journal_inode = _inode(self.journal_path)
+
+        if self.lru_entries:
+            print(
+                f"Restored {len(self.lru_entries)} cached weights "
+                f"({self.total_bytes / 2**30:.2f} GiB) from {self.base_dir}"
+            )
+
+    def _sync_journal(self) -> None:
+        """Apply the journal records other processes appended since we last looked."""
+        if _inode(self.journal_path) != self._journal_inode:
+            # Another process compacted the journal, so start over from disk
+            self.lru_entries.clear()
+            self.total_bytes = 0
+            self._aliases.clear()
+            self._load_index(compact=False)
+            return
+
+        records, self._journal_offset = self._read_journal(self._journal_offset)
+        self._journal_records += len(records)
+        for record in records:
+            path = self.base_dir / record["key"]
+            if record.get("op") == "alias":
+                self._aliases[record["alias"]] = record["key"]
+            elif record.get("op") == "remove":
+                self._forget(path)
+            elif path in self.lru_entries:
+                self.lru_entries.move_to_end(path)
+            elif path.exists():
+                self._add_entry(path, path.stat().st_size)
+
+    def _read_journal(self, offset: int = 0) -> tuple[list[dict], int]:
+        if not self.journal_path.exists():
+            return [], 0
+        records = []
+        with self.journal_path.open("rb") as f:
+            f.seek(offset)
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # Torn write from a crash, the remaining records are still valid
+                    continue
+                if isinstance(record, dict) and "key" in record and "t" in record:
+                    records.append(record)
+            return records, f.tell()
+
+    def _append_journal(self, path: Path, **fields: str) -> None:
+        record = {"key": path.name, "t": time.time(), **fields}
+        with self.journal_path.open("a") as f:
+            f.write(json.dumps(record) + "\n")
+            # We hold the index lock, so nothing was appended after our record
+            self._journal_offset = f.tell()
+        self._journal_records += 1
+
+        if self._journal_records > JOURNAL_COMPACT_FACTOR * max(
+            len(self.lru_entries), 16
+        ):
+            now = time.time()
+            # Only the order matters when rewriting, so synthesize increasing times
+            last_used = {
+                p.name: now - len(self.lru_entries) + i
+                for i, p in enumerate(self.lru_entries)
+            }
+            self._compact_journal(last_used)
+
+    def _compact_journal(self, last_used: dict[str, float]) -> None:
+        tmp_path = self.journal_path.with_name(self.journal_path.name + ".tmp")
+        with tmp_path.open("w") as f:
+            for name in sorted(last_used, key=last_used.__getitem__):
+                f.write(json.dumps({"key": name, "t": last_used[name]}) + "\n")
+            for alias, name in self._aliases.items():
+                if name in last_used:
+                    record = {"key": name, "t": 0, "op": "alias", "alias": alias}
+                    f.write(json.dumps(record) + "\n")
+            offset = f.tell()
+        tmp_path.replace(self.journal_path)
+        self._journal_records = len(last_used)
+        self._journal_offset = offset
+        self._journal_inode = _inode(self.journal_path)
+
+    def _add_entry(self, path: Path, size: int) -> None:
+        self.lru_entries[path] = size
+        self.total_bytes += size
+
+    def _forget(self, path: Path) -> None:
+        size = self.lru_entries.pop(path, None)
+        if size is not None:
+            self.total_bytes -= size
+
+    def _make_room(self, incoming: int) -> None:
+        """Evict enough least recently used entries to fit `incoming` bytes.
+
+        The disk is queried once and the victims are chosen up front from
+        the recorded entry sizes, so a download is preceded by at most one
+        round of evictions. Space promised to downloads that are still in
+        progress counts as used.
+        """
+        to_free = self._bytes_to_free(incoming)
+        for path in list(self.lru_entries):
+            if to_free <= 0:
+                break
+            to_free -= self._remove(path)
+
+    def _bytes_to_free(self, incoming: int) -> int:
+        incoming += self._reserved_bytes
+        to_free = self.min_disk_free + incoming - shutil.disk_usage(self.base_dir).free
+        if self.max_bytes is not None:
+            to_free = max(to_free, self.total_bytes + incoming - self.max_bytes)
+        return to_free
+
+    def _enforce_max_bytes(self, keep: Path) -> None:
+        if self.max_bytes is None:
+            return
+        for path in list(self.lru_entries):
+            if self.total_bytes <= self.max_bytes:
+                break
+            if path != keep:
+                self._remove(path)
+
+    def _remove(self, path: Path) -> int:
+        """Evict an entry, returning the number of bytes freed.
+
+        Entries leased by this or (in shared mode) another process are
+        skipped and free nothing.
+        """
+        if path in self._leases:
+            return 0
+        with self._entry_lock(path.name, fcntl.LOCK_EX | fcntl.LOCK_NB) as locked:
+            if not locked:
+                return 0
+            size = self.lru_entries.pop(path)
+            self.total_bytes -= size
+            print("removing least recently used", path)
+            path.unlink(missing_ok=True)
+            for sidecar in path.parent.glob(f".{path.name}.sidecar.*"):
+                sidecar.unlink(missing_ok=True)
+            self._append_journal(path, op="remove")
+        return size
+
+
+def sidecar_path(path: Path, suffix: str) -> Path:
+    """Where to store a file derived from the cached file at `path`.
+
+    Sidecars are hidden from the index, don't count towards `max_bytes`
+    and are removed when their cached file is evicted.
+    """
+    return path.with_name(f".{path.name}.sidecar.{suffix}")
+
+
+def _short_hash(value: str) -> str:
+    hashed = hashlib.sha256(value.encode()).hexdigest()
+    return hashed[:16]  # Use the first 16 characters of the hash
+
+
+def _file_sha256(path: Path) -> str:
+    sha256 = hashlib.sha256()
+    with path.open("rb") as f:
+        while chunk := f.read(STREAM_CHUNK_SIZE):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def _inode(path: Path) -> int | None:
+    try:
+        return path.stat().st_ino
+    except FileNotFoundError:
+        return None
 
-        free = disk_usage.free
-        print(f"{free=}")  # TODO(andreas): remove debug
 
-        return free >= self.min_disk_free
+@contextmanager
+def _flock(lock_path: Path, operation: int) -> Iterator[bool]:
+    """Hold an advisory lock on `lock_path`, yielding whether it was acquired.
 
-    def _weights_path(self, url: str) -> Path:
-        hashed_url = hashlib.sha256(url.encode()).hexdigest()
-        short_hash = hashed_url[:16]  # Use the first 16 characters of the hash
-        return self.base_dir / short_hash
+    Only non-blocking operations (LOCK_NB) can fail to acquire the lock.
+    """
+    fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        try:
+            fcntl.flock(fd, operation)
+        except BlockingIOError:
+            yield False
+            return
+        yield True
+    finally:
+        os.close(fd)  # Closing the descriptor releases the lock
+
+
+class URLResolver:
+    """
+    Remembers what weight URLs resolve to, in a small JSON table next to the
+    cache, so repeat lookups don't hit the network. Mutable URLs (see
+    `is_mutable_url`) are only trusted for `ttl` seconds after they were last
+    validated. HuggingFace repository listings are then re-fetched with
+    If-None-Match, which is a cheap 304 when nothing changed.
+    """
+
+    def __init__(self, path: Path, ttl: float):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        try:
+            self._table: dict[str, dict] = json.loads(path.read_text())
+        except (FileNotFoundError, json.JSONDecodeError):
+            self._table = {}
+
+    def resolve(self, url: str) -> str:
+        if not is_mutable_url(url):
+            return make_download_url(url)
+        with self._lock:
+            entry = dict(self._table.get(url, {}))
+        if "download_url" in entry and self._is_fresh(url, entry):
+            return entry["download_url"]
+
+        listing_etag = None
+        if m := re.match(HUGGINGFACE_REPO_PATTERN, url):
+            owner, model_name = m.groups()
+            download_url, listing_etag = resolve_huggingface_download_url(
+                owner, model_name, etag=entry.get("listing_etag")
+            )
+            download_url = download_url or entry["download_url"]
+        else:
+            download_url = make_download_url(url)
+
+        with self._lock:
+            self._table.setdefault(url, {}).update(
+                download_url=download_url, listing_etag=listing_etag
+            )
+            self._save()
+        return download_url
+
+    def is_fresh(self, url: str) -> bool:
+        with self._lock:
+            return self._is_fresh(url, self._table.get(url, {}))
+
+    def etag(self, url: str) -> str | None:
+        with self._lock:
+            return self._table.get(url, {}).get("etag")
+
+    def validated(self, url: str, etag: str | None) -> None:
+        """Record that `url` was just checked and serves the file with `etag`."""
+        if not is_mutable_url(url):
+            return
+        with self._lock:
+            self._table.setdefault(url, {}).update(etag=etag, validated_at=time.time())
+            self._save()
+
+    def _is_fresh(self, url: str, entry: dict) -> bool:
+        if not is_mutable_url(url):
+            return True
+        return time.time() - entry.get("validated_at", 0) < self.ttl
+
+    def _save(self) -> None:
+        tmp_path = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+        tmp_path.write_text(json.dumps(self._table))
+        tmp_path.replace(self.path)
+
+
+def is_mutable_url(url: str) -> bool:
+    """Whether `url` may resolve to different weights over time, e.g. the latest version."""
+    if url.startswith("data:"):
+        return False
+    if re.match(HUGGINGFACE_REPO_PATTERN, url):
+        return True
+    if re.match(r"^(?:https?://)?civitai\.com/models/(\d+)(?:/[^/?]+)?/?$", url):
+        return True
+    if "civitai.com" in url or re.match(r"^(https?://.*\.safetensors)(?:\?|$)", url):
+        return False
+    return bool(re.match(r"^(?:https?://replicate.com/)?([^/]+)/([^/]+)/?$", url))
 
 
 def download_weights(url: str, path: Path):
@@ -74,86 +681,209 @@ def download_weights(url: str, path: Path):
     download_weights_url(download_url, path)
 
 
-def download_weights_url(url: str, path: Path):
+@dataclass
+class DownloadProbe:
+    # Final URL after following redirects
+    url: str
+    # Expected number of bytes, if the server told us
+    size: int | None = None
+    etag: str | None = None
+    # The server confirmed the file still matches the ETag we sent
+    not_modified: bool = False
+
+
+def probe_download(url: str, etag: str | None = None) -> DownloadProbe:
+    """Best-effort lookup of what downloading `url` will fetch, without fetching it.
+
+    With `etag`, the request is conditional and a server that still has the
+    same file answers with `not_modified` set.
+    """
+    if url.startswith("data:"):
+        _, encoded = url.split(",", 1)
+        return DownloadProbe(url=url, size=len(encoded) * 3 // 4)
+
+    headers = {"If-None-Match": etag} if etag else {}
+    try:
+        response = get_http_session().head(
+            url, headers=headers, allow_redirects=True, timeout=HTTP_TIMEOUT
+        )
+    except requests.RequestException as e:
+        print(f"Failed to probe {url}: {e}")
+        return DownloadProbe(url=url)
+    if response.status_code == 304:
+        return DownloadProbe(url=response.url, etag=etag, not_modified=True)
+    if not response.ok:
+        return DownloadProbe(url=url)
+
+    content_length = response.headers.get("Content-Length", "")
+    return DownloadProbe(
+        url=response.url,
+        size=int(content_length) if content_length.isdigit() else None,
+        etag=response.headers.get("ETag"),
+    )
+
+
+def download_weights_url(url: str, path: Path) -> str | None:
+    """Download the weights at `url` to `path`.
+
+    Returns the SHA-256 hex digest of the file if the backend computed it
+    while downloading, otherwise None.
+    """
     path = Path(path)
 
     print("Downloading weights")
     start_time = time.time()
 
+    sha256 = None
     if url.startswith("data:"):
         download_data_url(url, path)
     elif url.endswith(".tar"):
         download_safetensors_tarball(url, path)
     elif url.endswith(".safetensors") or "://civitai.com/api/download" in url:
-        download_safetensors(url, path)
+        sha256 = download_safetensors(url, path)
     elif url.endswith("/_weights"):
         download_safetensors_tarball(url, path)
     else:
         raise ValueError("URL must end with either .tar or .safetensors")
 
     print(f"Downloaded weights in {time.time() - start_time:.2f}s")
-
-
-def find_safetensors(directory: Path) -> list[Path]:
-    safetensors_paths = []
-    for root, _, files in os.walk(directory):
-        root = Path(root)
-        for filename in files:
-            path = root / filename
-            if path.suffix == ".safetensors":
-                safetensors_paths.append(path)
-    return safetensors_paths
+    return sha256
 
 
 def download_safetensors_tarball(url: str, path: Path):
-    with tempfile.TemporaryDirectory() as temp_dir:
-        temp_dir = Path(temp_dir)
-        extract_dir = temp_dir / "weights"
-
-        try:
-            subprocess.run(["pget", "-x", url, extract_dir], check=True)
-        except subprocess.CalledProcessError as e:
-            raise RuntimeError(f"Failed to download tarball: {e}")
-
-        safetensors_paths = find_safetensors(extract_dir)
-        if not safetensors_paths:
-            raise ValueError("No .safetensors file found in tarball")
-        if len(safetensors_paths) > 1:
-            raise ValueError("Multiple .safetensors files found in tarball")
-        safetensors_path = safetensors_paths[0]
-
-        shutil.move(safetensors_path, path)
+    try:
+        with get_http_session().get(url, stream=True, timeout=HTTP_TIMEOUT) as response:
+            response.raise_for_status()
+            response.raw.decode_content = True
+            extract_safetensors(response.raw, path, source="tarball")
+    except requests.RequestException as e:
+        raise RuntimeError(f"Failed to download tarball: {e}")
 
 
 def download_data_url(url: str, path: Path):
     _, encoded = url.split(",", 1)
-    data = base64.b64decode(encoded)
-
-    with tempfile.TemporaryDirectory() as temp_dir:
-        with tarfile.open(fileobj=BytesIO(data), mode="r:*") as tar:
-            tar.extractall(path=temp_dir)
+    extract_safetensors(Base64Reader(encoded), path, source="data URI")
 
-        safetensors_paths = find_safetensors(Path(temp_dir))
-        if not safetensors_paths:
-            raise ValueError("No .safetensors file found in data URI")
-        if len(safetensors_paths) > 1:
-            raise ValueError("Multiple .safetensors files found in data URI")
-        safetensors_path = safetensors_paths[0]
 
-        shutil.move(safetensors_path, path)
+def extract_safetensors(fileobj: BinaryIO, path: Path, source: str):
+    """Write the single .safetensors member of the tar stream `fileobj` to `path`.
 
+    The archive is read sequentially as it arrives and other members are
+    skipped without being written anywhere. The whole stream is consumed to
+    make sure there is exactly one .safetensors file. `path` is removed
+    again if that isn't the case, so callers that need the final file to
+    appear atomically should pass a temporary path and rename it.
+    """
+    found = False
+    try:
+        with tarfile.open(fileobj=fileobj, mode="r|*") as tar:
+            for member in tar:
+                if not member.isfile() or not member.name.endswith(".safetensors"):
+                    continue
+                if found:
+                    raise ValueError(f"Multiple .safetensors files found in {source}")
+                with tar.extractfile(member) as src, path.open("wb") as dest:
+                    shutil.copyfileobj(src, dest, STREAM_CHUNK_SIZE)
+                found = True
+    except BaseException:
+        path.unlink(missing_ok=True)
+        raise
+
+    if not found:
+        raise ValueError(f"No .safetensors file found in {source}")
+
+
+class Base64Reader(io.RawIOBase):
+    """Read-only file object decoding a base64 string a chunk at a time.
+
+    Like `base64.b64decode`, characters outside the base64 alphabet, such as
+    the line breaks of wrapped base64, are ignored.
+    """
+
+    def __init__(self, encoded: str):
+        self.encoded = encoded
+        self.position = 0
+        self.decoded = memoryview(b"")
+        # Base64 characters left over from the previous chunk, fewer than 4
+        self.pending = ""
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while not self.decoded and self.position < len(self.encoded):
+            end = self.position + 4 * (STREAM_CHUNK_SIZE // 3)
+            chunk = self.pending + NON_BASE64_PATTERN.sub(
+                "", self.encoded[self.position : end]
+            )
+            self.position = end
+            if self.position < len(self.encoded):
+                # Only whole groups of 4 characters decode on their own
+                split = len(chunk) - len(chunk) % 4
+                chunk, self.pending = chunk[:split], chunk[split:]
+            else:
+                self.pending = ""
+            self.decoded = memoryview(base64.b64decode(chunk))
+        n = min(len(b), len(self.decoded))
+        b[:n] = self.decoded[:n]
+        self.decoded = self.decoded[n:]
+        return n
+
+
+def download_safetensors(url: str, path: Path) -> str | None:
+    if DOWNLOAD_BACKEND == "native":
+        try:
+            return get_parallel_downloader().download(url, path)
+        except requests.RequestException as e:
+            raise RuntimeError(f"Failed to download safetensors file: {e}")
 
-def download_safetensors(url: str, path: Path):
     try:
         subprocess.run(["pget", url, str(path)], check=True)
     except subprocess.CalledProcessError as e:
         raise RuntimeError(f"Failed to download safetensors file: {e}")
+    return None
+
+
+def set_download_backend(backend: str):
+    """Choose how files are downloaded: "pget" or "native" (in-process)."""
+    global DOWNLOAD_BACKEND
+    if backend not in ("pget", "native"):
+        raise ValueError(f"Unknown download backend: {backend}")
+    DOWNLOAD_BACKEND = backend
+
+
+def get_http_session() -> requests.Session:
+    """Pooled session with retries, shared by all metadata and streaming requests."""
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_maxsize=16,
+                max_retries=Retry(
+                    total=3,
+                    backoff_factor=0.5,
+                    status_forcelist=(429, 500, 502, 503, 504),
+                ),
+            )
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _http_session = session
+        return _http_session
+
+
+def get_parallel_downloader() -> ParallelDownloader:
+    global _parallel_downloader
+    with _parallel_downloader_lock:
+        if _parallel_downloader is None:
+            _parallel_downloader = ParallelDownloader()
+        return _parallel_downloader
 
 
 def make_download_url(url: str) -> str:
     if url.startswith("data:"):
         return url
-    if m := re.match(r"^(?:https?://)?huggingface\.co/([^/]+)/([^/]+)/?$", url):
+    if m := re.match(HUGGINGFACE_REPO_PATTERN, url):
         owner, model_name = m.groups()
         return make_huggingface_download_url(owner, model_name)
     if m := re.match(r"^(?:https?://)?civitai\.com/models/(\d+)(?:/[^/?]+)?/?$", url):
@@ -202,8 +932,24 @@ def make_replicate_version_download_url(
 
 
 def make_huggingface_download_url(owner: str, model_name: str) -> str:
+    download_url, _ = resolve_huggingface_download_url(owner, model_name)
+    assert download_url is not None
+    return download_url
+
+
+def resolve_huggingface_download_url(
+    owner: str, model_name: str, etag: str | None = None
+) -> tuple[str | None, str | None]:
+    """Find the .safetensors file in a HuggingFace repository.
+
+    Returns the download URL and the ETag of the repository listing. If
+    `etag` is given and the listing hasn't changed, the URL is None.
+    """
     url = f"https://huggingface.co/api/models/{owner}/{model_name}/tree/main"
-    response = requests.get(url)
+    headers = {"If-None-Match": etag} if etag else {}
+    response = get_http_session().get(url, headers=headers, timeout=HTTP_TIMEOUT)
+    if etag and response.status_code == 304:
+        return None, etag
     response.raise_for_status()
 
     files = response.json()
@@ -216,7 +962,8 @@ def make_huggingface_download_url(owner: str, model_name: str) -> str:
 
     safetensors_path = safetensors_files[0]["path"]
     return (
-        f"https://huggingface.co/{owner}/{model_name}/resolve/main/{safetensors_path}"
+        f"https://huggingface.co/{owner}/{model_name}/resolve/main/{safetensors_path}",
+        response.headers.get("ETag"),
     )
 
 